@@ -1,26 +1,78 @@
 # Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
 
-from flask import Flask, request, jsonify
+from flask import (Flask, Response, g, has_request_context, request, jsonify,
+                   stream_with_context)
 import pickle
 import base64
-import io
+import collections
+import contextlib
+import hmac
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import torch
 import torchvision.transforms as transforms
-from PIL import Image
 
 # Model libs
-from classification_model.downloader import ImageDownloader
+from classification_model.admission import Limiter, Rejected
+from classification_model.downloader import ImageDownloader, TileFetcher
+from classification_model.providers import make_provider
+from classification_model.scan import iter_cascade, iter_scan
+from classification_model.tiling import (TileGrid, tile_grid, grid_shape,
+                                         geometry_polygons, polygons_bbox)
 from classification_model.query import ModelQuery
 from classification_model.image_utils import overlay_image_mask
+from classification_model.encoders import ImageEncoder
+from classification_model.detections import DetectionStore
+from classification_model.jobs import JobRunner, JobStore
+from classification_model.metrics import Metrics, StageTimer
+from classification_model.preprocessing import Preprocessor
+from classification_model.registry import ModelRegistry
+from classification_model.result_cache import ResultCache
+from classification_model.scheduler import BatchScheduler
+from classification_model.singleflight import SingleFlight
+from classification_model.tile_cache import TileCache
+from classification_model.vectorize import grid_polygons
 
 # Argument validators
 from validators import (is_valid_latitude, is_valid_longitude,
-                       is_valid_zoom, is_valid_quantile, check_arguments)
+                       is_valid_zoom, is_valid_quantile, check_arguments,
+                       check_area_arguments, check_output_arguments,
+                       check_encoding_arguments, check_cascade_arguments,
+                       check_cam_arguments, check_detections_arguments,
+                       is_valid_max_age)
 # Service settings
-from settings import (secret_key, model_path,
+from settings import (secret_key, model_path, model_version, model_paths, model_swap_token,
+                      inference_backend, channels_last,
                       default_zoom, default_pixel_quantile,
-                      positive_message, negative_message)
+                      positive_message, negative_message,
+                      batch_max_size, batch_max_wait,
+                      batch_max_locations, download_workers,
+                      tile_cache_dir, tile_cache_max_bytes,
+                      tile_cache_ttl, tile_cache_memory_items,
+                      tile_provider, tile_provider_url, tile_provider_dir,
+                      download_timeout, download_retries, download_backoff,
+                      download_max_backoff, download_rate_limit, download_max_concurrency,
+                      tile_size, scan_max_tiles,
+                      response_formats, default_response_format,
+                      cam_output_types, default_cam_outputs,
+                      result_cache_items,
+                      image_format, image_quality, png_compress_level,
+                      jobs_db, jobs_workers, jobs_chunk_size, jobs_lease,
+                      jobs_max_tiles, jobs_page_size,
+                      server_timing_header,
+                      coalesce_requests, coalesce_precision,
+                      cascade_start_zoom, cascade_threshold,
+                      detections_db, detections_store_cam, detections_max_age,
+                      detections_max_results, detections_max_radius,
+                      admission_control, admission_download_max_in_flight,
+                      admission_download_max_queue, admission_inference_max_in_flight,
+                      admission_inference_max_queue, admission_reject_status,
+                      admission_default_timeout, admission_memory_budget)
 
 from settings import port_number
 
@@ -33,30 +85,160 @@ transform = transforms.Compose([
     transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 ])
 
-### Utils
-def numpy_to_bytes(arr):
-    image = Image.fromarray(arr.astype('uint8'))
+# Fused uint8 -> normalized float input, same values as `transform`.
+preprocessor = Preprocessor([0.485, 0.456, 0.406], [0.229, 0.224, 0.225],
+                            device=device, channels_last=channels_last)
 
-    # PIL Image to byte buffer
-    byte_buffer = io.BytesIO()
-    image.save(byte_buffer, format='PNG')
-    byte_buffer.seek(0)
+# The model is loaded (and warmed up) once per process, in background so the
+# server can answer /ready meanwhile.
+registry = ModelRegistry(device=device, input_size=tile_size,
+                         backend=inference_backend,
+                         channels_last=channels_last)
+model_loader = registry.load_async(model_version, model_path)
 
-    # Get the byte data
-    byte_data = byte_buffer.read()
+def run_query_batch(items):
+    '''
+    Runs a batch of (model, image, quantile) items, grouped by model
+    (a swap may happen while items are queued).
+    '''
+    results = [None] * len(items)
+    groups = {}
+    for i, (model, _, _) in enumerate(items):
+        groups.setdefault(id(model), []).append(i)
 
-    return byte_data
+    for indices in groups.values():
+        query = ModelQuery(model=items[indices[0]][0],
+                           device=device,
+                           preprocessor=preprocessor)
+        timings = {}
+        outputs = query.make_batch_query([items[i][1] for i in indices],
+                                         [items[i][2] for i in indices],
+                                         return_raw=True,
+                                         timings=timings)
+        for i, output in zip(indices, outputs):
+            results[i] = output, timings
+    return results
 
+# Concurrent queries share forward passes.
+scheduler = BatchScheduler(run_query_batch,
+                           max_batch_size=batch_max_size,
+                           max_wait=batch_max_wait)
 
-### Methods
-@app.route('/predict', methods=['POST'])
-def predict():
-    
-    if request.is_json:
-        data = request.json
-    else:
-        data = request.form
+# Model outputs of known tiles: a new quantile doesn't run the model again.
+result_cache = ResultCache(result_cache_items) if result_cache_items else None
+
+# Downloaded tiles are reused across requests.
+tile_cache = None
+if tile_cache_dir:
+    tile_cache = TileCache(tile_cache_dir,
+                           max_bytes=tile_cache_max_bytes,
+                           ttl=tile_cache_ttl,
+                           memory_items=tile_cache_memory_items)
+
+# Tile source and the pooled HTTP client shared by all downloads.
+tile_source = make_provider(tile_provider,
+                            secret_key=secret_key,
+                            url=tile_provider_url,
+                            directory=tile_provider_dir)
+tile_fetcher = TileFetcher(timeout=download_timeout,
+                           retries=download_retries,
+                           backoff=download_backoff,
+                           max_backoff=download_max_backoff,
+                           rate_limit=download_rate_limit,
+                           max_concurrency=download_max_concurrency)
+
+# Concurrent requests for the same tile share their download and inference.
+coalescer = SingleFlight() if coalesce_requests else None
+
+# Every prediction is kept, indexed by its tile footprint, for /detections.
+detection_store = None
+if detections_db:
+    detection_store = DetectionStore(detections_db, tile_size=tile_size,
+                                     precision=coalesce_precision)
+
+# Bounded in-flight requests and wait queues per stage: overload is
+# rejected early instead of piling up requests that will time out.
+download_limiter = inference_limiter = memory_limiter = None
+if admission_control:
+    download_limiter = Limiter('download', admission_download_max_in_flight,
+                               admission_download_max_queue)
+    inference_limiter = Limiter('inference', admission_inference_max_in_flight,
+                                admission_inference_max_queue)
+    if admission_memory_budget:
+        # In bytes: a request reserves its decoded tile.
+        memory_limiter = Limiter('memory', admission_memory_budget)
+tile_bytes = tile_size * tile_size * 3
+limiters = [l for l in (download_limiter, inference_limiter, memory_limiter) if l is not None]
+
+# Latency histograms and counters of this process, exposed at /metrics.
+metrics = Metrics()
+metrics.describe('request_duration_seconds', 'Request latency by endpoint.')
+metrics.describe('stage_duration_seconds', 'Latency of each stage of a query.')
+metrics.describe('requests_total', 'Requests by endpoint and status code.')
+metrics.describe('predictions_total', 'Tile predictions by result.')
+metrics.describe('upstream_errors_total', 'Tile download errors by upstream status.')
+metrics.describe('stored_predictions_total', 'Predictions answered from the detections store.')
+
+def collect_stats():
+    # Series taken from the stats of the components.
+    status = registry.status()
+    yield 'model_ready', 'gauge', {}, int(status['ready'])
+    if status['load_seconds'] is not None:
+        yield 'model_load_seconds', 'gauge', {}, status['load_seconds']
+
+    stats = scheduler.stats()
+    yield 'batch_queue_depth', 'gauge', {}, stats['queue_depth']
+    yield 'batches_total', 'counter', {}, stats['batches']
+    yield 'batch_items_total', 'counter', {}, stats['items']
+    yield 'batch_expired_total', 'counter', {}, stats['expired']
+
+    for limiter in limiters:
+        stats = limiter.stats()
+        labels = {'stage': limiter.name}
+        yield 'admission_in_use', 'gauge', labels, stats['in_use']
+        yield 'admission_waiting', 'gauge', labels, stats['waiting']
+        yield 'admission_rejected_total', 'counter', labels, stats['rejected']
+        yield 'admission_expired_total', 'counter', labels, stats['expired']
+
+    if tile_cache is not None:
+        stats = tile_cache.stats()
+        yield 'tile_cache_hits_total', 'counter', {'tier': 'memory'}, stats['memory_hits']
+        yield 'tile_cache_hits_total', 'counter', {'tier': 'disk'}, stats['disk_hits']
+        yield 'tile_cache_misses_total', 'counter', {}, stats['misses']
+    if result_cache is not None:
+        stats = result_cache.stats()
+        yield 'result_cache_hits_total', 'counter', {}, stats['hits']
+        yield 'result_cache_misses_total', 'counter', {}, stats['misses']
+    if coalescer is not None:
+        stats = coalescer.stats()
+        yield 'coalesced_requests_total', 'counter', {}, stats['coalesced']
+        yield 'coalescing_leaders_total', 'counter', {}, stats['leaders']
+    if detection_store is not None:
+        stats = detection_store.stats()
+        yield 'detections_stored', 'gauge', {}, stats['detections']
+        yield 'detections_queued', 'gauge', {}, stats['queued']
+        yield 'detections_dropped_total', 'counter', {}, stats['dropped']
+
+metrics.add_collector(collect_stats)
 
+### Utils
+class ServiceError(Exception):
+    ''' Error reported to the client with the given HTTP status code.'''
+    def __init__(self, message, code=500, errors=None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.errors = errors
+
+    def to_dict(self):
+        return {'status': 'error',
+                'message': self.message,
+                'errors': self.errors,
+                'data': None,
+                }
+
+def parse_arguments(data):
+    ''' Returns the validated (zoom, quantile, lat, lon) of a request.'''
     # Value checking.
     if 'zoom' in data:
         zoom = data['zoom']
@@ -71,101 +253,854 @@ def predict():
     if 'latitude' in data:
         lat = data['latitude']
     else:
-        return jsonify({'status': 'error',
-                        'message': 'Latitude is a mandatory argument.',
-                        'errors': None,
-                        'data': None,
-                }), 400
+        raise ServiceError('Latitude is a mandatory argument.', 400)
 
     if 'longitude' in data:
         lon = data['longitude']
     else:
-        return jsonify({'status': 'error',
-                        'message': 'Longitude is a mandatory argument.',
-                        'errors': None,
-                        'data': None,
-                }), 400 
+        raise ServiceError('Longitude is a mandatory argument.', 400)
 
     err_msg = check_arguments(zoom, quantile, lat, lon)
 
     if len(err_msg) > 0:
-        return jsonify({'status': 'error',
-                        'message': 'Errors encountered in argument values.',
-                        'errors': err_msg,
-                        'data': None,
-                        }), 400
- 
-    # Loading Model
-    try:
-        model = torch.load(model_path, map_location=torch.device(device))
-    except Exception:
-        return jsonify({'status': 'error',
-                        'message': 'Error when loading the service.',
-                        'errors': None,
-                        'data': None,
-                        }), 500
+        raise ServiceError('Errors encountered in argument values.', 400, err_msg)
+
+    return zoom, quantile, lat, lon
+
+def parse_area_arguments(data, max_tiles=scan_max_tiles):
+    ''' Returns the validated (zoom, quantile, bbox, polygons) of an area request.'''
+    zoom = data.get('zoom', default_zoom)
+    quantile = data.get('quantile', default_pixel_quantile)
 
-    # Image downloading
-    location = (lat, lon)
+    polygons = None
+    if 'geometry' in data:
+        try:
+            polygons = geometry_polygons(data['geometry'])
+            bbox = tuple(map(float, polygons_bbox(polygons)))
+        except (AttributeError, KeyError, TypeError, ValueError, IndexError):
+            raise ServiceError('Invalid GeoJSON geometry.', 400)
+    elif 'bbox' in data:
+        bbox = data['bbox']
+    else:
+        raise ServiceError('A bbox or a geometry is mandatory.', 400)
+
+    err_msg = check_area_arguments(zoom, quantile, bbox)
+    if len(err_msg) > 0:
+        raise ServiceError('Errors encountered in argument values.', 400, err_msg)
+
+    rows, cols = grid_shape(bbox, zoom, tile_size)
+    if rows * cols > max_tiles:
+        raise ServiceError(f'The area needs {rows * cols} tiles, at most '
+                           f'{max_tiles} are allowed.', 400)
+
+    return zoom, quantile, tuple(bbox), polygons
+
+def stage_timer():
+    ''' Stage timer of the current request (metrics only out of a request).'''
+    if has_request_context() and 'timer' in g:
+        return g.timer
+    return StageTimer(metrics)
+
+def parse_cascade_arguments(data, zoom):
+    ''' Returns the validated (start_zoom, threshold) of a cascade scan, or None.'''
+    cascade = data.get('cascade', False)
+    if not isinstance(cascade, bool):
+        raise ServiceError('Errors encountered in argument values.', 400,
+                           {'cascade': f'Invalid cascade value ({cascade}).'})
+    if not cascade:
+        return None
+
+    start_zoom = data.get('cascade_start_zoom', cascade_start_zoom)
+    threshold = data.get('cascade_threshold', cascade_threshold)
+    err_msg = check_cascade_arguments(start_zoom, zoom, threshold)
+    if len(err_msg) > 0:
+        raise ServiceError('Errors encountered in argument values.', 400, err_msg)
+    return start_zoom, threshold
+
+def rejection(e):
+    ''' ServiceError of a request not admitted in a stage.'''
+    if e.reason == 'deadline':
+        return ServiceError('The request deadline passed before it was processed.', 504,
+                            {'stage': e.stage, 'reason': e.reason})
+    if has_request_context():
+        g.retry_after = e.retry_after
+    return ServiceError('The service is overloaded, retry later.', admission_reject_status,
+                        {'stage': e.stage, 'reason': e.reason, 'retry_after': e.retry_after})
+
+@contextlib.contextmanager
+def admitted(limiter, deadline=None, wait=False, amount=1):
+    '''
+    Holds `amount` units of an admission stage (nothing if it's disabled),
+    raises ServiceError if not admitted.
+    '''
+    with contextlib.ExitStack() as stack:
+        if limiter is not None:
+            try:
+                stack.enter_context(limiter.acquire(amount, deadline, wait))
+            except Rejected as e:
+                raise rejection(e) from None
+        yield
+
+def admission(limiter, deadline=None, wait=False):
+    ''' Holds a unit of an admission stage (nothing if it's disabled), raises Rejected.'''
+    if limiter is None:
+        return contextlib.nullcontext()
+    return limiter.acquire(deadline=deadline, wait=wait)
+
+def current_model():
+    # A snapshot: a concurrent swap does not affect the running query.
+    version, model = registry.current()
+    if model is None:
+        raise ServiceError('The model is not ready yet.', 503)
+    return version, model
+
+def download_image(lat, lon, zoom):
     try:
-        downloader = ImageDownloader(location=location,
+        downloader = ImageDownloader(location=(lat, lon),
                                      zoom=zoom,
-                                     secret_key=secret_key)
-        image = downloader.request()
-    except Exception:
-        return jsonify({'status': 'error',
-                        'message': 'Errors when downloading the image from satellite service.',
-                        'errors': None,
-                        'data': None,
-                        }), 500
+                                     size=tile_size,
+                                     secret_key=secret_key,
+                                     cache=tile_cache,
+                                     provider=tile_source,
+                                     fetcher=tile_fetcher)
+        with stage_timer().stage('download'):
+            return downloader.request()
+    except Exception as e:
+        # Only the error type and upstream status: messages may contain the URL (and key).
+        status_code = getattr(e, 'status_code', None)
+        metrics.inc('upstream_errors_total', status=status_code or type(e).__name__)
+        raise ServiceError('Errors when downloading the image from satellite service.',
+                           errors={'stage': 'download',
+                                   'error': type(e).__name__,
+                                   'upstream_status': status_code})
 
-    # Query
+def query_image(model, version, image, quantile, with_cam=True, deadline=None):
+    # No quantile: the explainability map is not computed.
+    quantile = quantile if with_cam else None
+    if deadline is not None and time.monotonic() > deadline:
+        raise Rejected('inference', 'deadline')
+    timer = stage_timer()
     try:
-        query = ModelQuery(model=model,
-                       quantile=quantile,
-                       device=device,
-                       transform=transform)
+        key = None
+        if result_cache is not None:
+            key = ResultCache.image_key(image)
+            cached = result_cache.get(key, version)
+            if cached is not None:
+                query = ModelQuery(model=model, device=device, transform=transform)
+                with timer.stage('cam'):
+                    pred, score, cam = query.query_from_raw(*cached, image.shape[:2], quantile)
+                metrics.inc('predictions_total', result='positive' if pred else 'negative')
+                return pred, score, cam, cached[1]
 
-        pred, score, cam = query.make_query(image.transpose(2,0,1))
+        start = time.perf_counter()
+        job = scheduler.submit((model, image.transpose(2,0,1), quantile), deadline)
+        (pred, score, cam, raw_cam), timings = job.result()
+        # Stages of the batch the image was run in, and the time waiting for it.
+        for name, seconds in timings.items():
+            timer.add(name, seconds)
+        timer.add('batch_wait', time.perf_counter() - start - sum(timings.values()))
+
+        if result_cache is not None:
+            result_cache.put(key, version, score, raw_cam)
+        metrics.inc('predictions_total', result='positive' if pred else 'negative')
+        return pred, score, cam, raw_cam
+    except TimeoutError:
+        # Expired while waiting for a batch.
+        raise Rejected('inference', 'deadline')
     except Exception as e:
-        return jsonify({'status': 'error',
-                        'message': 'Error during query process.',
-                        'errors': None,
-                        'data': None,
-                        }), 500
+        raise ServiceError('Error during query process.',
+                           errors={'stage': 'query', 'error': type(e).__name__})
 
-    # Process the response
-    final_image = None
-    if cam is not None:
-        final_image = overlay_image_mask(image, cam, 0.5, 'jet')
+def predict_location(model, version, lat, lon, zoom, quantile, with_cam=True,
+                     deadline=None, wait=False):
+    '''
+    Downloads and queries the tile of a location, returns (image, pred, score,
+    cam, raw_cam); `cam` is only computed `with_cam`.
+
+    Each stage admits a bounded number of requests: beyond its queue a call
+    is rejected (ServiceError, 503 or 429) unless it can `wait`, and it is
+    dropped (504) once its `deadline` (time.monotonic()) passed.
+
+    Concurrent calls for the same tile (location rounded to
+    `settings.coalesce_precision` decimals, zoom and model version) and
+    explainability options (quantile, or none) share a single download and
+    inference, so a caller waiting for another one never runs the model
+    itself. It keeps its own deadline, and goes through admission itself if
+    the other one was rejected. Predictions are recorded in the detections
+    store.
+    '''
+    ran = []
+    def run():
+        ran.append(True)
+        with admission(download_limiter, deadline, wait):
+            image = download_image(lat, lon, zoom)
+        with admission(inference_limiter, deadline, wait):
+            result = query_image(model, version, image, quantile, with_cam, deadline)
+        if detection_store is not None:
+            pred, score, _, raw_cam = result
+            detection_store.add(lat, lon, zoom, pred, score, version,
+                                raw_cam if pred and detections_store_cam else None)
+        return (image,) + result
+
+    # Rejections become errors here, in the caller rejected (its Retry-After).
+    try:
+        if coalescer is None:
+            return run()
 
-    if final_image is not None:
-        # Convert to bytes and encode it.
-        final_image = numpy_to_bytes(final_image)
-        final_image = base64.b64encode(final_image).decode('utf-8')
+        start = time.perf_counter()
+        # Other options run on their own (with the result cache, only the map
+        # is recomputed), through admission like any run.
+        key = (round(lat, coalesce_precision), round(lon, coalesce_precision), zoom, version,
+               quantile if with_cam else None)
+        timeout = max(deadline - time.monotonic(), 0.) if deadline is not None else None
+        try:
+            result, shared = coalescer.do(key, run, timeout)
+        except TimeoutError:
+            # This caller's deadline passed while waiting for the shared run.
+            raise Rejected('coalesced', 'deadline')
+        except Rejected:
+            if ran:
+                raise
+            # The shared run wasn't admitted: its rejection isn't this caller's.
+            return run()
+
+        if shared:
+            stage_timer().add('coalesced', time.perf_counter() - start)
+        return result
+    except Rejected as e:
+        raise rejection(e) from None
+
+def parse_output_arguments(data, formats=response_formats):
+    ''' Returns the validated (format, include_input_image) of a request.'''
+    fmt = data.get('format', default_response_format)
+    include_input = data.get('include_input_image', True)
+    if include_input in ('true', 'false'):
+        include_input = include_input == 'true'
+
+    err_msg = check_output_arguments(fmt, include_input, formats)
+    if len(err_msg) > 0:
+        raise ServiceError('Errors encountered in argument values.', 400, err_msg)
+    return fmt, include_input
+
+def parse_encoding_arguments(data):
+    ''' Returns the image encoder of a request.'''
+    fmt = data.get('image_format', image_format)
+    quality = data.get('image_quality', image_quality)
+    compress_level = data.get('png_compress_level', png_compress_level)
+
+    err_msg = check_encoding_arguments(fmt, quality, compress_level,
+                                       list(ImageEncoder.formats))
+    if len(err_msg) > 0:
+        raise ServiceError('Errors encountered in argument values.', 400, err_msg)
+    return ImageEncoder(fmt, quality=quality, compress_level=compress_level)
+
+def parse_cam_arguments(data, fmt):
+    ''' Returns the validated explainability outputs of a request.'''
+    cam_outputs = data.get('cam_outputs', default_cam_outputs)
+    if isinstance(cam_outputs, str):
+        # Form data: comma separated.
+        cam_outputs = [t for t in cam_outputs.split(',') if t]
+
+    err_msg = check_cam_arguments(cam_outputs, fmt, cam_output_types)
+    if len(err_msg) > 0:
+        raise ServiceError('Errors encountered in argument values.', 400, err_msg)
+    return cam_outputs
 
-    # Convert original image:
-    image = numpy_to_bytes(image)
-    image = base64.b64encode(image).decode('utf-8')
+def predict_response(stored, pred, score, cam, image, location, zoom, quantile, version,
+                     fmt, include_input, encoder, raw_cam, cam_outputs):
+    ''' Serialized /predict response (`stored`: the stored prediction used, if any).'''
+    response = build_response(pred, score, cam, image, location,
+                              zoom, quantile, version, fmt, include_input, encoder,
+                              raw_cam, cam_outputs)
+    if stored is not None:
+        response['data']['stored_at'] = stored['created']
+    with g.timer.stage('serialize'):
+        if fmt == 'image':
+            return image_response(response, encoder), 200
+        if fmt == 'multipart':
+            return multipart_response(response, encoder), 200
+        return jsonify(encode_images(response)), 200
+
+def stored_prediction(data, lat, lon, zoom, version, cam_outputs):
+    '''
+    A stored prediction of the tile younger than the request `max_age`
+    (seconds), usable without running the model, or None.
+    '''
+    max_age = data.get('max_age', detections_max_age)
+    if isinstance(max_age, str):
+        # Form-encoded requests send it as text.
+        try:
+            max_age = float(max_age)
+        except ValueError:
+            pass
+    if not is_valid_max_age(max_age):
+        raise ServiceError('Errors encountered in argument values.', 400,
+                           {'max_age': f'Invalid max_age value ({max_age}).'})
+    if detection_store is None or not max_age:
+        return None
+
+    stored = detection_store.latest(lat, lon, zoom, version, max_age,
+                                    with_cam=bool(cam_outputs))
+    if stored is None or (cam_outputs and stored['prediction'] and stored['cam'] is None):
+        return None
+    metrics.inc('stored_predictions_total')
+    return stored
+
+def cam_data(pred, raw_cam, location, zoom, quantile, shape, cam_outputs):
+    '''
+    Compact explainability outputs of a query: the low resolution map
+    (`cam_grid`) and the detection regions (`detections`, GeoJSON), None for
+    negatives. They are computed from the raw map, without upsampling it.
+    '''
+    data = {}
+    if not cam_outputs:
+        return data
+    with stage_timer().stage('cam_outputs'):
+        grid = None
+        if pred:
+            grid = ModelQuery(quantile=quantile).compute_grid(raw_cam)
+        if 'grid' in cam_outputs:
+            data['cam_grid'] = None if grid is None else {
+                'shape': list(grid.shape),
+                'values': np.round(grid.astype(np.float64), 4).tolist()}
+        if 'polygons' in cam_outputs:
+            data['detections'] = None if grid is None else grid_polygons(
+                grid, location, zoom, shape)
+    return data
+
+def build_response(pred, score, cam, image, location, zoom, quantile, version,
+                   fmt='json', include_input=True, encoder=None,
+                   raw_cam=None, cam_outputs=()):
+    '''
+    Response of a query. Images are raw encoded bytes (or None): they are only
+    rendered when the format needs them.
+    '''
+    encoder = encoder or ImageEncoder(image_format, quality=image_quality,
+                                      compress_level=png_compress_level)
+    final_image = None
+    input_image = None
+    encoding = {}
+    timer = stage_timer()
+    if fmt != 'scores':
+        if cam is not None:
+            with timer.stage('overlay'):
+                final_image = overlay_image_mask(image, cam, 0.5, 'jet')
+            with timer.stage('encode'):
+                final_image, encoding['output_image'] = encoder.encode(final_image)
+
+        # The image format returns a single image: the input one for negatives.
+        if fmt == 'image':
+            include_input = final_image is None
+        if include_input:
+            with timer.stage('encode'):
+                input_image, encoding['input_image'] = encoder.encode(image)
 
     if pred:
         msg = positive_message
     else:
         msg = negative_message
 
-    response = {'status': 'success',
-                'message': msg,
-                'data': {'prediction': pred,
-                         'score': score,
-                         'output_image': final_image,
-                         'input_image': image,
-                         'location': location,
-                         'zoom': zoom,
-                         'quantile': quantile
-                        },
-                'errors': None,
-                }
-    return jsonify(response), 200
+    return {'status': 'success',
+            'message': msg,
+            'data': {'prediction': pred,
+                     'score': score,
+                     'output_image': final_image,
+                     'input_image': input_image,
+                     'location': location,
+                     'zoom': zoom,
+                     'quantile': quantile,
+                     'model_version': version,
+                     'encoding': encoding,
+                     **cam_data(pred, raw_cam, location, zoom, quantile,
+                                image.shape[:2] if image is not None else (tile_size, tile_size),
+                                cam_outputs)
+                    },
+            'errors': None,
+            }
+
+def encode_images(response):
+    ''' Base64 encoding of the images of a response, for JSON.'''
+    data = response['data']
+    if data is not None:
+        for k in ['output_image', 'input_image']:
+            if data.get(k) is not None:
+                data[k] = base64.b64encode(data[k]).decode('utf-8')
+    return response
+
+def image_response(response, encoder):
+    '''
+    Binary response: the output image (the input one for negatives) as body,
+    and the rest of the data as headers.
+    '''
+    data = response['data']
+    body = data['output_image'] if data['output_image'] is not None else data['input_image']
+    headers = {'X-Message': response['message'],
+               'X-Prediction': json.dumps(data['prediction']),
+               'X-Score': repr(data['score']),
+               'X-Location': ','.join(map(str, data['location'])),
+               'X-Zoom': str(data['zoom']),
+               'X-Quantile': str(data['quantile']),
+               'X-Model-Version': str(data['model_version']),
+               'X-Encoding': json.dumps(data['encoding'])}
+    return Response(body, mimetype=encoder.mimetype, headers=headers)
+
+def multipart_response(response, encoder):
+    '''
+    multipart/mixed response: the JSON response without images, followed by
+    an image part per image.
+    '''
+    boundary = uuid.uuid4().hex
+    data = dict(response['data'])
+    images = [(k, data.pop(k)) for k in ['output_image', 'input_image']]
+    metadata = json.dumps(dict(response, data=data)).encode('utf-8')
+
+    parts = [(b'Content-Type: application/json\r\n', metadata)]
+    for name, content in images:
+        if content is not None:
+            header = (f'Content-Type: {encoder.mimetype}\r\n'
+                      f'Content-Disposition: attachment; name="{name}"\r\n')
+            parts.append((header.encode('utf-8'), content))
+
+    delimiter = b'--' + boundary.encode('utf-8')
+    body = b''.join(delimiter + b'\r\n' + header + b'\r\n' + content + b'\r\n'
+                    for header, content in parts)
+    body += delimiter + b'--\r\n'
+    return Response(body, mimetype=f'multipart/mixed; boundary={boundary}')
+
+def process_job_tile(params, tile):
+    ''' Scores of a tile of an asynchronous job (the model is taken per tile).'''
+    lat, lon = tile['location']
+    zoom = tile.get('zoom', params.get('zoom'))
+    quantile = tile.get('quantile', params.get('quantile'))
+    version, model = current_model()
+    # Background work waits for its turn instead of being rejected.
+    with admitted(memory_limiter, wait=True, amount=tile_bytes):
+        _, pred, score, _, _ = predict_location(model, version, lat, lon, zoom, quantile,
+                                                with_cam=False, wait=True)
+    return {'prediction': pred, 'score': score, 'model_version': version}
+
+def parse_job_arguments(data):
+    ''' Returns the (params, tiles) of a job request: a list of locations or an area.'''
+    if not isinstance(data, dict):
+        raise ServiceError('A JSON object is expected.', 400)
+
+    if 'locations' in data:
+        locations = data['locations']
+        if not isinstance(locations, list) or len(locations) == 0:
+            raise ServiceError('A non-empty list of locations is mandatory.', 400)
+        if len(locations) > jobs_max_tiles:
+            raise ServiceError(f'At most {jobs_max_tiles} locations per job.', 400)
+
+        tiles = []
+        errors = {}
+        for i, item in enumerate(locations):
+            try:
+                if not isinstance(item, dict):
+                    raise ServiceError('Each location must be an object.', 400)
+                zoom, quantile, lat, lon = parse_arguments(item)
+                tiles.append({'location': (lat, lon), 'zoom': zoom, 'quantile': quantile})
+            except ServiceError as e:
+                errors[i] = e.errors or e.message
+        if errors:
+            raise ServiceError('Errors encountered in argument values.', 400, errors)
+        return {'type': 'locations'}, tiles
+
+    zoom, quantile, bbox, polygons = parse_area_arguments(data, jobs_max_tiles)
+    params = {'type': 'area', 'bbox': bbox, 'zoom': zoom, 'quantile': quantile}
+    return params, tile_grid(bbox, zoom, tile_size, polygons)
+
+# Durable queue of asynchronous jobs, consumed by worker threads of every
+# serving process (started by gunicorn's post_fork, or below).
+job_store = None
+job_runner = None
+if jobs_db:
+    job_store = JobStore(jobs_db, lease=jobs_lease)
+    job_runner = JobRunner(job_store, process_job_tile,
+                           workers=jobs_workers,
+                           max_workers=download_workers,
+                           chunk_size=jobs_chunk_size,
+                           ready=lambda: registry.ready)
+
+### Methods
+@app.before_request
+def start_timer():
+    g.timer = StageTimer(metrics)
+    # Past the client's timeout a request isn't worth running.
+    timeout = request.headers.get('X-Request-Timeout', type=float) or admission_default_timeout
+    g.deadline = time.monotonic() + timeout if timeout and timeout > 0 else None
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'other'
+    timer = g.get('timer')
+    if timer is not None:
+        metrics.observe('request_duration_seconds', timer.elapsed(), endpoint=endpoint)
+        if server_timing_header:
+            response.headers['Server-Timing'] = timer.server_timing()
+    metrics.inc('requests_total', endpoint=endpoint, code=response.status_code)
+    if response.status_code in (429, 503) and g.get('retry_after'):
+        response.headers['Retry-After'] = str(g.retry_after)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    
+    if request.is_json:
+        data = request.json
+    else:
+        data = request.form
+
+    try:
+        with g.timer.stage('validate'):
+            zoom, quantile, lat, lon = parse_arguments(data)
+            fmt, include_input = parse_output_arguments(data)
+            encoder = parse_encoding_arguments(data)
+            cam_outputs = parse_cam_arguments(data, fmt)
+        version, model = current_model()
+
+        # Without images, a recent enough prediction of the tile can be reused.
+        stored = None
+        if fmt == 'scores':
+            stored = stored_prediction(data, lat, lon, zoom, version, cam_outputs)
+        if stored is not None:
+            return predict_response(stored, stored['prediction'], stored['score'], None, None,
+                                    (lat, lon), zoom, quantile, version, fmt, include_input,
+                                    encoder, stored.get('cam'), cam_outputs)
+
+        # The decoded tile is held until the response is serialized.
+        with admitted(memory_limiter, g.deadline, amount=tile_bytes):
+            image, pred, score, cam, raw_cam = predict_location(model, version, lat, lon, zoom,
+                                                                quantile, fmt != 'scores',
+                                                                g.deadline)
+            return predict_response(None, pred, score, cam, image, (lat, lon), zoom,
+                                    quantile, version, fmt, include_input, encoder,
+                                    raw_cam, cam_outputs)
+    except ServiceError as e:
+        return jsonify(e.to_dict()), e.code
+
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    data = request.json if request.is_json else None
+    locations = data.get('locations') if isinstance(data, dict) else None
+
+    if not isinstance(locations, list) or len(locations) == 0:
+        return jsonify(ServiceError('A non-empty list of locations is mandatory.',
+                                    400).to_dict()), 400
+    if len(locations) > batch_max_locations:
+        return jsonify(ServiceError(f'At most {batch_max_locations} locations per request.',
+                                    400).to_dict()), 400
+
+    try:
+        # Binary formats can't hold several responses.
+        fmt, include_input = parse_output_arguments(data, ['json', 'scores'])
+        encoder = parse_encoding_arguments(data)
+        cam_outputs = parse_cam_arguments(data, fmt)
+        version, model = current_model()
+    except ServiceError as e:
+        return jsonify(e.to_dict()), e.code
+    deadline = g.deadline
+
+    def process(item):
+        # Errors are reported per location, they don't fail the batch.
+        try:
+            if not isinstance(item, dict):
+                raise ServiceError('Each location must be an object.', 400)
+            zoom, quantile, lat, lon = parse_arguments(item)
+            with admitted(memory_limiter, deadline, amount=tile_bytes):
+                # Downloads run concurrently so the queries end up batched together.
+                image, pred, score, cam, raw_cam = predict_location(model, version, lat, lon,
+                                                                    zoom, quantile,
+                                                                    fmt != 'scores', deadline)
+                response = build_response(pred, score, cam, image, (lat, lon),
+                                          zoom, quantile, version, fmt, include_input,
+                                          encoder, raw_cam, cam_outputs)
+                return encode_images(response)
+        except ServiceError as e:
+            return e.to_dict()
+
+    with ThreadPoolExecutor(max_workers=download_workers) as pool:
+        results = list(pool.map(process, locations))
+
+    n_ok = sum(result['status'] == 'success' for result in results)
+    return jsonify({'status': 'success',
+                    'message': f'{n_ok} of {len(results)} locations processed.',
+                    'errors': None,
+                    'data': {'results': results},
+                    }), 200
+
+@app.route('/scan', methods=['POST'])
+def scan():
+    data = request.json if request.is_json else None
+    try:
+        if not isinstance(data, dict):
+            raise ServiceError('A JSON object is expected.', 400)
+        zoom, quantile, bbox, polygons = parse_area_arguments(data)
+        cascade = parse_cascade_arguments(data, zoom)
+        cam_outputs = parse_cam_arguments(data, 'scores')
+        version, model = current_model()
+    except ServiceError as e:
+        return jsonify(e.to_dict()), e.code
+
+    def process(tile):
+        lat, lon = tile['location']
+        tile_zoom = tile.get('zoom', zoom)
+        # A streamed scan waits for its turn (no deadline) instead of failing tiles.
+        with admitted(memory_limiter, wait=True, amount=tile_bytes):
+            image, pred, score, _, raw_cam = predict_location(model, version, lat, lon,
+                                                              tile_zoom, quantile,
+                                                              with_cam=False, wait=True)
+            return pred, score, cam_data(pred, raw_cam, (lat, lon), tile_zoom, quantile,
+                                         image.shape[:2], cam_outputs)
+
+    def generate():
+        rows, cols = grid_shape(bbox, zoom, tile_size)
+        header = {'type': 'scan',
+                  'bbox': bbox,
+                  'zoom': zoom,
+                  'quantile': quantile,
+                  'rows': rows,
+                  'cols': cols,
+                  'model_version': version}
+
+        if cascade is None:
+            grid = tile_grid(bbox, zoom, tile_size, polygons)
+            results = ((tile, result, error, True)
+                       for tile, result, error in iter_scan(grid, process, download_workers))
+        else:
+            # Screening at the coarse zooms: a tile is refined if its score
+            # reaches the threshold (or it failed).
+            start_zoom, threshold = cascade
+            grids = [TileGrid(bbox, start_zoom, tile_size, polygons)]
+            while grids[-1].zoom < zoom:
+                grids.append(grids[-1].finer())
+            header['cascade'] = {'start_zoom': start_zoom, 'threshold': threshold}
+            results = iter_cascade(grids, process, lambda result: result[1] >= threshold,
+                                   download_workers)
+        yield json.dumps(header) + '\n'
+
+        tiles = positives = errors = 0
+        fetched = collections.Counter()
+        for tile, result, error, final in results:
+            fetched[tile.get('zoom', zoom)] += 1
+            if error is None:
+                pred, score, extra = result
+                tile.update({'status': 'success', 'prediction': pred, 'score': score})
+                if final:
+                    tile.update(extra)
+                if not final:
+                    tile['refined'] = score >= threshold
+            else:
+                message = error.message if isinstance(error, ServiceError) else str(error)
+                tile.update({'status': 'error', 'message': message})
+                if not final:
+                    tile['refined'] = True
+            if final:
+                tiles += 1
+                positives += error is None and pred
+                errors += error is not None
+            yield json.dumps(dict(type='tile' if final else 'screen', **tile)) + '\n'
+
+        summary = {'type': 'summary',
+                   'tiles': tiles,
+                   'positives': positives,
+                   'errors': errors}
+        if cascade is not None:
+            # Against a flat scan of the area at the requested zoom.
+            flat = len(grids[-1])
+            summary.update({'fetched': {str(z): n for z, n in sorted(fetched.items())},
+                            'inferences': sum(fetched.values()),
+                            'flat_tiles': flat,
+                            'saved': flat - sum(fetched.values())})
+        yield json.dumps(summary) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.json if request.is_json else None
+    try:
+        if job_store is None:
+            raise ServiceError('Jobs are disabled.', 404)
+        params, tiles = parse_job_arguments(data)
+    except ServiceError as e:
+        return jsonify(e.to_dict()), e.code
+
+    job_id = job_store.create(params, tiles)
+    job_runner.start()
+    job_runner.notify()
+    return jsonify({'status': 'success',
+                    'message': 'Job queued.',
+                    'errors': None,
+                    'data': job_store.get(job_id),
+                    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        if job_store is None:
+            raise ServiceError('Jobs are disabled.', 404)
+        job = job_store.get(job_id)
+        if job is None:
+            raise ServiceError(f'Unknown job ({job_id}).', 404)
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', jobs_page_size, type=int)
+        if offset < 0 or not 0 < limit <= jobs_page_size:
+            raise ServiceError(f'Invalid page (offset >= 0, 0 < limit <= {jobs_page_size}).', 400)
+    except ServiceError as e:
+        return jsonify(e.to_dict()), e.code
+
+    job['results'] = job_store.results(job_id, offset, limit)
+    job['offset'] = offset
+    job['next_offset'] = offset + limit if offset + limit < job['total'] else None
+    return jsonify({'status': 'success',
+                    'message': f'Job {job["status"]}.',
+                    'errors': None,
+                    'data': job,
+                    }), 200
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    status = job_store.cancel(job_id) if job_store is not None else None
+    if status is None:
+        return jsonify(ServiceError(f'Unknown job ({job_id}).', 404).to_dict()), 404
+    return jsonify({'status': 'success',
+                    'message': f'Job {status}.',
+                    'errors': None,
+                    'data': job_store.get(job_id),
+                    }), 200
+
+def parse_detections_arguments(args):
+    ''' Returns the validated store query (keyword arguments) and cam outputs of /detections.'''
+    try:
+        center = radius = bbox = None
+        if 'bbox' in args:
+            bbox = tuple(float(v) for v in args['bbox'].split(','))
+        elif 'latitude' in args or 'longitude' in args:
+            center = (float(args['latitude']), float(args['longitude']))
+            radius = float(args.get('radius', 1000.))
+        else:
+            raise ServiceError('A bbox or a location (latitude, longitude, radius) '
+                               'is mandatory.', 400)
+        query = {'bbox': bbox, 'center': center, 'radius': radius,
+                 'since': args.get('since', type=float),
+                 'until': args.get('until', type=float),
+                 'min_score': args.get('min_score', type=float),
+                 'zoom': args.get('zoom', type=int),
+                 'model_version': args.get('model_version'),
+                 'positives': args.get('positives', 'false') == 'true',
+                 'limit': int(args.get('limit', detections_max_results))}
+    except (KeyError, ValueError):
+        raise ServiceError('Errors encountered in argument values.', 400,
+                           {'query': 'bbox, latitude, longitude, radius and limit must be numbers.'})
+
+    err_msg = check_detections_arguments(bbox, center, radius, query['limit'],
+                                         detections_max_radius, detections_max_results)
+    if len(err_msg) > 0:
+        raise ServiceError('Errors encountered in argument values.', 400, err_msg)
+
+    quantile = args.get('quantile', default_pixel_quantile, type=float)
+    cam_outputs = parse_cam_arguments({'cam_outputs': args.get('cam_outputs', '')}, 'json')
+    if cam_outputs and not is_valid_quantile(quantile):
+        raise ServiceError('Errors encountered in argument values.', 400,
+                           {'quantile': f'Invalid quantile value ({quantile}).'})
+    return query, cam_outputs, quantile
+
+@app.route('/detections', methods=['GET'])
+def detections():
+    try:
+        if detection_store is None:
+            raise ServiceError('The detections store is disabled.', 404)
+        query, cam_outputs, quantile = parse_detections_arguments(request.args)
+    except ServiceError as e:
+        return jsonify(e.to_dict()), e.code
+
+    with g.timer.stage('query'):
+        results = detection_store.query(with_cam=bool(cam_outputs), **query)
+    for detection in results:
+        raw_cam = detection.pop('cam', None)
+        if cam_outputs:
+            detection.update(cam_data(detection['prediction'] and raw_cam is not None,
+                                      raw_cam, (detection['latitude'], detection['longitude']),
+                                      detection['zoom'], quantile, (tile_size, tile_size),
+                                      cam_outputs))
+
+    if request.args.get('format') == 'geojson':
+        return jsonify({'type': 'FeatureCollection',
+                        'features': [{'type': 'Feature',
+                                      'geometry': {'type': 'Point',
+                                                   'coordinates': [d['longitude'], d['latitude']]},
+                                      'properties': d} for d in results]}), 200
+    return jsonify({'status': 'success',
+                    'message': f'{len(results)} stored predictions.',
+                    'errors': None,
+                    'data': {'detections': results},
+                    }), 200
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = registry.status()
+    if status['ready']:
+        return jsonify({'status': 'success',
+                        'message': 'Model ready.',
+                        'errors': None,
+                        'data': status,
+                        }), 200
+    return jsonify({'status': 'error',
+                    'message': 'Model not ready.',
+                    'errors': None,
+                    'data': status,
+                    }), 503
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({'status': 'success',
+                    'message': 'Service statistics.',
+                    'errors': None,
+                    'data': {'scheduler': scheduler.stats(),
+                             'tile_cache': tile_cache.stats() if tile_cache else None,
+                             'result_cache': result_cache.stats() if result_cache else None,
+                             'coalescing': coalescer.stats() if coalescer else None,
+                             'jobs': job_store.stats() if job_store else None,
+                             'detections': detection_store.stats() if detection_store else None,
+                             'admission': {l.name: l.stats() for l in limiters}},
+                    }), 200
+
+@app.route('/model/<version>', methods=['POST'])
+def swap_model(version):
+    if not model_swap_token:
+        return jsonify(ServiceError('Model swaps are disabled.', 403).to_dict()), 403
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode('utf-8'),
+                               f'Bearer {model_swap_token}'.encode('utf-8')):
+        return jsonify(ServiceError('Invalid or missing token.', 401).to_dict()), 401
+
+    if version not in model_paths:
+        return jsonify({'status': 'error',
+                        'message': f'Unknown model version ({version}).',
+                        'errors': None,
+                        'data': None,
+                        }), 404
+    try:
+        registry.load(version, model_paths[version])
+    except Exception:
+        return jsonify({'status': 'error',
+                        'message': 'Error when loading the model.',
+                        'errors': None,
+                        'data': dict(registry.status(), worker=os.getpid()),
+                        }), 500
+
+    # Only this worker swapped: report which one it is.
+    return jsonify({'status': 'success',
+                    'message': f'Model {version} loaded in worker {os.getpid()}.',
+                    'errors': None,
+                    'data': dict(registry.status(), worker=os.getpid()),
+                    }), 200
 
 if __name__ == '__main__':
+    if job_runner is not None:
+        job_runner.start()
     app.run(host='0.0.0.0', port=port_number)
\ No newline at end of file
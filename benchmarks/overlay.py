@@ -0,0 +1,64 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+# Overlay renderer: lookup-table implementation vs. the previous matplotlib
+# one (time per call and pixel differences).
+#
+#   PYTHONPATH=. python benchmarks/overlay.py [--size 512] [--repeat 50]
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from classification_model.image_utils import overlay_image_mask
+
+def overlay_image_mask_matplotlib(rgb_image, colormap_image, alpha=0.5, colormap='jet'):
+    # Previous implementation, kept as reference.
+    from matplotlib.colors import Normalize
+    from matplotlib.cm import ScalarMappable
+
+    norm = Normalize(vmin=0, vmax=1)
+    mapper = ScalarMappable(norm=norm, cmap=colormap)
+    colormap_image = mapper.to_rgba(colormap_image, bytes=True)
+    blended_image = alpha * colormap_image[:,:,:3] + (1-alpha) * rgb_image
+    return np.clip(blended_image, 0, 255).astype(np.uint8)
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--colormaps', type=str, default='jet,viridis')
+    parser.add_argument('--alphas', type=str, default='0.5,0.3')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)
+    # Like the model maps: mostly 0, values in [0,1], exact 0 and 1 included.
+    cam = rng.random((args.size, args.size), dtype=np.float32)
+    cam[cam < 0.9] = 0
+    cam[0, 0] = 1
+
+    results = []
+    for colormap in args.colormaps.split(','):
+        for alpha in map(float, args.alphas.split(',')):
+            expected = overlay_image_mask_matplotlib(image, cam, alpha, colormap)
+            output = overlay_image_mask(image, cam, alpha, colormap)
+            diff = np.abs(expected.astype(int) - output.astype(int))
+            out = np.empty_like(image)
+            results.append({'colormap': colormap,
+                            'alpha': alpha,
+                            'max_abs_diff': int(diff.max()),
+                            'different_pixels': int((diff > 0).sum()),
+                            'matplotlib_ms': timeit(lambda: overlay_image_mask_matplotlib(image, cam, alpha, colormap), args.repeat),
+                            'lut_ms': timeit(lambda: overlay_image_mask(image, cam, alpha, colormap, out=out), args.repeat)})
+
+    for result in results:
+        print(json.dumps(result))
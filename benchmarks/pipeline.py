@@ -0,0 +1,233 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+# Benchmark of /predict without a Google API key nor the trained checkpoint:
+# tiles come from a local tile_server.py (synthetic, distinct per location)
+# and the model is a randomly initialised one of the same architecture.
+#
+# - Per-stage latency of a query: validate, download, decode, preprocess,
+#   forward, cam, overlay, encode, json.
+# - End-to-end throughput and latency of the /predict endpoint (app.py on a
+#   local server) at several concurrency levels.
+#
+# Results are JSON lines (stdout, and --output), starting with the commit
+# and environment, so runs can be compared across commits:
+#
+#   PYTHONPATH=. python benchmarks/pipeline.py [--tiles 32] [--concurrency 1 4 16]
+#       [--arch resnet18] [--output results.jsonl]
+
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+import torch
+import torchvision
+
+from classification_model.cam import CAMExtractor
+from classification_model.downloader import ImageDownloader, TileFetcher
+from classification_model.encoders import ImageEncoder
+from classification_model.image_utils import overlay_image_mask
+from classification_model.preprocessing import Preprocessor
+from classification_model.providers import HTTPTileProvider
+from classification_model.query import ModelQuery
+from classification_model.tile_server import make_server
+from validators import check_arguments
+
+STAGES = ['validate', 'download', 'decode', 'preprocess', 'forward',
+          'cam', 'overlay', 'encode', 'json']
+
+def synthetic_model(arch: str, path: str):
+    ''' Randomly initialised classifier (one output) saved as a checkpoint.'''
+    torch.manual_seed(0)
+    model = getattr(torchvision.models, arch)(num_classes=1)
+    torch.save(model.eval(), path)
+
+def latency_summary(seconds) -> dict:
+    ms = np.array(seconds) * 1000
+    return {'mean_ms': float(ms.mean()),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)),
+            'max_ms': float(ms.max())}
+
+def location(i: int):
+    # Distinct locations: every tile is a new download and forward pass.
+    return (-34.5 + i * 1e-3, -58.5)
+
+def stage_benchmark(model_path, tile_url, n_tiles, zoom=18, quantile=0.94, size=512):
+    ''' Latencies (seconds) of each stage of a single-tile query.'''
+    model = torch.load(model_path, weights_only=False).eval()
+    extractor = CAMExtractor.for_model(model)
+    query = ModelQuery(model=model, quantile=quantile)
+    preprocessor = Preprocessor()
+    provider = HTTPTileProvider(tile_url)
+    fetcher = TileFetcher()
+    encoder = ImageEncoder('png')
+
+    times = {stage: [] for stage in STAGES}
+    def timed(stage, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        times[stage].append(time.perf_counter() - start)
+        return result
+
+    # First tile warms up (allocations, kernel selection), not measured.
+    for i in range(-1, n_tiles):
+        lat, lon = location(i)
+        timed('validate', check_arguments, zoom, quantile, lat, lon)
+        downloader = ImageDownloader(location=(lat, lon), zoom=zoom, size=size,
+                                     provider=provider, fetcher=fetcher)
+        content = timed('download', downloader.download)
+        image = timed('decode', downloader.image_bytes_to_numpy, content)
+        input_ = timed('preprocess', preprocessor.batch, [image.transpose(2,0,1)])
+        with torch.no_grad():
+            logits, cam = timed('forward', extractor, input_)
+        maps = timed('cam', query.compute_cam, cam, image.shape[:2], [quantile])
+        overlay = timed('overlay', overlay_image_mask, image, maps[0], 0.5, 'jet')
+
+        def encode():
+            return encoder.encode(overlay)[0], encoder.encode(image)[0]
+        output_image, input_image = timed('encode', encode)
+
+        def to_json():
+            return json.dumps({'prediction': bool(logits[0, 0] > 0),
+                               'score': float(torch.sigmoid(logits[0, 0])),
+                               'output_image': base64.b64encode(output_image).decode('utf-8'),
+                               'input_image': base64.b64encode(input_image).decode('utf-8')})
+        timed('json', to_json)
+
+        if i < 0:
+            times = {stage: [] for stage in STAGES}
+    return times
+
+def start_app(model_path, tile_url):
+    '''
+    app.py served on a local port, with the synthetic model and tile server,
+    and without caches, request coalescing, admission control, detections
+    store nor jobs: every request downloads and queries its tile, and
+    nothing is written to the working directory.
+    '''
+    import settings
+    settings.model_path = model_path
+    settings.model_paths = {settings.model_version: model_path}
+    settings.inference_backend = 'eager'
+    settings.tile_provider = 'http'
+    settings.tile_provider_url = tile_url
+    settings.tile_cache_dir = ''
+    settings.result_cache_items = 0
+    settings.jobs_db = ''
+    settings.detections_db = ''
+    settings.coalesce_requests = False
+    settings.admission_control = False
+
+    import app
+    from werkzeug.serving import make_server as make_app_server
+    app.model_loader.join()
+    if not app.registry.ready:
+        raise RuntimeError(f'Model not loaded: {app.registry.status()["error"]}')
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_app_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+def e2e_benchmark(url, n_requests, concurrency, offset, fmt='json'):
+    ''' Throughput and latency of concurrent /predict requests.'''
+    local = threading.local()
+
+    def post(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        lat, lon = location(offset + i)
+        start = time.perf_counter()
+        response = session.post(f'{url}/predict', json={'latitude': lat,
+                                                        'longitude': lon,
+                                                        'format': fmt})
+        response.content
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(post, range(n_requests)))
+    elapsed = time.perf_counter() - start
+
+    return dict(requests_per_s=n_requests / elapsed,
+                errors=sum(status != 200 for _, status in results),
+                **latency_summary([seconds for seconds, _ in results]))
+
+def environment(args) -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit or None,
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads(),
+            'cpus': os.cpu_count(),
+            'arch': args.arch,
+            'tiles': args.tiles}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', type=str, default='resnet18',
+                        help='torchvision architecture of the synthetic model.')
+    parser.add_argument('--tiles', type=int, default=32,
+                        help='Tiles of the per-stage benchmark.')
+    parser.add_argument('--requests', type=int, default=64,
+                        help='Requests per concurrency level.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--format', type=str, default='json',
+                        help='Response format of the end-to-end requests.')
+    parser.add_argument('--output', type=str, default='',
+                        help='Also append the results to this file.')
+    args = parser.parse_args()
+
+    output = open(args.output, 'a') if args.output else None
+    def emit(record):
+        line = json.dumps(record)
+        print(line, flush=True)
+        if output is not None:
+            output.write(line + '\n')
+            output.flush()
+
+    tile_server = make_server(port=0)
+    threading.Thread(target=tile_server.serve_forever, daemon=True).start()
+    tile_url = f'http://127.0.0.1:{tile_server.server_port}/staticmap'
+
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.join(directory, f'{args.arch}.pt')
+        synthetic_model(args.arch, model_path)
+
+        emit(dict(benchmark='environment', **environment(args)))
+
+        times = stage_benchmark(model_path, tile_url, args.tiles)
+        for stage in STAGES:
+            emit(dict(benchmark='stage', stage=stage, **latency_summary(times[stage])))
+        total = np.sum([times[stage] for stage in STAGES], axis=0)
+        emit(dict(benchmark='stage', stage='total', **latency_summary(total)))
+
+        server, url = start_app(model_path, tile_url)
+        offset = args.tiles
+        e2e_benchmark(url, 2, 1, offset, args.format)
+        offset += 2
+        for concurrency in args.concurrency:
+            result = e2e_benchmark(url, args.requests, concurrency, offset, args.format)
+            offset += args.requests
+            emit(dict(benchmark='e2e', format=args.format, concurrency=concurrency,
+                      requests=args.requests, **result))
+        server.shutdown()
+
+    tile_server.shutdown()
+    if output is not None:
+        output.close()
@@ -0,0 +1,88 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+# Preprocessing, from downloaded bytes to model input: previous pipeline
+# (np.array -> torch.tensor -> .float() -> Normalize) vs. the fused
+# Preprocessor. Reports time, allocations and bytes allocated per tile.
+#
+#   PYTHONPATH=. python benchmarks/preprocess.py [--batch 8] [--repeat 20]
+
+import argparse
+import io
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.profiler import ProfilerActivity, profile
+
+from classification_model.downloader import ImageDownloader
+from classification_model.preprocessing import Preprocessor
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+def previous_pipeline(contents, transform):
+    images = []
+    for content in contents:
+        image = Image.open(io.BytesIO(content))
+        image = image.convert('RGB')
+        images.append(np.array(image).transpose(2,0,1))
+    input_ = torch.tensor(np.stack(images)).float()
+    return transform(input_)
+
+def fused_pipeline(contents, preprocessor, downloader):
+    images = [downloader.image_bytes_to_numpy(content).transpose(2,0,1)
+              for content in contents]
+    return preprocessor.batch(images)
+
+def measure(fn, n_tiles, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeat
+
+    # numpy/PIL allocations (tracemalloc) and torch allocations (profiler).
+    tracemalloc.start()
+    fn()
+    _, numpy_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = [e for e in prof.events() if e.cpu_memory_usage > 0]
+
+    return {'ms_per_tile': elapsed / n_tiles * 1000,
+            'python_peak_bytes_per_tile': numpy_peak / n_tiles,
+            'torch_allocations_per_tile': len(events) / n_tiles,
+            'torch_bytes_per_tile': sum(e.cpu_memory_usage for e in events) / n_tiles}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    contents = []
+    for _ in range(args.batch):
+        byte_buffer = io.BytesIO()
+        image = rng.integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)
+        Image.fromarray(image).save(byte_buffer, format='PNG')
+        contents.append(byte_buffer.getvalue())
+
+    transform = transforms.Compose([transforms.Normalize(MEAN, STD)])
+    preprocessor = Preprocessor(MEAN, STD)
+    downloader = ImageDownloader(location=(0., 0.))
+
+    expected = previous_pipeline(contents, transform)
+    output = fused_pipeline(contents, preprocessor, downloader)
+    print(json.dumps({'max_abs_diff': (expected - output).abs().max().item()}))
+
+    for name, fn in [('previous', lambda: previous_pipeline(contents, transform)),
+                     ('fused', lambda: fused_pipeline(contents, preprocessor, downloader))]:
+        print(json.dumps(dict(pipeline=name, **measure(fn, args.batch, args.repeat))))
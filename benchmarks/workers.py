@@ -0,0 +1,92 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+# Throughput of the production server (gunicorn.conf.py) with 1..N workers.
+# For each worker count a server is started, warmed up and loaded with
+# concurrent /predict requests (scores only) at distinct locations; prints
+# one JSON line per worker count (tiles/s and latency percentiles).
+#
+# Use a tile source that doesn't bound the measure, e.g. tile_server.py
+# (settings.tile_provider = 'http'), whose tiles are distinct per location:
+#
+#   PYTHONPATH=. python benchmarks/workers.py --workers 1 2 4 [--requests 400]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+def wait_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{url}/ready', timeout=1).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    return False
+
+def load(url, n_requests, concurrency, offset):
+    local = threading.local()
+
+    def post(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        # Distinct locations, so every request downloads and runs a new tile.
+        data = {'latitude': -34.5 + (offset + i) * 1e-3,
+                'longitude': -58.5,
+                'format': 'scores'}
+        start = time.perf_counter()
+        response = session.post(f'{url}/predict', json=data, timeout=300)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(post, range(n_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([r[0] for r in results]) * 1000
+    return {'tiles_per_s': n_requests / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'errors': sum(r[1] != 200 for r in results)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    url = f'http://127.0.0.1:{args.port}'
+    offset = 0
+    for n_workers in args.workers:
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app',
+                                   '--workers', str(n_workers),
+                                   '--bind', f'127.0.0.1:{args.port}'],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_ready(url, args.startup_timeout):
+                sys.exit(f'Server with {n_workers} workers not ready.')
+            # Warm-up: first requests of every worker.
+            load(url, 4 * n_workers, args.concurrency, offset)
+            offset += 4 * n_workers
+
+            result = load(url, args.requests, args.concurrency, offset)
+            offset += args.requests
+            print(json.dumps(dict(workers=n_workers, cores=len(os.sched_getaffinity(0)),
+                                  requests=args.requests,
+                                  concurrency=args.concurrency, **result)), flush=True)
+        finally:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,107 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import contextlib
+import math
+import threading
+import time
+from typing import Optional
+
+class Rejected(Exception):
+    '''
+    A request not admitted in a stage: its queue is full (`reason`
+    'overloaded') or its deadline passed while waiting ('deadline').
+    `retry_after` (seconds) is an estimate of when to try again.
+    '''
+    def __init__(self, stage: str, reason: str = 'overloaded',
+                 retry_after: Optional[int] = None):
+        super().__init__(f'{stage}: {reason}')
+        self.stage = stage
+        self.reason = reason
+        self.retry_after = retry_after
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    ''' Seconds left before a `time.monotonic()` deadline (None: no deadline).'''
+    return None if deadline is None else deadline - time.monotonic()
+
+class Limiter():
+    '''
+    Admission control of a stage: at most `capacity` units (requests, or
+    bytes of a memory budget) in use and `max_queue` callers waiting for
+    them.
+
+    A caller arriving with the queue full is rejected at once instead of
+    piling up, unless it asks to `wait` (background work); waiting never
+    goes beyond the caller's deadline.
+    '''
+    def __init__(self, name: str, capacity: int, max_queue: int = 0):
+        if capacity < 1:
+            raise ValueError('The capacity must be at least 1.')
+        self.name = name
+        self.capacity = capacity
+        self.max_queue = max_queue
+
+        self._cond = threading.Condition()
+        self._used = 0
+        self._waiting = 0
+        # Smoothed seconds a unit is held, for the Retry-After estimate.
+        self._hold = 0.
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def retry_after(self) -> int:
+        ''' Seconds until the queue ahead is likely served (at least 1).'''
+        with self._cond:
+            return self._retry_after()
+
+    def _retry_after(self) -> int:
+        backlog = (self._waiting + 1) / self.capacity
+        return max(1, math.ceil(self._hold * backlog))
+
+    @contextlib.contextmanager
+    def acquire(self, amount: int = 1, deadline: Optional[float] = None,
+                wait: bool = False):
+        '''
+        Holds `amount` units for the duration of the context. Raises
+        Rejected if the queue is full (and not `wait`) or the deadline passes.
+        '''
+        # A single request larger than the whole capacity still goes alone.
+        amount = min(amount, self.capacity)
+        with self._cond:
+            if self._used + amount > self.capacity or self._waiting:
+                if not wait and self._waiting >= self.max_queue:
+                    self.rejected += 1
+                    raise Rejected(self.name, 'overloaded', self._retry_after())
+                self._waiting += 1
+                try:
+                    while self._used + amount > self.capacity:
+                        timeout = remaining(deadline)
+                        if timeout is not None and timeout <= 0:
+                            self.expired += 1
+                            raise Rejected(self.name, 'deadline')
+                        self._cond.wait(timeout)
+                finally:
+                    self._waiting -= 1
+            self._used += amount
+            self.admitted += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - start
+            with self._cond:
+                self._used -= amount
+                self._hold = 0.9 * self._hold + 0.1 * held if self._hold else held
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {'in_use': self._used,
+                    'capacity': self.capacity,
+                    'waiting': self._waiting,
+                    'max_queue': self.max_queue,
+                    'admitted': self.admitted,
+                    'rejected': self.rejected,
+                    'expired': self.expired,
+                    'mean_hold_seconds': self._hold}
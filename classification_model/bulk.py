@@ -0,0 +1,346 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+# Offline scoring of many locations (see main.py --input).
+#
+# Tiles are downloaded by a thread pool and scored in batches by a pool of
+# processes, each loading the model once. Results are written in input
+# order to NDJSON (or Parquet) and the progress is checkpointed next to the
+# output, so an interrupted run resumes without redoing the rows already
+# written.
+
+import collections
+import csv
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import torch
+
+from classification_model.encoders import ImageEncoder
+from classification_model.image_utils import overlay_image_mask
+from classification_model.preprocessing import Preprocessor
+from classification_model.query import ModelQuery
+from classification_model.registry import ModelRegistry
+from classification_model.scan import iter_scan
+from classification_model.vectorize import grid_polygons
+from validators import check_arguments
+
+# Output columns (Parquet types); `detections` is a GeoJSON string in Parquet.
+FIELDS = [('index', 'int64'), ('id', 'string'),
+          ('latitude', 'float64'), ('longitude', 'float64'),
+          ('zoom', 'int64'), ('quantile', 'float64'),
+          ('status', 'string'), ('message', 'string'),
+          ('prediction', 'bool_'), ('score', 'float64'),
+          ('image', 'string'), ('detections', 'string')]
+
+def read_locations(path: str, start: int = 0) -> Iterator[Tuple[int, dict]]:
+    ''' (index, row) of the rows of a CSV or Parquet file, from row `start`.'''
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Parquet files need the pyarrow package.')
+
+        index = 0
+        for batch in pq.ParquetFile(path).iter_batches():
+            if index + batch.num_rows <= start:
+                index += batch.num_rows
+                continue
+            for row in batch.to_pylist():
+                if index >= start:
+                    yield index, row
+                index += 1
+    else:
+        with open(path, newline='') as f:
+            for index, row in enumerate(csv.DictReader(f)):
+                if index >= start:
+                    yield index, row
+
+def parse_location(row: dict, zoom: int, quantile: float) -> Tuple[float, float, int, float]:
+    '''
+    Validated (lat, lon, zoom, quantile) of an input row: `latitude` (or
+    `lat`) and `longitude` (or `lon`) columns, and optional `zoom` and
+    `quantile` ones. Raises ValueError.
+    '''
+    def value(names, cast, default=None):
+        for name in names:
+            if row.get(name) not in (None, ''):
+                try:
+                    return cast(row[name])
+                except (TypeError, ValueError):
+                    raise ValueError(f'Invalid {name} value ({row[name]}).')
+        if default is None:
+            raise ValueError(f'Missing {names[0]} value.')
+        return default
+
+    lat = value(['latitude', 'lat'], float)
+    lon = value(['longitude', 'lon'], float)
+    zoom = value(['zoom'], int, zoom)
+    quantile = value(['quantile'], float, quantile)
+    err_msg = check_arguments(zoom, quantile, lat, lon)
+    if len(err_msg) > 0:
+        raise ValueError(' '.join(err_msg.values()))
+    return lat, lon, zoom, quantile
+
+class NDJSONWriter():
+    ''' Results as JSON lines, truncated to the last checkpoint on resume.'''
+    def __init__(self, path: str, state: Optional[dict] = None):
+        offset = state['offset'] if state else 0
+        self.file = open(path, 'r+b' if offset else 'wb')
+        self.file.truncate(offset)
+        self.file.seek(offset)
+
+    def write(self, records: List[dict]):
+        self.file.write(b''.join(json.dumps(r).encode('utf-8') + b'\n' for r in records))
+
+    def commit(self) -> dict:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {'offset': self.file.tell()}
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter():
+    '''
+    Results as a directory of Parquet files, one per checkpoint (a Parquet
+    file can't be appended to). Parts after the last checkpoint are
+    removed on resume.
+    '''
+    def __init__(self, path: str, state: Optional[dict] = None):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Parquet output needs the pyarrow package.')
+        self.pa, self.pq = pa, pq
+        self.schema = pa.schema([(name, getattr(pa, kind)()) for name, kind in FIELDS])
+        self.path = path
+        self.parts = state['parts'] if state else 0
+        self.records = []
+
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            # Parts after the checkpoint, and any left half written by a kill.
+            match = re.fullmatch(r'part-(\d+)\.parquet(\.tmp)?', name)
+            if match and (match.group(2) or int(match.group(1)) >= self.parts):
+                os.remove(os.path.join(path, name))
+
+    def write(self, records: List[dict]):
+        for record in records:
+            record = dict(record)
+            if record.get('detections') is not None:
+                record['detections'] = json.dumps(record['detections'])
+            self.records.append(record)
+
+    def commit(self) -> dict:
+        if self.records:
+            table = self.pa.Table.from_pylist(self.records, schema=self.schema)
+            path = os.path.join(self.path, f'part-{self.parts:06d}.parquet')
+            self.pq.write_table(table, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            self.parts += 1
+            self.records = []
+        return {'parts': self.parts}
+
+    def close(self):
+        pass
+
+class Checkpoint():
+    ''' Rows done and output state of a run, saved atomically as JSON.'''
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[dict]:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, state: dict):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+# Per-process state of the inference workers.
+_worker = {}
+
+def init_worker(model_path: str, backend: str, channels_last: bool,
+                threads: int, size: int):
+    ''' Loads (and warms up) the model once per worker process.'''
+    if threads:
+        torch.set_num_threads(threads)
+    registry = ModelRegistry(device='cpu', input_size=size, backend=backend,
+                             channels_last=channels_last)
+    model = registry.load('bulk', model_path)
+    preprocessor = Preprocessor([0.485, 0.456, 0.406], [0.229, 0.224, 0.225],
+                                channels_last=channels_last)
+    _worker['query'] = ModelQuery(model=model, preprocessor=preprocessor)
+
+def infer_batch(items: list, images_dir: str = '', detections: bool = False) -> List[dict]:
+    '''
+    Scores a batch of (index, image, location, zoom, quantile) in a worker.
+    The overlay of positives is only rendered (and saved to `images_dir`)
+    if requested.
+    '''
+    query = _worker['query']
+    images = [image.transpose(2,0,1) for _, image, _, _, _ in items]
+    quantiles = [quantile if images_dir else None for _, _, _, _, quantile in items]
+    outputs = query.make_batch_query(images, quantiles, return_raw=True)
+
+    results = []
+    for (index, image, location, zoom, quantile), (pred, score, cam, raw_cam) in zip(items, outputs):
+        result = {'status': 'success', 'prediction': pred, 'score': score}
+        if images_dir and cam is not None:
+            overlay, _ = ImageEncoder('png').encode(overlay_image_mask(image, cam, 0.5, 'jet'))
+            result['image'] = os.path.join(images_dir, f'{index}.png')
+            with open(result['image'], 'wb') as f:
+                f.write(overlay)
+        if detections:
+            result['detections'] = None
+            if pred:
+                grid = query.compute_grid(raw_cam, quantile)
+                result['detections'] = grid_polygons(grid, location, zoom, image.shape[:2])
+        results.append(result)
+    return results
+
+def error_message(error: Exception) -> str:
+    # Download errors only report their type and status: messages may
+    # contain the URL (and key).
+    if isinstance(error, ValueError):
+        return str(error)
+    status_code = getattr(error, 'status_code', None)
+    return type(error).__name__ + (f' ({status_code})' if status_code else '')
+
+def run_bulk(input_path: str,
+             output_path: str,
+             make_downloader: Callable[[Tuple[float, float], int], object],
+             model_path: str,
+             backend: str = 'eager',
+             channels_last: bool = False,
+             zoom: int = 18,
+             quantile: float = 0.94,
+             workers: int = 2,
+             threads: int = 0,
+             batch_size: int = 8,
+             download_workers: int = 8,
+             checkpoint_rows: int = 1000,
+             images_dir: str = '',
+             detections: bool = False,
+             size: int = 512,
+             restart: bool = False) -> dict:
+    '''
+    Scores every location of `input_path` (CSV or Parquet) into
+    `output_path` (NDJSON, or a directory of Parquet files if it ends with
+    .parquet), resuming from `output_path`.checkpoint unless `restart`.
+
+    Returns
+    -------
+    The final checkpoint: rows done and output state.
+    '''
+    checkpoint = Checkpoint(output_path + '.checkpoint')
+    state = None if restart else checkpoint.load()
+    if state is not None and state['input'] != os.path.abspath(input_path):
+        raise ValueError(f'{checkpoint.path} belongs to another input ({state["input"]}).')
+    if state is not None and state.get('complete'):
+        return state
+    rows_done = state['rows'] if state else 0
+    if rows_done:
+        print(f'Resuming after {rows_done} rows.', file=sys.stderr)
+
+    Writer = ParquetWriter if output_path.endswith('.parquet') else NDJSONWriter
+    writer = Writer(output_path, state['writer'] if state else None)
+    if images_dir:
+        os.makedirs(images_dir, exist_ok=True)
+
+    def download(item):
+        index, row = item
+        lat, lon, row_zoom, row_quantile = parse_location(row, zoom, quantile)
+        image = make_downloader((lat, lon), row_zoom).request()
+        return lat, lon, row_zoom, row_quantile, image
+
+    def batches():
+        # Consecutive downloads (in input order) grouped for a forward pass.
+        batch = []
+        rows = read_locations(input_path, rows_done)
+        for item, result, error in iter_scan(rows, download, download_workers,
+                                             2 * batch_size * max(workers, download_workers)):
+            batch.append((item, result, error))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    progress = {'rows': rows_done, 'committed': rows_done,
+                'start': time.perf_counter(), 'start_rows': rows_done}
+
+    def commit(complete=False):
+        state = {'input': os.path.abspath(input_path),
+                 'rows': progress['rows'],
+                 'writer': writer.commit(),
+                 'complete': complete}
+        checkpoint.save(state)
+        progress['committed'] = progress['rows']
+        rate = (progress['rows'] - progress['start_rows']) / (time.perf_counter() - progress['start'])
+        print(f'{progress["rows"]} rows ({rate:.1f} rows/s)', file=sys.stderr, flush=True)
+        return state
+
+    def write(batch, future):
+        try:
+            results = iter(future.result()) if future is not None else iter(())
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory): stop, the rows are redone on resume.
+            raise
+        except Exception as e:
+            results = None
+            failure = {'status': 'error', 'message': f'{type(e).__name__}: {e}'}
+
+        records = []
+        for (index, row), downloaded, error in batch:
+            record = {'index': index}
+            if row.get('id') not in (None, ''):
+                record['id'] = str(row['id'])
+            if error is None:
+                lat, lon, row_zoom, row_quantile, _ = downloaded
+                record.update({'latitude': lat, 'longitude': lon,
+                               'zoom': row_zoom, 'quantile': row_quantile})
+                record.update(next(results) if results is not None else failure)
+            else:
+                record.update({'status': 'error', 'message': error_message(error)})
+            records.append(record)
+        writer.write(records)
+        progress['rows'] += len(batch)
+        if progress['rows'] - progress['committed'] >= checkpoint_rows:
+            commit()
+
+    # Spawned workers: the parent runs download threads, forking would copy
+    # their locks in any state.
+    context = multiprocessing.get_context('spawn')
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                               initializer=init_worker,
+                               initargs=(model_path, backend, channels_last, threads, size))
+    try:
+        pending = collections.deque()
+        for batch in batches():
+            items = [(index, result[4], result[:2], result[2], result[3])
+                     for (index, _), result, error in batch if error is None]
+            future = pool.submit(infer_batch, items, images_dir, detections) if items else None
+            pending.append((batch, future))
+            # A couple of batches per worker in flight, results in order.
+            while len(pending) > 2 * workers:
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+        return commit(complete=True)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        writer.close()
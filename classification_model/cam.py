@@ -0,0 +1,99 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import threading
+import weakref
+
+import torch
+import torch.nn as nn
+
+class CAMExtractor():
+    '''
+    Runs the classifier and returns its logits together with the raw
+    (low-resolution) class activation map computed from `layer4`.
+
+    A single forward hook is attached for the whole lifetime of the model,
+    so use `CAMExtractor.for_model(model)` to get the shared instance instead
+    of building a new one per query. The features captured by the hook are
+    stored per thread, so concurrent callers don't see each other's maps.
+    '''
+    _instances = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, model: nn.Module, layer: str = 'layer4'):
+        self._model = weakref.ref(model)
+        self._local = threading.local()
+        self._handle = getattr(model, layer).register_forward_hook(self._hook)
+
+    @classmethod
+    def for_model(cls, model: nn.Module) -> 'CAMExtractor':
+        ''' Shared extractor of `model` (created on first use).'''
+        with cls._instances_lock:
+            extractor = cls._instances.get(model)
+            if extractor is None:
+                extractor = cls(model)
+                cls._instances[model] = extractor
+            return extractor
+
+    @property
+    def model(self) -> nn.Module:
+        return self._model()
+
+    def _hook(self, module, input, output):
+        self._local.features = output.detach()
+
+    def __call__(self, input_: torch.Tensor):
+        '''
+        Forward pass.
+
+        Parameters
+        ----------
+        input_ : Tensor
+            Normalized batch of images (N, 3, H, W).
+
+        Returns
+        -------
+        logits: Tensor
+            Classifier output (N, 1).
+        cam: Tensor
+            Class activation map at `layer4` resolution (N, 1, h, w).
+        '''
+        model = self.model
+        self._local.features = None
+        with torch.no_grad():
+            logits = model(input_)
+            features = self._local.features
+            self._local.features = None
+
+            fc_weights = model.fc.weight.unsqueeze(2).unsqueeze(3)
+            cam = (fc_weights * features).sum(1, keepdim=True)
+
+        return logits, cam
+
+    def remove(self):
+        ''' Detach the hook from the model.'''
+        self._handle.remove()
+        with self._instances_lock:
+            model = self.model
+            if model is not None and self._instances.get(model) is self:
+                del self._instances[model]
+
+class CAMModel(nn.Module):
+    '''
+    ResNet classifier returning (logits, cam) from a single forward pass,
+    without hooks, so it can be exported (TorchScript, ONNX). Outputs are
+    the same as `CAMExtractor`'s.
+    '''
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor):
+        m = self.model
+        x = m.maxpool(m.relu(m.bn1(m.conv1(x))))
+        x = m.layer3(m.layer2(m.layer1(x)))
+        features = m.layer4(x)
+        logits = m.fc(torch.flatten(m.avgpool(features), 1))
+
+        fc_weights = m.fc.weight.unsqueeze(2).unsqueeze(3)
+        cam = (fc_weights * features).sum(1, keepdim=True)
+        return logits, cam
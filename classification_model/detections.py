@@ -0,0 +1,280 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import collections
+import contextlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from classification_model.tiling import latlon_to_pixel, pixel_to_latlon
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS detections (
+    id INTEGER PRIMARY KEY,
+    tile TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    zoom INTEGER NOT NULL,
+    prediction INTEGER NOT NULL,
+    score REAL NOT NULL,
+    model_version TEXT,
+    created REAL NOT NULL,
+    cam BLOB,
+    cam_shape TEXT
+);
+CREATE INDEX IF NOT EXISTS detections_tile ON detections (tile, model_version, created);
+CREATE INDEX IF NOT EXISTS detections_created ON detections (created);
+CREATE VIRTUAL TABLE IF NOT EXISTS detections_index USING rtree (
+    id, min_lon, max_lon, min_lat, max_lat
+);
+'''
+
+EARTH_RADIUS = 6371008.8
+
+def tile_key(lat: float, lon: float, zoom: int, precision: int = 6) -> str:
+    ''' Key of the tile of a location (rounded to `precision` decimals).'''
+    return f'{zoom}/{round(lat, precision)}/{round(lon, precision)}'
+
+def tile_bounds(lat: float, lon: float, zoom: int,
+                size: int = 512) -> Tuple[float, float, float, float]:
+    ''' (min_lon, min_lat, max_lon, max_lat) of the `size` tile centred at a location.'''
+    x, y = latlon_to_pixel(lat, lon, zoom)
+    max_lat, min_lon = pixel_to_latlon(x - size / 2, y - size / 2, zoom)
+    min_lat, max_lon = pixel_to_latlon(x + size / 2, y + size / 2, zoom)
+    return min_lon, min_lat, max_lon, max_lat
+
+def radius_bbox(lat: float, lon: float, radius: float) -> Tuple[float, float, float, float]:
+    ''' Bounding box (min_lon, min_lat, max_lon, max_lat) of a circle (meters).'''
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    dlon = math.degrees(radius / (EARTH_RADIUS * max(math.cos(math.radians(lat)), 1e-6)))
+    return (max(lon - dlon, -180.), max(lat - dlat, -90.),
+            min(lon + dlon, 180.), min(lat + dlat, 90.))
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    ''' Great-circle (haversine) distance in meters.'''
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi, dlambda = phi2 - phi1, math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+class DetectionStore():
+    '''
+    Past predictions in a SQLite database, indexed by the footprint of
+    their tile (an R-tree), for area queries without running the model.
+
+    `add` only queues a prediction: a background thread writes the queue in
+    a single transaction every `flush_interval` seconds (or `batch_size`
+    predictions), so the serving path doesn't wait for the disk. Several
+    processes can share the database. A batch failing with a database error
+    (e.g. locked or full) is retried on the next flush; any other error drops
+    it, so a bad prediction can't block the queue.
+    '''
+    def __init__(self, path: str,
+                       tile_size: int = 512,
+                       precision: int = 6,
+                       flush_interval: float = 1.,
+                       batch_size: int = 256):
+
+        self.path = path
+        self.tile_size = tile_size
+        self.precision = precision
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+        self._reset()
+        # Threads don't survive a fork: the writer is started again in the child.
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._queue = collections.deque()
+        self._writer = None
+        self.written = 0
+        self.dropped = 0
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A connection per operation: safe across threads and forks.
+        db = sqlite3.connect(self.path, timeout=30., isolation_level=None)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            yield db
+        finally:
+            db.close()
+
+    def add(self, lat: float, lon: float, zoom: int, prediction: bool, score: float,
+            model_version: Optional[str] = None, cam: Optional[np.ndarray] = None,
+            created: Optional[float] = None):
+        ''' Queues a prediction (`cam`: optional raw explainability map).'''
+        created = time.time() if created is None else created
+        with self._lock:
+            self._queue.append((lat, lon, zoom, bool(prediction), float(score),
+                                model_version, created, cam))
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._loop, name='detections-writer',
+                                                daemon=True)
+                self._writer.start()
+            if len(self._queue) >= self.batch_size:
+                self._wake.set()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # Kept in the queue, retried on the next flush.
+                logger.warning('Writing detections failed, retrying.', exc_info=True)
+            except Exception:
+                logger.exception('Writing detections failed, batch dropped.')
+
+    def flush(self):
+        '''
+        Writes the queued predictions. They stay queued after a database
+        error and are dropped after any other one.
+        '''
+        with self._lock:
+            records = list(self._queue)
+        if not records:
+            return
+
+        try:
+            self._write(records)
+        except sqlite3.Error:
+            raise
+        except Exception:
+            self._pop(len(records), written=False)
+            raise
+        self._pop(len(records), written=True)
+
+    def _pop(self, count: int, written: bool):
+        with self._lock:
+            for _ in range(count):
+                self._queue.popleft()
+            if written:
+                self.written += count
+            else:
+                self.dropped += count
+
+    def _write(self, records: list):
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                for lat, lon, zoom, prediction, score, version, created, cam in records:
+                    if cam is not None:
+                        cam = np.asarray(cam, dtype=np.float32)
+                    cursor = db.execute(
+                        'INSERT INTO detections (tile, latitude, longitude, zoom, prediction, '
+                        'score, model_version, created, cam, cam_shape) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (tile_key(lat, lon, zoom, self.precision), lat, lon, zoom,
+                         prediction, score, version, created,
+                         cam.tobytes() if cam is not None else None,
+                         ','.join(map(str, cam.shape)) if cam is not None else None))
+                    min_lon, min_lat, max_lon, max_lat = tile_bounds(lat, lon, zoom,
+                                                                     self.tile_size)
+                    db.execute('INSERT INTO detections_index VALUES (?, ?, ?, ?, ?)',
+                               (cursor.lastrowid, min_lon, max_lon, min_lat, max_lat))
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def _row(self, row, with_cam: bool) -> dict:
+        keys = ['id', 'latitude', 'longitude', 'zoom', 'prediction', 'score',
+                'model_version', 'created']
+        detection = dict(zip(keys, row[:8]))
+        detection['prediction'] = bool(detection['prediction'])
+        if with_cam:
+            cam, shape = row[8], row[9]
+            detection['cam'] = None
+            if cam is not None:
+                shape = tuple(map(int, shape.split(',')))
+                detection['cam'] = np.frombuffer(cam, dtype=np.float32).reshape(shape)
+        return detection
+
+    def latest(self, lat: float, lon: float, zoom: int,
+               model_version: Optional[str] = None,
+               max_age: Optional[float] = None,
+               with_cam: bool = False) -> Optional[dict]:
+        ''' Most recent prediction of the tile of a location (None if none or too old).'''
+        since = time.time() - max_age if max_age is not None else 0.
+        with self._connect() as db:
+            row = db.execute('SELECT id, latitude, longitude, zoom, prediction, score, '
+                             'model_version, created, cam, cam_shape FROM detections '
+                             'WHERE tile = ? AND model_version IS ? AND created >= ? '
+                             'ORDER BY created DESC LIMIT 1',
+                             (tile_key(lat, lon, zoom, self.precision), model_version,
+                              since)).fetchone()
+        return self._row(row, with_cam) if row is not None else None
+
+    def query(self, bbox: Optional[Tuple[float, float, float, float]] = None,
+              center: Optional[Tuple[float, float]] = None,
+              radius: Optional[float] = None,
+              since: Optional[float] = None,
+              until: Optional[float] = None,
+              min_score: Optional[float] = None,
+              positives: bool = False,
+              zoom: Optional[int] = None,
+              model_version: Optional[str] = None,
+              limit: int = 1000,
+              with_cam: bool = False) -> list:
+        '''
+        Predictions whose tile intersects `bbox` (min_lon, min_lat, max_lon,
+        max_lat), or whose centre is within `radius` meters of `center`
+        (lat, lon), most recent first.
+        '''
+        if center is not None:
+            bbox = radius_bbox(center[0], center[1], radius)
+        min_lon, min_lat, max_lon, max_lat = bbox
+
+        conditions = ['r.max_lon >= ?', 'r.min_lon <= ?', 'r.max_lat >= ?', 'r.min_lat <= ?']
+        values = [min_lon, max_lon, min_lat, max_lat]
+        for condition, value in [('d.created >= ?', since), ('d.created <= ?', until),
+                                 ('d.score >= ?', min_score), ('d.zoom = ?', zoom),
+                                 ('d.model_version = ?', model_version)]:
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        if positives:
+            conditions.append('d.prediction = 1')
+
+        sql = ('SELECT d.id, d.latitude, d.longitude, d.zoom, d.prediction, d.score, '
+               'd.model_version, d.created, d.cam, d.cam_shape '
+               'FROM detections_index r JOIN detections d ON d.id = r.id '
+               'WHERE ' + ' AND '.join(conditions) + ' ORDER BY d.created DESC')
+        if center is None:
+            sql += ' LIMIT ?'
+            values.append(limit)
+
+        results = []
+        with self._connect() as db:
+            for row in db.execute(sql, values):
+                # The R-tree gives the candidates of the circle's bounding box.
+                if center is not None and distance(center[0], center[1], row[1], row[2]) > radius:
+                    continue
+                results.append(self._row(row, with_cam))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def stats(self) -> dict:
+        with self._connect() as db:
+            # Rows are never deleted: the last id is the count, without a scan.
+            total = db.execute('SELECT COALESCE(MAX(id), 0) FROM detections').fetchone()[0]
+        with self._lock:
+            return {'detections': total, 'queued': len(self._queue),
+                    'written': self.written, 'dropped': self.dropped}
@@ -1,57 +1,197 @@
 # Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
 
 import io
-from typing import Union, Optional, Tuple
+import random
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from typing import List, Union, Optional, Tuple
 from PIL import Image
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+
+from classification_model.providers import GoogleStaticMapsProvider
+
+class DownloadError(Exception):
+    ''' The tile could not be downloaded (after retries).'''
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class TileFetcher():
+    '''
+    HTTP client shared by the downloaders of a process.
+
+    Connections are pooled (one requests.Session), at most `max_concurrency`
+    requests are in flight at once, and no more than `rate_limit` requests
+    per second are started (0: no limit). Timeouts, connection errors and
+    429/5xx answers are retried up to `retries` times with jittered
+    exponential backoff, waiting at most `max_backoff` seconds: an upstream
+    Retry-After longer than that is an error instead of a wait.
+    '''
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout: float = 10.,
+                       retries: int = 3,
+                       backoff: float = 0.5,
+                       rate_limit: float = 0.,
+                       max_concurrency: int = 16,
+                       max_backoff: float = 10.):
+
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limit = rate_limit
+        self.max_concurrency = max_concurrency
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrency,
+                              pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._rate_lock = threading.Lock()
+        self._next_start = 0.
+
+    def _wait_rate_limit(self):
+        if self.rate_limit <= 0:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + 1. / self.rate_limit
+        if start > now:
+            time.sleep(start - now)
+
+    def _sleep_backoff(self, attempt: int, retry_after: Optional[float] = None):
+        delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        time.sleep(min(delay, self.max_backoff))
+
+    def get(self, url: str) -> bytes:
+        ''' Content of `url`, raises DownloadError when it can't be fetched.'''
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            self._wait_rate_limit()
+            try:
+                with self._slots:
+                    response = self.session.get(url, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as err:
+                if last:
+                    raise DownloadError(f'Error when getting the image: {err}') from err
+                self._sleep_backoff(attempt)
+                continue
+
+            if response.status_code == 200:
+                return response.content
+            if last or response.status_code not in self.retry_status:
+                raise DownloadError('Error when getting the image. Code: '
+                                    f'{response.status_code}', response.status_code)
+            retry_after = response.headers.get('Retry-After', '')
+            retry_after = float(retry_after) if retry_after.isdigit() else None
+            if retry_after is not None and retry_after > self.max_backoff:
+                # Not worth holding the request that long.
+                raise DownloadError('Error when getting the image. Code: '
+                                    f'{response.status_code}, retry after {retry_after:.0f} s',
+                                    response.status_code)
+            self._sleep_backoff(attempt, retry_after)
+
+# Fetcher used by downloaders built without one.
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+def default_fetcher() -> TileFetcher:
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = TileFetcher()
+        return _default_fetcher
 
 class ImageDownloader():
     def __init__(self, location: Tuple[float, float],
                        zoom: int = 18,
                        size: int = 512,
                        maptype: str = 'satellite',
-                       secret_key: str = ''):
+                       secret_key: str = '',
+                       cache = None,
+                       provider = None,
+                       fetcher: Optional[TileFetcher] = None):
 
         self.center = location
         self.zoom = zoom
         self.size = size
         self.maptype = maptype
         self.key = secret_key
+        # Optional TileCache, shared between downloaders.
+        self.cache = cache
+        # Google Static Maps unless another TileProvider is given.
+        self.provider = provider or GoogleStaticMapsProvider(secret_key)
+        self.fetcher = fetcher or default_fetcher()
 
     def _set_secret_key(self, value: str):
         self.key = value
-    
+        if isinstance(self.provider, GoogleStaticMapsProvider):
+            self.provider.key = value
+
     def image_bytes_to_numpy(self, image_bytes: bytes) -> np.ndarray:
         image = Image.open(io.BytesIO(image_bytes))
-        image = image.convert('RGB')
-        image = np.array(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        # Read-only view of the decoded buffer (no extra copy).
+        image = np.asarray(image)
         return image
 
-    def generate_url(self) -> str:          
-        center = ','.join(tuple(map(str, self.center)))
-
-        url = 'https://maps.googleapis.com/maps/api/staticmap?'
-        url += f'center={center}'
-        url += f'&zoom={self.zoom}'
-        url += f'&size={self.size}x{self.size}'
-        url += f'&maptype={self.maptype}'
-        url += f'&key={self.key}'
-
+    def generate_url(self) -> str:
+        url = self.provider.url(self.center, self.zoom, self.size, self.maptype)
         self.url = url
         return url
 
+    def download(self) -> bytes:
+        return self.provider.fetch(self.center, self.zoom, self.size,
+                                   self.maptype, self.fetcher)
+
     def request(self, return_as_numpy=True):
-        url = self.generate_url()        
+        if self.cache is None:
+            content = self.download()
+            if return_as_numpy:
+                return self.image_bytes_to_numpy(content)
+            return content
+
+        key = self.cache.key(self.center, self.zoom, self.size, self.maptype)
+        if return_as_numpy:
+            image = self.cache.get_array(key)
+            if image is not None:
+                return image
+
+        content = self.cache.get(key)
+        if content is None:
+            content = self.download()
+            self.cache.put(key, content)
+
+        if return_as_numpy:
+            image = self.image_bytes_to_numpy(content)
+            return self.cache.put_array(key, image)
+        return content
+
+def request_many(downloaders: List[ImageDownloader],
+                 max_workers: int = 8,
+                 return_as_numpy: bool = True) -> list:
+    '''
+    Runs the requests of several downloaders concurrently.
+
+    Failed downloads are returned as their exception instead of raised, so
+    one bad tile doesn't lose the others.
+    '''
+    def run(downloader):
         try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                if return_as_numpy:
-                    return self.image_bytes_to_numpy(response.content)
-                else:
-                    return response.content
-            else:
-                raise Exception('Error when getting the image. Code: ', 
-                                 response.status_code)
-        except requests.exceptions.HTTPError as err:
-            raise SystemExit(err)
+            return downloader.request(return_as_numpy)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(run, downloaders))
@@ -0,0 +1,70 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import io
+import time
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+
+class ImageEncoder():
+    '''
+    Encodes uint8 RGB arrays as PNG, JPEG or WebP.
+
+    Parameters
+    ----------
+    image_format : str
+        'png', 'jpeg', 'webp' (lossy) or 'webp_lossless'.
+    quality : int
+        JPEG (1-95) and lossy WebP (1-100) quality.
+    compress_level : int
+        PNG compression level (0: none, fastest; 9: smallest).
+    '''
+    formats = {'png': ('PNG', 'image/png'),
+               'jpeg': ('JPEG', 'image/jpeg'),
+               'webp': ('WEBP', 'image/webp'),
+               'webp_lossless': ('WEBP', 'image/webp')}
+
+    def __init__(self, image_format: str = 'png',
+                       quality: int = 90,
+                       compress_level: int = 6):
+
+        if image_format not in self.formats:
+            raise ValueError(f'Unknown image format ({image_format}).')
+        self.image_format = image_format
+        self.quality = quality
+        self.compress_level = compress_level
+
+    @property
+    def mimetype(self) -> str:
+        return self.formats[self.image_format][1]
+
+    def _save_options(self) -> dict:
+        if self.image_format == 'png':
+            return {'compress_level': self.compress_level}
+        if self.image_format == 'jpeg':
+            return {'quality': self.quality}
+        if self.image_format == 'webp':
+            return {'quality': self.quality, 'method': 0}
+        return {'lossless': True, 'quality': 0, 'method': 0}
+
+    def encode(self, arr: np.ndarray) -> Tuple[bytes, dict]:
+        '''
+        Encoded image and its stats: format, size (bytes) and encoding
+        time (ms).
+        '''
+        start = time.perf_counter()
+        # No copy when the array is already uint8 and contiguous.
+        if arr.dtype != np.uint8:
+            arr = arr.astype(np.uint8)
+        image = Image.fromarray(np.ascontiguousarray(arr))
+
+        byte_buffer = io.BytesIO()
+        image.save(byte_buffer, format=self.formats[self.image_format][0],
+                   **self._save_options())
+        content = byte_buffer.getvalue()
+
+        stats = {'format': self.image_format,
+                 'bytes': len(content),
+                 'encode_ms': (time.perf_counter() - start) * 1000}
+        return content, stats
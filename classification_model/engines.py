@@ -0,0 +1,50 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import torch
+
+class TorchScriptEngine():
+    '''
+    Model exported to TorchScript by export.py. Called like `CAMExtractor`:
+    normalized input batch -> (logits, raw cam).
+    '''
+    def __init__(self, path: str, device: str = 'cpu'):
+        self.device = device
+        self.module = torch.jit.load(path, map_location=torch.device(device))
+        self.module.eval()
+
+    def __call__(self, input_: torch.Tensor):
+        with torch.no_grad():
+            return self.module(input_)
+
+class ONNXEngine():
+    '''
+    Model exported to ONNX by export.py, run with ONNX Runtime (CPU).
+    Called like `CAMExtractor`: normalized input batch -> (logits, raw cam).
+    '''
+    def __init__(self, path: str, num_threads: int = 0):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnx backend needs the onnxruntime package.')
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input_: torch.Tensor):
+        inputs = {self.input_name: input_.detach().cpu().contiguous().numpy()}
+        logits, cam = self.session.run(None, inputs)
+        return torch.from_numpy(logits), torch.from_numpy(cam)
+
+def load_engine(backend: str, path: str, device: str = 'cpu'):
+    ''' Engine of an exported model: torchscript, int8 or onnx.'''
+    if backend == 'torchscript':
+        return TorchScriptEngine(path, device)
+    if backend == 'int8':
+        # TorchScript model quantized by quantize.py, quantized kernels are CPU only.
+        return TorchScriptEngine(path, 'cpu')
+    if backend == 'onnx':
+        return ONNXEngine(path)
+    raise ValueError(f'Unknown inference backend ({backend}).')
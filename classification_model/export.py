@@ -0,0 +1,103 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+# Exports the classifier (logits and layer4 class activation map) to
+# TorchScript and/or ONNX, and checks that the exported models match the
+# eager one (scores and explainability maps) within tolerance.
+#
+#   PYTHONPATH=.. python export.py --model ./models/model_cls.pt \
+#       --torchscript ./models/model_cls.ts --onnx ./models/model_cls.onnx
+#
+# then set `inference_backend` and `model_path` in settings.py.
+
+import argparse
+import json
+import sys
+
+import numpy as np
+import torch
+
+from classification_model.cam import CAMModel
+from classification_model.engines import load_engine
+from classification_model.preprocessing import Preprocessor
+from classification_model.query import ModelQuery
+
+def export_torchscript(model, path, size=512):
+    example = torch.zeros((1, 3, size, size))
+    with torch.no_grad():
+        traced = torch.jit.trace(CAMModel(model).eval(), example)
+    traced = torch.jit.freeze(traced)
+    traced.save(path)
+
+def export_onnx(model, path, size=512, opset=17):
+    example = torch.zeros((1, 3, size, size))
+    torch.onnx.export(CAMModel(model).eval(), (example,), path,
+                      input_names=['input'],
+                      output_names=['logits', 'cam'],
+                      dynamic_axes={'input': {0: 'batch'},
+                                    'logits': {0: 'batch'},
+                                    'cam': {0: 'batch'}},
+                      opset_version=opset,
+                      dynamo=False)
+
+def check_parity(model, engine, n_images=8, size=512, quantile=0.94,
+                 score_atol=1e-4, cam_atol=1e-3, seed=0):
+    '''
+    Compares an exported engine with the eager model on random tiles.
+
+    Returns
+    -------
+    dict with the maximum score and explainability map differences, the
+    number of differing predictions and whether they are within tolerance.
+    '''
+    rng = np.random.default_rng(seed)
+    images = [rng.integers(0, 256, (3, size, size), dtype=np.uint8)
+              for _ in range(n_images)]
+
+    # Threshold 0: every image gets an explainability map to compare.
+    preprocessor = Preprocessor()
+    eager = ModelQuery(model=model, threshold=0., quantile=quantile,
+                       preprocessor=preprocessor)
+    exported = ModelQuery(model=engine, threshold=0., quantile=quantile,
+                          preprocessor=preprocessor)
+
+    expected = eager.make_batch_query(images)
+    output = exported.make_batch_query(images)
+
+    score_diff = max(abs(a[1] - b[1]) for a, b in zip(expected, output))
+    cam_diff = max(float(np.nanmax(np.abs(a[2] - b[2]))) for a, b in zip(expected, output))
+    # Predictions at the default threshold.
+    mismatches = sum((a[1] > 0.5) != (b[1] > 0.5) for a, b in zip(expected, output))
+
+    return {'max_score_diff': score_diff,
+            'max_cam_diff': cam_diff,
+            'prediction_mismatches': mismatches,
+            'ok': score_diff <= score_atol and cam_diff <= cam_atol and mismatches == 0}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='./models/model_cls.pt',
+                        help='Eager checkpoint (torch.save of the full model).')
+    parser.add_argument('--torchscript', type=str, default='',
+                        help='Output path of the TorchScript model.')
+    parser.add_argument('--onnx', type=str, default='',
+                        help='Output path of the ONNX model.')
+    parser.add_argument('--size', type=int, default=512, help='Tile size.')
+    parser.add_argument('--images', type=int, default=8,
+                        help='Random tiles used in the parity check.')
+    args = parser.parse_args()
+
+    model = torch.load(args.model, map_location='cpu', weights_only=False)
+    model.eval()
+
+    ok = True
+    for backend, path, export in [('torchscript', args.torchscript, export_torchscript),
+                                  ('onnx', args.onnx, export_onnx)]:
+        if not path:
+            continue
+        export(model, path, args.size)
+        report = check_parity(model, load_engine(backend, path),
+                              n_images=args.images, size=args.size)
+        print(json.dumps(dict(backend=backend, path=path, **report)))
+        ok = ok and report['ok']
+
+    sys.exit(0 if ok else 1)
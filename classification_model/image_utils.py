@@ -1,13 +1,58 @@
 # Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
 
-from matplotlib.colors import Normalize
-from matplotlib.cm import ScalarMappable
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+import functools
+import threading
+
 import numpy as np
 
+# Segment data of matplotlib's 'jet' colormap: (x, y) breakpoints per channel.
+_JET_DATA = {'red': ((0., 0.), (0.35, 0.), (0.66, 1.), (0.89, 1.), (1., 0.5)),
+             'green': ((0., 0.), (0.125, 0.), (0.375, 1.), (0.64, 1.), (0.91, 0.), (1., 0.)),
+             'blue': ((0., 0.5), (0.11, 1.), (0.34, 1.), (0.65, 0.), (1., 0.))}
+
+# Scratch buffers of the overlay renderer, per thread.
+_buffers = threading.local()
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(colormap: str = 'jet') -> np.ndarray:
+    '''
+    RGB lookup table of a colormap, as uint8 (N+1, 3) array.
+
+    Rows 0..N-1 are the colors matplotlib uses for each of the N bins of
+    [0,1]; the extra last row is the color of NaN values (black). 'jet' is
+    built without matplotlib, other colormaps are read from it.
+    '''
+    if colormap == 'jet':
+        x = np.linspace(0, 1, 256)
+        lut = np.stack([np.interp(x, *zip(*_JET_DATA[c])) for c in ['red', 'green', 'blue']], axis=1)
+        lut = (np.clip(lut, 0, 1) * 255).astype(np.uint8)
+    else:
+        import matplotlib
+        cmap = matplotlib.colormaps[colormap]
+        lut = cmap(np.arange(cmap.N), bytes=True)[:,:3]
+    return np.concatenate([lut, np.zeros((1, 3), dtype=np.uint8)])
+
+@functools.lru_cache(maxsize=16)
+def blend_table(alpha: float) -> np.ndarray:
+    '''
+    uint8 (256*256,) table of alpha * color + (1 - alpha) * pixel, truncated,
+    indexed by color * 256 + pixel.
+    '''
+    color = np.arange(256, dtype=np.float64)[:,None]
+    pixel = np.arange(256, dtype=np.float64)[None,:]
+    table = alpha * color + (1 - alpha) * pixel
+    return np.clip(table, 0, 255).astype(np.uint8).ravel()
+
+def _scratch(name: str, shape: tuple, dtype) -> np.ndarray:
+    buffer = getattr(_buffers, name, None)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        setattr(_buffers, name, buffer)
+    return buffer
+
 def overlay_image_mask(rgb_image: np.ndarray, colormap_image: np.ndarray,
-                       alpha: float = 0.5, colormap: str = 'jet') -> np.ndarray:
+                       alpha: float = 0.5, colormap: str = 'jet',
+                       out: np.ndarray = None) -> np.ndarray:
     '''
     Overlays two images using alpha blending.
     
@@ -19,27 +64,51 @@ def overlay_image_mask(rgb_image: np.ndarray, colormap_image: np.ndarray,
         The colormap image as a NumPy array.
     alpha: float
         The alpha blending factor.
+    colormap: str
+        Name of the (matplotlib) colormap.
+    out: ndarray, optional
+        uint8 array with the shape of `rgb_image` to write the result in.
     
     Returns
     -------
     The resulting image as a NumPy array.
     '''
+    lut = colormap_lut(colormap)
+    n = len(lut) - 1
+    height, width = colormap_image.shape
 
-    norm = Normalize(vmin=0, vmax=1)
-    mapper = ScalarMappable(norm=norm, cmap=colormap)
-    colormap_image = mapper.to_rgba(colormap_image, bytes=True)  # Convert to 0-255 uint8
+    # Colormap bin of each pixel, as matplotlib does: floor(v * N) in
+    # [0, N-1], NaN values to the extra (black) row.
+    dtype = colormap_image.dtype if colormap_image.dtype.kind == 'f' else np.float64
+    scaled = _scratch('scaled', (height, width), dtype)
+    np.multiply(colormap_image, n, out=scaled)
+    np.clip(scaled, 0, n - 1, out=scaled)
+    nan = np.isnan(scaled)
+    if nan.any():
+        scaled[nan] = n
+    index = _scratch('index', (height, width), np.intp)
+    np.copyto(index, scaled, casting='unsafe')
 
-    blended_image = alpha * colormap_image[:,:,:3] + (1-alpha) * rgb_image
-    
-    blended_image = np.clip(blended_image, 0, 255).astype(np.uint8)
+    colors = _scratch('colors', (height, width, 3), np.uint8)
+    np.take(lut, index, axis=0, out=colors, mode='clip')
+
+    # Blend through the precomputed table: color * 256 + pixel.
+    blend_index = _scratch('blend_index', (height, width, 3), np.uint16)
+    np.left_shift(colors, 8, out=blend_index, dtype=np.uint16)
+    np.add(blend_index, rgb_image, out=blend_index, casting='unsafe')
 
-    return blended_image
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    np.take(blend_table(float(alpha)), blend_index, out=out, mode='clip')
+    return out
 
 
 # Display/Save image with its original size
 # Adapted from:
 # https://stackoverflow.com/questions/28816046/displaying-different-images-with-actual-size-in-matplotlib-subplot
 def display_image_in_actual_size(im_data, mask=None, output_path='./', cmap='jet', alpha=0.5):
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
 
     dpi = mpl.rcParams['figure.dpi']
     height, width, depth = im_data.shape
@@ -0,0 +1,310 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Iterable, Optional
+
+from classification_model.scan import iter_scan
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    positives INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    owner TEXT,
+    heartbeat REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    tile TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+'''
+
+# Job states. Finished jobs (done, cancelled, failed) don't change anymore.
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+class JobStore():
+    '''
+    Durable queue of jobs in a SQLite database.
+
+    A job is a list of tiles (any JSON object) processed independently; each
+    tile result is stored as soon as it's ready, so a job interrupted by a
+    restart resumes with its pending tiles. Several processes can share the
+    database: a running job is owned by whoever holds its lease (renewed
+    by its runner while it works), and can be taken over once the lease
+    expires.
+    '''
+    def __init__(self, path: str, lease: float = 60.):
+        self.path = path
+        self.lease = lease
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A connection per operation: safe across threads and forks.
+        db = sqlite3.connect(self.path, timeout=30., isolation_level=None)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            yield db
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def create(self, params: dict, tiles: Iterable[dict]) -> str:
+        ''' Queue a new job, returns its id.'''
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.executemany(
+                'INSERT INTO items (job_id, idx, tile, status) VALUES (?, ?, ?, ?)',
+                ((job_id, i, json.dumps(tile), 'pending') for i, tile in enumerate(tiles)))
+            db.execute('INSERT INTO jobs (id, status, params, total, created, updated) '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       (job_id, QUEUED, json.dumps(params), cursor.rowcount, now, now))
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        ''' Status and progress of a job (None if unknown).'''
+        with self._connect() as db:
+            row = db.execute('SELECT id, status, params, total, done, positives, errors, '
+                             'message, created, updated FROM jobs WHERE id = ?',
+                             (job_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ['id', 'status', 'params', 'total', 'done', 'positives', 'errors',
+                'message', 'created', 'updated']
+        job = dict(zip(keys, row))
+        job['params'] = json.loads(job['params'])
+        return job
+
+    def results(self, job_id: str, offset: int = 0, limit: int = 100) -> list:
+        ''' Tiles [offset, offset + limit) of a job, with their results if finished.'''
+        with self._connect() as db:
+            rows = db.execute('SELECT idx, tile, status, result FROM items '
+                              'WHERE job_id = ? AND idx >= ? ORDER BY idx LIMIT ?',
+                              (job_id, offset, limit)).fetchall()
+        results = []
+        for idx, tile, status, result in rows:
+            item = dict(json.loads(tile), index=idx)
+            item.update(json.loads(result) if result is not None else {'status': status})
+            results.append(item)
+        return results
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        ''' Cancels a queued or running job, returns its (new) status.'''
+        with self._transaction() as db:
+            row = db.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            if row[0] in (QUEUED, RUNNING):
+                db.execute('UPDATE jobs SET status = ?, updated = ? WHERE id = ?',
+                           (CANCELLED, time.time(), job_id))
+                return CANCELLED
+            return row[0]
+
+    def claim(self, owner: str) -> Optional[str]:
+        '''
+        Takes the oldest queued job (or a running one with an expired lease)
+        for `owner`, an id of the caller.
+        '''
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute('SELECT id FROM jobs WHERE status = ? OR '
+                             '(status = ? AND heartbeat < ?) ORDER BY created LIMIT 1',
+                             (QUEUED, RUNNING, now - self.lease)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE jobs SET status = ?, owner = ?, heartbeat = ?, updated = ? '
+                       'WHERE id = ?', (RUNNING, owner, now, now, row[0]))
+            return row[0]
+
+    def renew(self, job_id: str, owner: str) -> bool:
+        ''' Renews the lease, False if the job isn't running for `owner` anymore.'''
+        now = time.time()
+        with self._connect() as db:
+            cursor = db.execute('UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = ? '
+                                'AND owner = ?', (now, job_id, RUNNING, owner))
+            return cursor.rowcount == 1
+
+    def pending(self, job_id: str, limit: int) -> list:
+        ''' (index, tile) of the next unprocessed tiles of a job.'''
+        with self._connect() as db:
+            rows = db.execute('SELECT idx, tile FROM items WHERE job_id = ? AND '
+                              'status = ? ORDER BY idx LIMIT ?',
+                              (job_id, 'pending', limit)).fetchall()
+        return [(idx, json.loads(tile)) for idx, tile in rows]
+
+    def store(self, job_id: str, owner: str, results: list) -> bool:
+        '''
+        Saves a chunk of (index, result) and renews the lease. Returns False
+        (and saves nothing) if the job isn't running for `owner` anymore
+        (cancelled, or taken over after the lease expired).
+        '''
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute('SELECT status, owner FROM jobs WHERE id = ?',
+                             (job_id,)).fetchone()
+            if row is None or row != (RUNNING, owner):
+                return False
+            db.executemany('UPDATE items SET status = ?, result = ? WHERE job_id = ? AND idx = ?',
+                           ((result['status'], json.dumps(result), job_id, idx)
+                            for idx, result in results))
+            db.execute('UPDATE jobs SET done = done + ?, positives = positives + ?, '
+                       'errors = errors + ?, heartbeat = ?, updated = ? WHERE id = ?',
+                       (len(results),
+                        sum(bool(r.get('prediction')) for _, r in results),
+                        sum(r['status'] == 'error' for _, r in results),
+                        now, now, job_id))
+        return True
+
+    def finish(self, job_id: str, owner: str, status: str = DONE,
+               message: Optional[str] = None):
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET status = ?, message = ?, updated = ? '
+                       'WHERE id = ? AND status = ? AND owner = ?',
+                       (status, message, time.time(), job_id, RUNNING, owner))
+
+    def stats(self) -> dict:
+        with self._connect() as db:
+            rows = db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict(rows)
+
+class JobRunner():
+    '''
+    Worker threads consuming a JobStore.
+
+    Tiles of a job are processed concurrently with `process(params, tile)`,
+    which returns the result (a dict) of the tile or raises. Results are
+    stored in chunks of `chunk_size`, the job is checked for cancellation
+    between chunks. The lease of a running job is renewed every third of it,
+    however long a chunk takes. Call `start` in every serving process (after
+    forking).
+    '''
+    def __init__(self, store: JobStore,
+                       process: Callable[[dict, dict], dict],
+                       workers: int = 2,
+                       max_workers: int = 8,
+                       chunk_size: int = 64,
+                       poll_interval: float = 1.,
+                       ready: Callable[[], bool] = lambda: True):
+
+        self.store = store
+        self.process = process
+        self.workers = workers
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.ready = ready
+
+        self._reset()
+        # Threads don't survive a fork: `start` again in the child.
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._threads = []
+
+    def start(self):
+        ''' Starts the worker threads (once per process).'''
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._loop, name=f'job-worker-{i}',
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self):
+        ''' A job was queued: wake up the idle workers.'''
+        self._wake.set()
+
+    def _loop(self):
+        owner = uuid.uuid4().hex
+        while True:
+            job_id = self.store.claim(owner) if self.ready() else None
+            if job_id is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            try:
+                self._run(job_id, owner)
+            except Exception as e:
+                self.store.finish(job_id, owner, FAILED, f'{type(e).__name__}: {e}')
+
+    def _heartbeat(self, job_id: str, owner: str, stop: threading.Event):
+        while not stop.wait(self.store.lease / 3):
+            try:
+                if not self.store.renew(job_id, owner):
+                    # Cancelled or taken over: the next store() finds out.
+                    return
+            except sqlite3.Error:
+                # Retried on the next beat, the lease has room for it.
+                pass
+
+    def _run(self, job_id: str, owner: str):
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, owner, stop),
+                                     name=f'job-heartbeat-{job_id[:8]}', daemon=True)
+        heartbeat.start()
+        try:
+            self._run_chunks(job_id, owner)
+        finally:
+            stop.set()
+
+    def _run_chunks(self, job_id: str, owner: str):
+        params = self.store.get(job_id)['params']
+
+        def process(item):
+            return self.process(params, item[1])
+
+        while True:
+            items = self.store.pending(job_id, self.chunk_size)
+            if not items:
+                self.store.finish(job_id, owner, DONE)
+                return
+
+            results = []
+            for (idx, _), result, error in iter_scan(items, process, self.max_workers):
+                if error is None:
+                    results.append((idx, dict(result, status='success')))
+                else:
+                    results.append((idx, {'status': 'error', 'message': str(error)}))
+
+            if not self.store.store(job_id, owner, results):
+                # Cancelled (or taken over after an expired lease).
+                return
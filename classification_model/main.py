@@ -1,6 +1,12 @@
 # Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
 
-from settings import secret_key
+from settings import (secret_key, tile_cache_dir, tile_cache_max_bytes,
+                      tile_cache_ttl, tile_cache_memory_items,
+                      tile_provider, tile_provider_url, tile_provider_dir,
+                      download_timeout, download_retries, download_backoff,
+                      download_max_backoff, download_rate_limit, download_max_concurrency,
+                      download_workers, inference_backend, channels_last,
+                      tile_size)
 
 import torch
 import torch.nn as nn
@@ -9,10 +15,17 @@ import torchvision.transforms as transforms
  
 import numpy as np
 
-from query import ModelQuery
-from downloader import ImageDownloader
-from image_utils import overlay_image_mask
+from classification_model.query import ModelQuery
+from classification_model.downloader import ImageDownloader, TileFetcher
+from classification_model.providers import make_provider
+from classification_model.image_utils import overlay_image_mask
+from classification_model.tile_cache import TileCache
+from classification_model.scan import iter_scan
+from classification_model.tiling import tile_grid, geometry_polygons, polygons_bbox
+from classification_model.bulk import run_bulk
 import argparse
+import json
+import sys
 
 from matplotlib import pyplot as plt
 
@@ -31,12 +44,70 @@ def get_input_args():
     help_ = 'Zoom level of satellite image.'
     parser.add_argument('--zoom', type=int, help=help_, default=18)
 
+    def parse_bbox(input_string):
+        t = tuple(map(float, input_string.split(',')))
+        if len(t) != 4:
+            raise ValueError('Must be four numbers.')
+        return t
+
+    area = parser.add_mutually_exclusive_group(required=True)
+
     help_ = 'Map location (latitude, longitude), eg. 12.345,56.789'
-    parser.add_argument('--loc', type=parse_tuple, help=help_, required=True)
+    area.add_argument('--loc', type=parse_tuple, help=help_)
+
+    help_ = ('Scan an area (min_lon,min_lat,max_lon,max_lat), '
+             'results are written to stdout as NDJSON.')
+    area.add_argument('--bbox', type=parse_bbox, help=help_)
+
+    help_ = 'Scan the area of a GeoJSON (Multi)Polygon file, as --bbox.'
+    area.add_argument('--geojson', type=str, help=help_)
+
+    help_ = ('Score the locations of a CSV or Parquet file (latitude, longitude '
+             'and optional zoom, quantile and id columns), see --output.')
+    area.add_argument('--input', type=str, help=help_)
+
+    bulk = parser.add_argument_group('bulk scoring (--input)')
+    bulk.add_argument('--output', type=str, default='output.ndjson',
+                      help='Results: NDJSON, or Parquet files if it ends with .parquet. '
+                           'An interrupted run resumes from OUTPUT.checkpoint.')
+    bulk.add_argument('--restart', action='store_true',
+                      help='Ignore the checkpoint and start over.')
+    bulk.add_argument('--images', type=str, default='',
+                      help='Save the overlay of positives to this directory.')
+    bulk.add_argument('--detections', action='store_true',
+                      help='Add the GeoJSON detection regions of positives.')
+    bulk.add_argument('--model', type=str, default='./models/model_cls.pt')
+    bulk.add_argument('--backend', type=str, default=inference_backend,
+                      help='eager, torchscript, onnx or int8 (see settings.py).')
+    bulk.add_argument('--workers', type=int, default=2,
+                      help='Inference processes (each loads the model).')
+    bulk.add_argument('--threads', type=int, default=0,
+                      help='Torch threads per inference process (0: default).')
+    bulk.add_argument('--batch-size', type=int, default=8)
+    bulk.add_argument('--checkpoint-rows', type=int, default=1000,
+                      help='Rows between checkpoints.')
 
     args = parser.parse_args()
     return args
 
+def scan_area(bbox, polygons, zoom, query, make_downloader):
+    '''
+    Scans the tile grid of an area, writing one JSON line per tile to stdout
+    as soon as it is ready.
+    '''
+    def process(tile):
+        x = make_downloader(tile['location']).request()
+        pred, score, _ = query.make_query(x.transpose(2,0,1))
+        return pred, score
+
+    grid = tile_grid(bbox, zoom, polygons=polygons)
+    for tile, result, error in iter_scan(grid, process, download_workers):
+        if error is None:
+            tile.update({'status': 'success', 'prediction': result[0], 'score': result[1]})
+        else:
+            tile.update({'status': 'error', 'message': str(error)})
+        print(json.dumps(tile), flush=True)
+
 if __name__ == '__main__':
     args = get_input_args()
     zoom = args.zoom
@@ -49,15 +120,55 @@ if __name__ == '__main__':
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])        
     ])
 
+    # Image downloading (repeated locations are read from the tile cache)
+    tile_cache = None
+    if tile_cache_dir:
+        tile_cache = TileCache(tile_cache_dir,
+                               max_bytes=tile_cache_max_bytes,
+                               ttl=tile_cache_ttl,
+                               memory_items=tile_cache_memory_items)
+
+    provider = make_provider(tile_provider,
+                             secret_key=secret_key,
+                             url=tile_provider_url,
+                             directory=tile_provider_dir)
+    fetcher = TileFetcher(timeout=download_timeout,
+                          retries=download_retries,
+                          backoff=download_backoff,
+                          max_backoff=download_max_backoff,
+                          rate_limit=download_rate_limit,
+                          max_concurrency=download_max_concurrency)
+
+    def make_downloader(location, zoom=zoom):
+        return ImageDownloader(location=location,
+                               zoom=zoom,
+                               secret_key=secret_key,
+                               cache=tile_cache,
+                               provider=provider,
+                               fetcher=fetcher)
+
+    # Bulk mode: the model is loaded by each inference process.
+    if args.input:
+        run_bulk(args.input, args.output, make_downloader, args.model,
+                 backend=args.backend,
+                 channels_last=channels_last,
+                 zoom=zoom,
+                 quantile=quantile,
+                 workers=args.workers,
+                 threads=args.threads,
+                 batch_size=args.batch_size,
+                 download_workers=download_workers,
+                 checkpoint_rows=args.checkpoint_rows,
+                 images_dir=args.images,
+                 detections=args.detections,
+                 size=tile_size,
+                 restart=args.restart)
+        sys.exit(0)
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model_path = './models/model_cls.pt'
+    model_path = args.model
     model = torch.load(model_path, map_location=torch.device(device))
 
-    # Image downloading
-    downloader = ImageDownloader(location=location,
-                                 zoom=zoom,
-                                 secret_key=secret_key)
-
     # Query
     query = ModelQuery(model=model,
                        quantile=quantile,
@@ -65,6 +176,19 @@ if __name__ == '__main__':
                        transform=transform
     )
 
+    # Area scan mode.
+    if location is None:
+        polygons = None
+        bbox = args.bbox
+        if args.geojson:
+            with open(args.geojson) as f:
+                polygons = geometry_polygons(json.load(f))
+            bbox = polygons_bbox(polygons)
+        scan_area(bbox, polygons, zoom, query, make_downloader)
+        sys.exit(0)
+
+    downloader = make_downloader(location)
+
     # Downlad the image and query the model.
     x = downloader.request()
     pred, score, cam = query.make_query(x.transpose(2,0,1))
@@ -0,0 +1,131 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import bisect
+import collections
+import contextlib
+import threading
+import time
+from typing import Callable, Iterable, Optional, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1., 2.5, 5., 10., 30.)
+
+class Metrics():
+    '''
+    Counters, gauges and latency histograms of a process, rendered in the
+    Prometheus text format.
+
+    Series are identified by a name and keyword labels. Observations take a
+    lock and a bisect, cheap enough for every stage of every request.
+    Collectors (callables returning (name, type, labels, value) tuples) add
+    series computed at render time, e.g. from the caches' stats.
+    '''
+    def __init__(self, prefix: str = 'waste_api',
+                       buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(float)
+        self._gauges = {}
+        # (name, labels) -> [bucket counts..., sum]
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def inc(self, name: str, value: float = 1., **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def add_collector(self, collector: Callable[[], Iterable[tuple]]):
+        self._collectors.append(collector)
+
+    def _series(self, name: str, labels, value, suffix: str = '') -> str:
+        labels = ','.join(f'{k}="{v}"' for k, v in labels)
+        labels = '{' + labels + '}' if labels else ''
+        return f'{self.prefix}_{name}{suffix}{labels} {value!r}'
+
+    def render(self) -> str:
+        ''' All series, in the Prometheus text exposition format.'''
+        with self._lock:
+            counters = [(k, 'counter', v) for k, v in self._counters.items()]
+            gauges = [(k, 'gauge', v) for k, v in self._gauges.items()]
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        for collector in self._collectors:
+            for name, kind, labels, value in collector():
+                entry = ((name, tuple(sorted(labels.items()))), kind, value)
+                (counters if kind == 'counter' else gauges).append(entry)
+
+        families = collections.defaultdict(list)
+        for (name, labels), kind, value in counters + gauges:
+            families[(name, kind)].append(self._series(name, labels, float(value)))
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            lines = families[(name, 'histogram')]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram[:-1]):
+                cumulative += count
+                lines.append(self._series(name, labels + (('le', bound),),
+                                          cumulative, '_bucket'))
+            lines.append(self._series(name, labels, histogram[-1], '_sum'))
+            lines.append(self._series(name, labels, cumulative, '_count'))
+
+        output = []
+        for (name, kind), lines in sorted(families.items()):
+            if name in self._help:
+                output.append(f'# HELP {self.prefix}_{name} {self._help[name]}')
+            output.append(f'# TYPE {self.prefix}_{name} {kind}')
+            output.extend(sorted(lines) if kind != 'histogram' else lines)
+        return '\n'.join(output) + '\n'
+
+class StageTimer():
+    '''
+    Durations of the stages of a request (e.g. download, forward, encode).
+
+    Each stage is also observed in the `stage_duration_seconds` histogram of
+    `metrics`, if given. `server_timing` formats the stages as a
+    Server-Timing header value.
+    '''
+    def __init__(self, metrics: Optional[Metrics] = None):
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.stages = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.) + seconds
+        if self.metrics is not None:
+            self.metrics.observe('stage_duration_seconds', seconds, stage=name)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        stages = list(self.stages.items()) + [('total', self.elapsed())]
+        return ', '.join(f'{name};dur={seconds * 1000:.2f}' for name, seconds in stages)
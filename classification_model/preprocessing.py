@@ -0,0 +1,81 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import threading
+from typing import List, Sequence
+
+import numpy as np
+import torch
+
+class Preprocessor():
+    '''
+    Model input of a batch of images, without intermediate copies.
+
+    uint8 -> float conversion and normalization ((x - mean) / std, on the raw
+    0-255 values, exactly as transforms.Normalize after .float()) are fused
+    in a single pass through a per-channel 256-entry lookup table, written
+    straight into a reusable (per thread) batch tensor.
+
+    With `channels_last` the batch tensor is laid out as N, H, W, C in memory
+    (torch.channels_last), the format expected by a channels-last model.
+    '''
+    def __init__(self, mean: Sequence[float] = (0.485, 0.456, 0.406),
+                       std: Sequence[float] = (0.229, 0.224, 0.225),
+                       device: str = 'cpu',
+                       channels_last: bool = False):
+
+        self.device = device
+        self.channels_last = channels_last
+        # Same float32 operations as transforms.Normalize on each value.
+        values = torch.arange(256, dtype=torch.float32).expand(len(mean), 256)
+        mean = torch.tensor(mean, dtype=torch.float32)[:,None]
+        std = torch.tensor(std, dtype=torch.float32)[:,None]
+        self.lut = ((values - mean) / std).numpy()
+        self._local = threading.local()
+
+    def _buffer(self, n: int, shape: tuple) -> torch.Tensor:
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or buffer.shape[0] < n or buffer.shape[1:] != shape:
+            buffer = torch.empty((n,) + shape, dtype=torch.float32)
+            if self.channels_last:
+                buffer = buffer.to(memory_format=torch.channels_last)
+            self._local.buffer = buffer
+        return buffer[:n]
+
+    def fill(self, slot: torch.Tensor, image: np.ndarray):
+        '''
+        Writes the normalized image into `slot`, a (3, H, W) float32 CPU tensor.
+
+        Parameters
+        ----------
+        slot : Tensor
+            Destination, e.g. one element of a batch tensor (any strides).
+        image : ndarray
+            uint8 image, channels first (3, H, W). Transposed views are fine.
+        '''
+        slot = slot.numpy()
+        for c in range(len(self.lut)):
+            np.take(self.lut[c], image[c], out=slot[c], mode='clip')
+
+    def batch(self, images: List[np.ndarray]) -> torch.Tensor:
+        '''
+        (N, 3, H, W) model input of uint8 channels-first images.
+
+        The tensor is a reusable buffer of the calling thread: it's only
+        valid until the next call from the same thread.
+        '''
+        batch = self._buffer(len(images), tuple(images[0].shape))
+        if not self.channels_last:
+            for slot, image in zip(batch, images):
+                self.fill(slot, image)
+            return batch.to(self.device)
+
+        # Strided writes into the channels-last slots are slow, the lookups go
+        # to a contiguous scratch image first and torch does the transposition.
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None or scratch.shape != batch.shape[1:]:
+            scratch = torch.empty(batch.shape[1:], dtype=torch.float32)
+            self._local.scratch = scratch
+        for slot, image in zip(batch, images):
+            self.fill(scratch, image)
+            slot.copy_(scratch)
+        return batch.to(self.device)
@@ -0,0 +1,96 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import hashlib
+import os
+from typing import Tuple
+
+class TileProvider():
+    '''
+    Source of satellite tiles.
+
+    `fetch` returns the encoded image centred at `center`. URL-based
+    providers only need to implement `url`, the request itself is made by
+    the given fetcher (see downloader.TileFetcher).
+    '''
+    def url(self, center: Tuple[float, float], zoom: int, size: int,
+            maptype: str) -> str:
+        raise NotImplementedError
+
+    def fetch(self, center: Tuple[float, float], zoom: int, size: int,
+              maptype: str, fetcher) -> bytes:
+        return fetcher.get(self.url(center, zoom, size, maptype))
+
+class GoogleStaticMapsProvider(TileProvider):
+    ''' Google Static Maps API (needs a secret key).'''
+    def __init__(self, secret_key: str = ''):
+        self.key = secret_key
+
+    def url(self, center, zoom, size, maptype) -> str:
+        center = ','.join(tuple(map(str, center)))
+
+        url = 'https://maps.googleapis.com/maps/api/staticmap?'
+        url += f'center={center}'
+        url += f'&zoom={zoom}'
+        url += f'&size={size}x{size}'
+        url += f'&maptype={maptype}'
+        url += f'&key={self.key}'
+        return url
+
+class HTTPTileProvider(TileProvider):
+    '''
+    Any server answering the Static Maps query parameters (center, zoom,
+    size, maptype) with an image, e.g. `tile_server.py` for local runs.
+    '''
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip('?')
+
+    def url(self, center, zoom, size, maptype) -> str:
+        center = ','.join(tuple(map(str, center)))
+        return (f'{self.base_url}?center={center}&zoom={zoom}'
+                f'&size={size}x{size}&maptype={maptype}')
+
+class FileSystemTileProvider(TileProvider):
+    '''
+    Tiles read from a directory of images, without network.
+
+    A file named `<lat>_<lon>_<zoom>.png` is returned for its exact
+    location. Any other request gets one of the images of the directory,
+    chosen deterministically from the request parameters (enough for tests
+    and benchmarks).
+    '''
+    extensions = ('.png', '.jpg', '.jpeg')
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files = sorted(name for name in os.listdir(directory)
+                            if name.lower().endswith(self.extensions))
+        if not self.files:
+            raise ValueError(f'No images found in {directory}.')
+
+    def path(self, center, zoom, size, maptype) -> str:
+        lat, lon = center
+        exact = f'{lat}_{lon}_{zoom}.png'
+        if exact in self.files:
+            return os.path.join(self.directory, exact)
+
+        params = f'{lat},{lon},{zoom},{size},{maptype}'.encode('utf-8')
+        index = int(hashlib.sha256(params).hexdigest(), 16) % len(self.files)
+        return os.path.join(self.directory, self.files[index])
+
+    def url(self, center, zoom, size, maptype) -> str:
+        return 'file://' + os.path.abspath(self.path(center, zoom, size, maptype))
+
+    def fetch(self, center, zoom, size, maptype, fetcher=None) -> bytes:
+        with open(self.path(center, zoom, size, maptype), 'rb') as f:
+            return f.read()
+
+def make_provider(name: str, secret_key: str = '', url: str = '',
+                  directory: str = '') -> TileProvider:
+    ''' Provider from its settings name: google, http or file.'''
+    if name == 'google':
+        return GoogleStaticMapsProvider(secret_key)
+    if name == 'http':
+        return HTTPTileProvider(url)
+    if name == 'file':
+        return FileSystemTileProvider(directory)
+    raise ValueError(f'Unknown tile provider ({name}).')
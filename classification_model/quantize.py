@@ -0,0 +1,213 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+# Post-training static (int8) quantization of the classifier, calibrated on
+# a directory of tiles (e.g. the tile cache), and a report comparing the
+# quantized and channels-last models with the fp32 one on held-out tiles:
+# latency, memory, and score/prediction agreement.
+#
+#   PYTHONPATH=.. python quantize.py --model ./models/model_cls.pt \
+#       --tiles ../tile_cache --output ./models/model_cls.int8.pt
+#
+# then set `inference_backend = 'int8'` and `model_path` in settings.py.
+
+import argparse
+import copy
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.profiler import ProfilerActivity, profile
+
+from classification_model.cam import CAMExtractor
+from classification_model.engines import load_engine
+from classification_model.preprocessing import Preprocessor
+
+class Backbone(nn.Module):
+    ''' Convolutional part of the ResNet classifier (input -> layer4 features).'''
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        for name in ['conv1', 'bn1', 'relu', 'maxpool',
+                     'layer1', 'layer2', 'layer3', 'layer4']:
+            setattr(self, name, getattr(model, name))
+
+    def forward(self, x: torch.Tensor):
+        x = self.maxpool(self.relu(self.bn1(self.conv1(x))))
+        return self.layer4(self.layer3(self.layer2(self.layer1(x))))
+
+class QuantizedCAMModel(nn.Module):
+    '''
+    int8 backbone followed by the fp32 pooling, classifier and class
+    activation map, so the outputs are the same as `CAMModel`'s. Keeping
+    the last (tiny) layer in fp32 leaves the map weights exact.
+    '''
+    def __init__(self, backbone: nn.Module, model: nn.Module):
+        super().__init__()
+        self.backbone = backbone
+        self.avgpool = model.avgpool
+        self.fc = model.fc
+
+    def forward(self, x: torch.Tensor):
+        features = self.backbone(x)
+        logits = self.fc(torch.flatten(self.avgpool(features), 1))
+
+        fc_weights = self.fc.weight.unsqueeze(2).unsqueeze(3)
+        cam = (fc_weights * features).sum(1, keepdim=True)
+        return logits, cam
+
+def load_tiles(directory: str, size: int = 512) -> list:
+    '''
+    uint8 (3, H, W) images of a directory of tiles: tile cache entries
+    (.tile) or image files. Files that aren't `size` x `size` images are
+    skipped. Sorted by file name, so splits are reproducible.
+    '''
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(('.tile', '.png', '.jpg', '.jpeg')):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'rb') as f:
+                image = Image.open(io.BytesIO(f.read())).convert('RGB')
+        except OSError:
+            continue
+        if image.size == (size, size):
+            images.append(np.asarray(image).transpose(2,0,1))
+    return images
+
+def batches(images: list, batch_size: int):
+    for i in range(0, len(images), batch_size):
+        yield images[i:i + batch_size]
+
+def quantize(model: nn.Module, images: list, preprocessor: Preprocessor,
+             batch_size: int = 8, qengine: str = 'x86') -> nn.Module:
+    '''
+    Static int8 quantization of the model backbone.
+
+    Parameters
+    ----------
+    model : nn.Module
+        fp32 ResNet classifier.
+    images : list
+        Calibration tiles, uint8 (3, H, W); activation ranges are observed on them.
+    preprocessor : Preprocessor
+        Model input of the tiles (its memory format is the one served).
+
+    Returns
+    -------
+    QuantizedCAMModel, called like `CAMExtractor`.
+    '''
+    torch.backends.quantized.engine = qengine
+    backbone = Backbone(model).eval()
+    example = preprocessor.batch(images[:1]).clone()
+
+    prepared = prepare_fx(backbone, get_default_qconfig_mapping(qengine), (example,))
+    with torch.no_grad():
+        for batch in batches(images, batch_size):
+            prepared(preprocessor.batch(batch))
+
+    return QuantizedCAMModel(convert_fx(prepared), model).eval()
+
+def save(model: nn.Module, path: str, example: torch.Tensor):
+    ''' TorchScript file of the quantized model, loaded by the 'int8' backend.'''
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example))
+    traced.save(path)
+
+def measure(run, images: list, preprocessor: Preprocessor, batch_size: int) -> dict:
+    '''
+    Logits of `run` (input batch -> (logits, cam)) on the tiles, with the
+    latency per tile and the bytes allocated by torch per tile.
+    '''
+    with torch.no_grad():
+        run(preprocessor.batch(images[:batch_size]))
+
+        logits = []
+        start = time.perf_counter()
+        for batch in batches(images, batch_size):
+            logits.append(run(preprocessor.batch(batch))[0].flatten().numpy())
+        elapsed = time.perf_counter() - start
+
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            run(preprocessor.batch(images[:batch_size]))
+    allocated = sum(e.self_cpu_memory_usage for e in prof.events()
+                    if e.self_cpu_memory_usage > 0)
+
+    return {'logits': np.concatenate(logits),
+            'ms_per_tile': elapsed / len(images) * 1000,
+            'torch_bytes_per_tile': allocated / min(batch_size, len(images))}
+
+def agreement(expected: np.ndarray, logits: np.ndarray, threshold: float = 0.5) -> dict:
+    ''' Differences of the logits and scores with the fp32 ones.'''
+    expected_scores = torch.sigmoid(torch.from_numpy(expected)).numpy()
+    scores = torch.sigmoid(torch.from_numpy(logits)).numpy()
+    diff = np.abs(expected_scores - scores)
+    return {'max_logit_diff': float(np.abs(expected - logits).max()),
+            'max_score_diff': float(diff.max()),
+            'mean_score_diff': float(diff.mean()),
+            'prediction_agreement': float(np.mean((expected_scores > threshold) ==
+                                                  (scores > threshold)))}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='./models/model_cls.pt',
+                        help='fp32 checkpoint (torch.save of the full model).')
+    parser.add_argument('--tiles', type=str, required=True,
+                        help='Directory of tiles (e.g. the tile cache).')
+    parser.add_argument('--holdout', type=str, default='',
+                        help='Directory of held-out tiles for the report '
+                             '(default: the last --holdout-fraction of --tiles).')
+    parser.add_argument('--holdout-fraction', type=float, default=0.2)
+    parser.add_argument('--output', type=str, default='',
+                        help='Output path of the int8 model.')
+    parser.add_argument('--size', type=int, default=512, help='Tile size.')
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--qengine', type=str, default='x86',
+                        choices=torch.backends.quantized.supported_engines)
+    args = parser.parse_args()
+
+    tiles = load_tiles(args.tiles, args.size)
+    if args.holdout:
+        calibration, holdout = tiles, load_tiles(args.holdout, args.size)
+    else:
+        split = len(tiles) - max(1, int(len(tiles) * args.holdout_fraction))
+        calibration, holdout = tiles[:split], tiles[split:]
+    if not calibration or not holdout:
+        sys.exit(f'Not enough {args.size}x{args.size} tiles '
+                 f'(calibration: {len(calibration)}, held-out: {len(holdout)}).')
+
+    model = torch.load(args.model, map_location='cpu', weights_only=False)
+    model.eval()
+
+    # int8 kernels work on NHWC, calibration and serving use channels-last input.
+    preprocessor = Preprocessor()
+    preprocessor_cl = Preprocessor(channels_last=True)
+    int8 = quantize(copy.deepcopy(model), calibration, preprocessor_cl,
+                    args.batch, args.qengine)
+    if args.output:
+        save(int8, args.output, preprocessor_cl.batch(holdout[:1]).clone())
+        int8 = load_engine('int8', args.output)
+
+    reference = None
+    def report(name, run, preprocessor, path=None):
+        global reference
+        result = measure(run, holdout, preprocessor, args.batch)
+        logits = result.pop('logits')
+        if reference is None:
+            reference = logits
+        result.update(agreement(reference, logits))
+        if path:
+            result['model_bytes'] = os.path.getsize(path)
+        print(json.dumps(dict(model=name, calibration_tiles=len(calibration),
+                              holdout_tiles=len(holdout), **result)), flush=True)
+
+    report('fp32', CAMExtractor.for_model(model), preprocessor, args.model)
+    model.to(memory_format=torch.channels_last)
+    report('fp32_channels_last', CAMExtractor.for_model(model), preprocessor_cl, args.model)
+    report('int8', int8, preprocessor_cl, args.output)
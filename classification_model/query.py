@@ -6,18 +6,46 @@ import torchvision.transforms as transforms
 from torch.nn import functional as F
 
 import numpy as np
+import time
 
-from typing import Union, Optional, Tuple
+from typing import List, Union, Optional, Tuple
+
+from classification_model.cam import CAMExtractor
+
+def quantile_thresholds(maps: np.ndarray, quantiles: List[float]) -> np.ndarray:
+    '''
+    Per-map quantile (linear interpolation, as torch.quantile) of (N, ...)
+    maps, by selection (np.partition) instead of a full sort.
+    '''
+    flat = maps.reshape(len(maps), -1)
+    pos = np.asarray(quantiles, dtype=np.float64) * (flat.shape[1] - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    # A single partition places every requested rank of every row.
+    values = np.partition(flat, np.unique(np.concatenate([lo, hi])), axis=1)
+    rows = np.arange(len(flat))
+    low, high = values[rows, lo], values[rows, hi]
+    return low + (high - low) * (pos - lo)
 
 class ModelQuery():
     def __init__(self, threshold: float = 0.5,
                        quantile: float = 0.94,
-                       model: Union[nn.Module, None] = None,
+                       model = None,
                        transform: Union[nn.Sequential, None] = None,
-                       device: str = 'cpu'):
+                       device: str = 'cpu',
+                       preprocessor = None):
 
-        self.model = model.to(device)
+        if isinstance(model, nn.Module):
+            self.model = model.to(device)
+            # One hook per model, shared by every ModelQuery built on it.
+            self.extractor = CAMExtractor.for_model(self.model)
+        else:
+            # Exported model (see engines.py), called like the extractor.
+            self.model = model
+            self.extractor = model
         self.transform = transform
+        # Optional Preprocessor (uint8 images), replaces `transform`.
+        self.preprocessor = preprocessor
         self.threshold = threshold
         self.quantile = quantile
         self.device = device
@@ -44,16 +72,70 @@ class ModelQuery():
         if not 0. <= value and value <= 1.:
             raise ValueError("The threshold must be in range [0,1].")
     
-    def compute_cam(self, image: np.array, name: str, fc_weights: np.array):
-        fc_weights = self.model.fc.weight.unsqueeze(2).unsqueeze(3)
-        cam = fc_weights * self._activation_cam[name].sum(1, keepdim=True)
-        
-        cam = torch.where(cam <= torch.quantile(cam, self.quantile), 0, cam)
-        cam = F.interpolate(cam, image.shape[1:3], mode="bilinear", align_corners=True)
-        cam = cam.detach().cpu().numpy()[0,0,:,:]
-        
-        cam = (cam - np.min(cam)) / (np.max(cam) - np.min(cam))
-        return cam 
+    def compute_cam(self, cam: torch.Tensor, shape: Tuple[int, int],
+                    quantiles: Optional[List[float]] = None) -> np.ndarray:
+        '''
+        Explainability maps of positive predictions.
+
+        Parameters
+        ----------
+        cam : Tensor
+            Raw class activation maps (N, 1, h, w) as returned by the extractor.
+        shape : tuple
+            Output (height, width), usually the input image size.
+        quantiles : list, optional
+            Pixel-wise threshold of each map. By default, the query quantile.
+
+        Returns
+        -------
+        cam: ndarray
+            (N, height, width) maps in [0,1] where only the pixels above
+            their quantile are kept.
+        '''
+        n = cam.shape[0]
+        if quantiles is None:
+            quantiles = [self.quantile] * n
+
+        thresholds = quantile_thresholds(cam.detach().cpu().numpy(), quantiles)
+        thresholds = torch.from_numpy(thresholds).to(cam.dtype).to(cam.device)
+
+        cam = torch.where(cam <= thresholds.view(n, 1, 1, 1), 0, cam)
+        cam = F.interpolate(cam, shape, mode="bilinear", align_corners=True)
+        cam = cam.detach().cpu().numpy()[:,0,:,:]
+
+        cam_min = cam.min(axis=(1,2), keepdims=True)
+        cam_max = cam.max(axis=(1,2), keepdims=True)
+        cam = (cam - cam_min) / (cam_max - cam_min)
+        return cam
+
+    def compute_grid(self, raw_cam: np.ndarray,
+                     quantile: Optional[float] = None) -> np.ndarray:
+        '''
+        Explainability map at the resolution of the model features (e.g.
+        16x16 for a 512x512 image), without upsampling.
+
+        Parameters
+        ----------
+        raw_cam : ndarray
+            Raw class activation map (h, w), as returned by `make_batch_query`.
+        quantile : float, optional
+            Pixel-wise threshold. By default, the query quantile.
+
+        Returns
+        -------
+        cam: ndarray
+            (h, w) float32 map in [0,1] where only the cells above the
+            quantile are kept (as `compute_cam`, before the upsampling).
+        '''
+        quantile = self.quantile if quantile is None else quantile
+        self._validate_quantile(quantile)
+        raw_cam = np.asarray(raw_cam, dtype=np.float32)
+        threshold = quantile_thresholds(raw_cam[None], [quantile])[0]
+        grid = np.where(raw_cam <= threshold, 0, raw_cam)
+        grid_min, grid_max = grid.min(), grid.max()
+        if grid_max > grid_min:
+            grid = (grid - grid_min) / (grid_max - grid_min)
+        return grid.astype(np.float32)
 
     def make_query(self, image: np.array):
         '''
@@ -75,37 +157,103 @@ class ModelQuery():
             In case of positive prediction, it returns the Explainability of the classification.
             Otherwise, None is returned.
         '''
- 
-        self.activation = {}
-        def get_activation(name):
-            def hook(model, input, output):        
-                self.activation[name] = output.detach()
-            return hook
-
-        input_ = torch.tensor(np.expand_dims(image, axis=0)).float()
-        if self.transform:
-            input_ = self.transform(input_).to(self.device)
-
-        self.model.eval()
-        with torch.no_grad():
-            self.model.layer4.register_forward_hook(get_activation("layer4"))
-                        
-            output = self.model(input_)
-            score = torch.nn.functional.sigmoid(output)
-            prediction = (score > self.threshold)
-
-        if prediction:
-            fc_weights = self.model.fc.weight.unsqueeze(2).unsqueeze(3)
-            cam = (fc_weights * self.activation["layer4"]).sum(1, keepdim=True)
-
-            cam = torch.where(cam <= torch.quantile(cam, self.quantile), 0, cam)
-            cam = F.interpolate(cam, image.shape[1:3], mode="bilinear", align_corners=True)
-            cam = cam.detach().cpu().numpy()[0,0,:,:]
-            cam = (cam - np.min(cam)) / (np.max(cam) - np.min(cam))
-            
-            # Avoid saving hook in case of double-quering
-            self.activation = {}
+        return self.make_batch_query([image])[0]
+
+    def make_batch_query(self, images: List[np.array],
+                               quantiles: Optional[List[float]] = None,
+                               return_raw: bool = False,
+                               timings: Optional[dict] = None) -> list:
+        '''
+        Query pipeline for several images in a single forward pass.
+
+        Parameters
+        ----------
+        images : list
+            3D arrays of the same shape (RGB images, channels first).
+        quantiles : list, optional
+            Pixel-wise threshold for each image. By default, the query quantile.
+            A None quantile skips the explainability map of its image.
+        return_raw : bool
+            Also return the raw class activation map of each image (see
+            `query_from_raw`).
+        timings : dict, optional
+            Filled with the duration (seconds) of the preprocess, forward and
+            cam stages of the batch.
+
+        Returns
+        -------
+        A list with a (prediction, score, cam) tuple per image, as in `make_query`,
+        or (prediction, score, cam, raw_cam) tuples if `return_raw` is set.
+        '''
+        if quantiles is None:
+            quantiles = [self.quantile] * len(images)
+        for q in quantiles:
+            if q is not None:
+                self._validate_quantile(q)
+
+        start = time.perf_counter()
+        if self.preprocessor is not None:
+            input_ = self.preprocessor.batch(images)
         else:
-            cam = None
+            input_ = torch.tensor(np.stack(images)).float()
+            if self.transform:
+                input_ = self.transform(input_)
+            input_ = input_.to(self.device)
+
+        preprocessed = time.perf_counter()
+
+        if isinstance(self.model, nn.Module):
+            self.model.eval()
+        output, cam = self.extractor(input_)
+        scores = torch.nn.functional.sigmoid(output).view(-1)
+        predictions = (scores > self.threshold)
+        forwarded = time.perf_counter()
 
-        return (prediction.squeeze().item(), score.squeeze().item(), cam)
+        cams = [None] * len(images)
+        positives = [i for i in predictions.nonzero().view(-1).tolist()
+                     if quantiles[i] is not None]
+        if positives:
+            positive_cams = self.compute_cam(cam[positives], images[0].shape[1:3],
+                                             [quantiles[i] for i in positives])
+            for i, positive_cam in zip(positives, positive_cams):
+                cams[i] = positive_cam
+
+        if timings is not None:
+            timings['preprocess'] = preprocessed - start
+            timings['forward'] = forwarded - preprocessed
+            timings['cam'] = time.perf_counter() - forwarded
+
+        results = list(zip(predictions.tolist(), scores.tolist(), cams))
+        if return_raw:
+            raw_cams = cam[:,0].detach().cpu().numpy()
+            results = [result + (raw_cam,) for result, raw_cam in zip(results, raw_cams)]
+        return results
+
+    def query_from_raw(self, score: float, raw_cam: np.ndarray,
+                       shape: Tuple[int, int],
+                       quantile: Optional[float] = None):
+        '''
+        Query result from a previous forward pass, without running the model.
+
+        Parameters
+        ----------
+        score : float
+            Classification score.
+        raw_cam : ndarray
+            Raw class activation map (h, w), as returned by `make_batch_query`.
+        shape : tuple
+            (height, width) of the explainability map.
+        quantile : float, optional
+            Pixel-wise threshold. None skips the explainability map.
+
+        Returns
+        -------
+        (prediction, score, cam) as in `make_query`.
+        '''
+        prediction = score > self.threshold
+        cam = None
+        if prediction and quantile is not None:
+            self._validate_quantile(quantile)
+            raw_cam = torch.from_numpy(np.array(raw_cam))[None,None]
+            cam = self.compute_cam(raw_cam, shape, [quantile])[0]
+        return prediction, score, cam
@@ -0,0 +1,134 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import threading
+import time
+from typing import Any, Optional, Tuple
+
+import torch
+
+from classification_model.engines import load_engine
+
+class ModelRegistry():
+    '''
+    Process-level holder of the served model.
+
+    The checkpoint is deserialized once, moved to the device and warmed up
+    with a dummy forward pass before it is published. Swapping a version is
+    atomic: callers take a (version, model) snapshot with `current()` and
+    keep using it, so in-flight queries finish on the model they started with.
+    '''
+    def __init__(self, device: str = 'cpu',
+                       input_size: int = 512,
+                       backend: str = 'eager',
+                       channels_last: bool = False):
+
+        self.device = device
+        self.input_size = input_size
+        # 'eager' (torch.save checkpoints) or an exported model backend
+        # (see engines.py); the published model is then the engine.
+        self.backend = backend
+        # NHWC memory format for the eager model (inputs should match, see
+        # Preprocessor); exported models keep the format they were traced with.
+        self.channels_last = channels_last
+
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._version = None
+        self._model = None
+        self._loading = None
+        self._error = None
+        self._load_seconds = None
+
+    @property
+    def ready(self) -> bool:
+        ''' True once a warm model is published.'''
+        with self._lock:
+            return self._model is not None
+
+    def current(self) -> Tuple[Optional[str], Optional[Any]]:
+        ''' Snapshot of the published (version, model) pair.'''
+        with self._lock:
+            return self._version, self._model
+
+    def status(self) -> dict:
+        with self._lock:
+            return {'ready': self._model is not None,
+                    'version': self._version,
+                    'loading': self._loading,
+                    'error': self._error,
+                    'load_seconds': self._load_seconds}
+
+    def load(self, version: str, path: str):
+        '''
+        Load, warm up and publish a checkpoint.
+
+        Parameters
+        ----------
+        version : str
+            Identifier reported with every prediction made by this model.
+        path : str
+            Path of the serialized model (full module, as saved by torch.save),
+            or of the exported model for other backends.
+
+        Returns
+        -------
+        The published model. The previous one is released once the
+        queries holding a reference to it are done.
+        '''
+        with self._load_lock:
+            with self._lock:
+                self._loading = version
+                self._error = None
+            start = time.perf_counter()
+            try:
+                if self.backend == 'eager':
+                    model = torch.load(path, map_location=torch.device(self.device),
+                                       weights_only=False)
+                    model = model.to(self.device)
+                    if self.channels_last:
+                        model = model.to(memory_format=torch.channels_last)
+                    model.eval()
+                else:
+                    model = load_engine(self.backend, path, self.device)
+                self._warm_up(model)
+            except Exception as e:
+                with self._lock:
+                    self._loading = None
+                    self._error = f'{type(e).__name__}: {e}'
+                raise
+
+            with self._lock:
+                self._version = version
+                self._model = model
+                self._loading = None
+                # Deserialization and warm-up of the published model.
+                self._load_seconds = time.perf_counter() - start
+        return model
+
+    def load_async(self, version: str, path: str) -> threading.Thread:
+        ''' Same as `load` but in a background thread (errors go to `status`).'''
+        def target():
+            try:
+                self.load(version, path)
+            except Exception:
+                pass
+
+        thread = threading.Thread(target=target, name=f'model-load-{version}',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def warm_up(self):
+        ''' Forward pass of the published model, e.g. in a newly forked process.'''
+        _, model = self.current()
+        if model is not None:
+            self._warm_up(model)
+
+    def _warm_up(self, model):
+        # First forward pass allocates buffers and picks kernels.
+        x = torch.zeros((1, 3, self.input_size, self.input_size),
+                        device=self.device)
+        if self.channels_last:
+            x = x.to(memory_format=torch.channels_last)
+        with torch.no_grad():
+            model(x)
@@ -0,0 +1,60 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import collections
+import hashlib
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+
+class ResultCache():
+    '''
+    LRU cache of model outputs, keyed by (tile content, model version).
+
+    Each entry keeps the classification score and the raw class activation
+    map at `layer4` resolution (a few hundred floats), which is everything
+    the quantile-dependent post-processing needs: changing the quantile of a
+    known tile doesn't run the model again.
+    '''
+    def __init__(self, max_items: int = 4096):
+        self.max_items = max_items
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def image_key(image: np.ndarray) -> str:
+        ''' Content hash of a decoded tile.'''
+        digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16)
+        digest.update(str(image.shape).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key: str, version: str) -> Optional[Tuple[float, np.ndarray]]:
+        ''' (score, raw cam) of a tile, or None.'''
+        with self._lock:
+            entry = self._entries.get((key, version))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((key, version))
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, version: str, score: float, cam: np.ndarray):
+        cam.flags.writeable = False
+        with self._lock:
+            self._entries[(key, version)] = (score, cam)
+            self._entries.move_to_end((key, version))
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.,
+                    'items': len(self._entries),
+                    'max_items': self.max_items}
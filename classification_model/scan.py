@@ -0,0 +1,75 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+def iter_scan(tiles: Iterable[Any],
+              process: Callable[[Any], Any],
+              max_workers: int = 8,
+              window: Optional[int] = None) -> Iterator[Tuple[Any, Any, Optional[Exception]]]:
+    '''
+    Streams `process(tile)` over many tiles.
+
+    Tiles are consumed lazily and at most `window` of them (default: twice
+    the workers) are in progress or waiting to be read, so memory doesn't
+    grow with the number of tiles. Results are yielded in input order.
+
+    Yields
+    ------
+    (tile, result, error) tuples; `error` is the exception raised by
+    `process` (and `result` None) when it failed.
+    '''
+    window = window or 2 * max_workers
+    pending = collections.deque()
+
+    def pop():
+        tile, future = pending.popleft()
+        try:
+            return tile, future.result(), None
+        except Exception as e:
+            return tile, None, e
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for tile in tiles:
+            pending.append((tile, pool.submit(process, tile)))
+            if len(pending) >= window:
+                yield pop()
+        while pending:
+            yield pop()
+    finally:
+        # Also reached when the consumer stops early (e.g. client disconnected).
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def iter_cascade(grids: List[Any],
+                 process: Callable[[dict], Any],
+                 descend: Callable[[Any], bool],
+                 max_workers: int = 8,
+                 window: Optional[int] = None) -> Iterator[Tuple[dict, Any, Optional[Exception], bool]]:
+    '''
+    Coarse-to-fine scan of an area.
+
+    Every tile of the first (coarsest) grid is processed; only the tiles for
+    which `descend(result)` is true (or whose processing failed) are refined
+    with their children in the next grid, and so on down to the last grid.
+    See tiling.TileGrid (`finer` builds the next grid).
+
+    Yields
+    ------
+    (tile, result, error, final) tuples, level by level; tiles get their
+    `zoom`, and `final` is set for the tiles of the last grid.
+    '''
+    tiles = [dict(tile, zoom=grids[0].zoom) for tile in grids[0]]
+    for level, grid in enumerate(grids):
+        final = level == len(grids) - 1
+        refine = []
+        for tile, result, error in iter_scan(tiles, process, max_workers, window):
+            yield tile, result, error, final
+            if not final and (error is not None or descend(result)):
+                refine.append(tile)
+
+        if not final:
+            finer = grids[level + 1]
+            tiles = [dict(child, zoom=finer.zoom)
+                     for tile in refine for child in grid.children(tile, finer)]
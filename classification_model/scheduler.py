@@ -0,0 +1,124 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import collections
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+
+class BatchScheduler():
+    '''
+    Dynamic micro-batching of concurrent queries.
+
+    Items submitted from any thread are queued and a single worker thread
+    groups them: a batch is run as soon as `max_batch_size` items are pending
+    or the oldest pending item has waited `max_wait` seconds. `run_batch`
+    receives the list of items and must return one result per item (same
+    order); every caller gets its own result through a Future. Items whose
+    deadline passed while queued are dropped (TimeoutError) before the batch
+    runs.
+    '''
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]],
+                       max_batch_size: int = 8,
+                       max_wait: float = 0.010):
+
+        if max_batch_size < 1:
+            raise ValueError("The batch size must be at least 1.")
+        if max_wait < 0:
+            raise ValueError("The waiting time must be positive.")
+
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._reset()
+        # Threads don't survive a fork: start again (lazily) in the child.
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._thread = None
+        self._batches = 0
+        self._items = 0
+        self._expired = 0
+        self._max_queue_depth = 0
+        self._batch_sizes = collections.Counter()
+
+    def submit(self, item: Any, deadline: Optional[float] = None) -> Future:
+        '''
+        Queue an item, its result is set on the returned Future.
+        `deadline`: optional time.monotonic() after which it isn't run.
+        '''
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop,
+                                                name='batch-scheduler',
+                                                daemon=True)
+                self._thread.start()
+            self._queue.append((time.monotonic(), item, future, deadline))
+            self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+            self._cond.notify()
+        return future
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {'queue_depth': len(self._queue),
+                    'max_queue_depth': self._max_queue_depth,
+                    'batches': self._batches,
+                    'items': self._items,
+                    'expired': self._expired,
+                    'mean_batch_size': self._items / self._batches if self._batches else 0.,
+                    'batch_sizes': dict(sorted(self._batch_sizes.items())),
+                    'max_batch_size': self.max_batch_size,
+                    'max_wait': self.max_wait}
+
+    def _next_batch(self) -> list:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+
+            deadline = self._queue[0][0] + self.max_wait
+            while len(self._queue) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            n = min(len(self._queue), self.max_batch_size)
+            batch = [self._queue.popleft() for _ in range(n)]
+
+            self._batches += 1
+            self._items += n
+            self._batch_sizes[n] += 1
+        return batch
+
+    def _loop(self):
+        while True:
+            pending = self._next_batch()
+            # After the wait: the queue may have been idle for long.
+            now = time.monotonic()
+            batch = []
+            for _, item, future, deadline in pending:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if deadline is not None and now > deadline:
+                    future.set_exception(TimeoutError('Deadline passed before inference.'))
+                    with self._cond:
+                        self._expired += 1
+                    continue
+                batch.append((item, future))
+            if not batch:
+                continue
+
+            try:
+                results = self.run_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,64 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import threading
+from concurrent.futures import Future, wait
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+class SingleFlight():
+    '''
+    Coalescing of concurrent calls with the same key.
+
+    The first caller of a key (the leader) runs the function; callers with
+    the same key arriving while it runs wait for it and get the same result
+    (or exception) instead of running it again. Once the leader is done the
+    key is forgotten: results are not cached.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any],
+           timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        '''
+        A caller waiting for another one's run gives up after `timeout`
+        seconds (TimeoutError); the run goes on for the others.
+
+        Returns
+        -------
+        (result, shared): the result of `fn`, and whether it came from
+        another caller's run.
+        '''
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            done, _ = wait([future], timeout)
+            if not done:
+                raise TimeoutError('Timed out waiting for the coalesced call.')
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'leaders': self.leaders,
+                    'coalesced': self.coalesced,
+                    'in_flight': len(self._calls)}
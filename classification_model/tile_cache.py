@@ -0,0 +1,165 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+class TileCache():
+    '''
+    Two-tier cache of satellite tiles.
+
+    Disk tier: the downloaded (encoded) image of each request, one file per
+    (lat, lon, zoom, size, maptype) key, bounded by `max_bytes` with LRU
+    eviction. Memory tier: the last `memory_items` decoded arrays.
+    Entries older than `ttl` seconds are ignored (and removed) in both tiers.
+    '''
+    def __init__(self, directory: str,
+                       max_bytes: int = 1 << 30,
+                       ttl: float = 7 * 24 * 3600,
+                       memory_items: int = 128):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.memory_items = memory_items
+
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()  # key -> (time, array)
+        self._files = collections.OrderedDict()   # key -> size, LRU order
+        self._total_bytes = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def key(center: Tuple[float, float], zoom: int, size: int, maptype: str) -> str:
+        ''' Cache key of a tile request.'''
+        lat, lon = center
+        params = f'{float(lat)!r},{float(lon)!r},{zoom},{size},{maptype}'
+        return hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.tile')
+
+    def _scan(self):
+        # Rebuild the index from a previous run (oldest files first).
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.tile'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len('.tile')], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._files[key] = size
+            self._total_bytes += size
+        with self._lock:
+            self._evict()
+
+    def _expired(self, created: float) -> bool:
+        return time.time() - created > self.ttl
+
+    def _remove(self, key: str):
+        size = self._files.pop(key, None)
+        if size is not None:
+            self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._files:
+            key = next(iter(self._files))
+            self._remove(key)
+            self.evictions += 1
+
+    def get_array(self, key: str) -> Optional[np.ndarray]:
+        ''' Decoded tile from the memory tier (read-only), or None.'''
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            created, array = entry
+            if self._expired(created):
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return array
+
+    def put_array(self, key: str, array: np.ndarray) -> np.ndarray:
+        ''' Keep a decoded tile in memory, returns the (read-only) cached array.'''
+        array.flags.writeable = False
+        with self._lock:
+            self._memory[key] = (time.time(), array)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+        return array
+
+    def get(self, key: str) -> Optional[bytes]:
+        ''' Encoded tile from the disk tier, or None.'''
+        path = self._path(key)
+        with self._lock:
+            try:
+                created = os.path.getmtime(path)
+                if self._expired(created):
+                    self._remove(key)
+                    content = None
+                else:
+                    with open(path, 'rb') as f:
+                        content = f.read()
+            except FileNotFoundError:
+                # Evicted by another process sharing the directory.
+                self._files.pop(key, None)
+                content = None
+
+            if content is None:
+                self.misses += 1
+                return None
+
+            if key not in self._files:
+                self._files[key] = len(content)
+                self._total_bytes += len(content)
+            self._files.move_to_end(key)
+            self.disk_hits += 1
+            return content
+
+    def put(self, key: str, content: bytes):
+        # Write + rename, so readers never see partial files.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, self._path(key))
+
+        with self._lock:
+            old_size = self._files.pop(key, None)
+            if old_size is not None:
+                self._total_bytes -= old_size
+            self._files[key] = len(content)
+            self._total_bytes += len(content)
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {'memory_hits': self.memory_hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'hit_rate': hits / lookups if lookups else 0.,
+                    'evictions': self.evictions,
+                    'memory_items': len(self._memory),
+                    'disk_items': len(self._files),
+                    'disk_bytes': self._total_bytes}
@@ -0,0 +1,96 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+# Local stand-in for the Google Static Maps API (tests and benchmarks).
+# It answers the same query parameters (center, zoom, size, maptype) with
+# images from a directory or, without one, with synthetic noise tiles.
+#
+#   PYTHONPATH=.. python tile_server.py --port 8001 --dir ./tiles
+#
+# and set `tile_provider = 'http'`, `tile_provider_url = 'http://localhost:8001/staticmap'`
+# in settings.py.
+
+import argparse
+import hashlib
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+
+from classification_model.providers import FileSystemTileProvider
+
+def synthetic_tile(center: str, zoom: int, size: int) -> bytes:
+    ''' Deterministic noise PNG for the given request.'''
+    seed = int(hashlib.sha256(f'{center},{zoom}'.encode('utf-8')).hexdigest()[:8], 16)
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    byte_buffer = io.BytesIO()
+    Image.fromarray(image).save(byte_buffer, format='PNG')
+    return byte_buffer.getvalue()
+
+def make_handler(provider=None, latency: float = 0., error_rate: float = 0.):
+    rng_lock = threading.Lock()
+    rng = np.random.default_rng(0)
+
+    class TileHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            params = parse_qs(urlparse(self.path).query)
+            try:
+                center = params['center'][0]
+                zoom = int(params.get('zoom', ['18'])[0])
+                size = int(params.get('size', ['512x512'])[0].split('x')[0])
+                maptype = params.get('maptype', ['satellite'])[0]
+                location = tuple(map(float, center.split(',')))
+            except (KeyError, ValueError):
+                self.send_error(400)
+                return
+
+            if latency > 0:
+                time.sleep(latency)
+            with rng_lock:
+                fail = rng.random() < error_rate
+            if fail:
+                self.send_error(503)
+                return
+
+            if provider is not None:
+                content = provider.fetch(location, zoom, size, maptype)
+            else:
+                content = synthetic_tile(center, zoom, size)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return TileHandler
+
+def make_server(port: int = 8001, directory: str = '', latency: float = 0.,
+                error_rate: float = 0.) -> ThreadingHTTPServer:
+    provider = FileSystemTileProvider(directory) if directory else None
+    handler = make_handler(provider, latency, error_rate)
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--dir', type=str, default='',
+                        help='Directory of tiles (synthetic tiles if empty).')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='Seconds added to every answer.')
+    parser.add_argument('--error-rate', type=float, default=0.,
+                        help='Fraction of requests answered with a 503.')
+    args = parser.parse_args()
+
+    server = make_server(args.port, args.dir, args.latency, args.error_rate)
+    print(f'Serving tiles on http://127.0.0.1:{args.port}/staticmap')
+    server.serve_forever()
@@ -0,0 +1,193 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import math
+from typing import Iterator, List, Optional, Tuple
+
+# Web Mercator world size (pixels) at zoom 0, as used by the Static Maps API.
+WORLD_SIZE = 256
+MAX_LATITUDE = 85.05112878
+
+def latlon_to_pixel(lat: float, lon: float, zoom: int) -> Tuple[float, float]:
+    ''' Global Web Mercator pixel coordinates (x, y) at the given zoom.'''
+    lat = min(max(lat, -MAX_LATITUDE), MAX_LATITUDE)
+    scale = WORLD_SIZE * 2 ** zoom
+    x = (lon + 180.) / 360. * scale
+    sin_lat = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+def pixel_to_latlon(x: float, y: float, zoom: int) -> Tuple[float, float]:
+    ''' Inverse of `latlon_to_pixel`.'''
+    scale = WORLD_SIZE * 2 ** zoom
+    lon = x / scale * 360. - 180.
+    n = math.pi - 2 * math.pi * y / scale
+    lat = math.degrees(math.atan(math.sinh(n)))
+    return lat, lon
+
+def geometry_polygons(geometry: dict) -> List[List[List[Tuple[float, float]]]]:
+    '''
+    Polygons of a GeoJSON Polygon, MultiPolygon, Feature or
+    FeatureCollection, as lists of rings of (lon, lat) points.
+    '''
+    kind = geometry.get('type')
+    if kind == 'FeatureCollection':
+        return [polygon for feature in geometry['features']
+                for polygon in geometry_polygons(feature)]
+    if kind == 'Feature':
+        return geometry_polygons(geometry['geometry'])
+    if kind == 'Polygon':
+        return [[[tuple(p[:2]) for p in ring] for ring in geometry['coordinates']]]
+    if kind == 'MultiPolygon':
+        return [[[tuple(p[:2]) for p in ring] for ring in polygon]
+                for polygon in geometry['coordinates']]
+    raise ValueError(f'Unsupported geometry type ({kind}).')
+
+def polygons_bbox(polygons) -> Tuple[float, float, float, float]:
+    ''' (min_lon, min_lat, max_lon, max_lat) of the polygons.'''
+    points = [p for polygon in polygons for p in polygon[0]]
+    lons = [p[0] for p in points]
+    lats = [p[1] for p in points]
+    return min(lons), min(lats), max(lons), max(lats)
+
+def _point_in_rings(x, y, rings) -> bool:
+    # Even-odd rule over the outer ring and its holes.
+    inside = False
+    for ring in rings:
+        n = len(ring)
+        for i in range(n):
+            x1, y1 = ring[i]
+            x2, y2 = ring[(i + 1) % n]
+            if (y1 > y) != (y2 > y):
+                if x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                    inside = not inside
+    return inside
+
+def _segment_hits_box(p, q, box) -> bool:
+    # Liang-Barsky clipping of the segment p-q against the box.
+    x0, y0, x1, y1 = box
+    t0, t1 = 0., 1.
+    dx, dy = q[0] - p[0], q[1] - p[1]
+    for d, r in ((-dx, p[0] - x0), (dx, x1 - p[0]),
+                 (-dy, p[1] - y0), (dy, y1 - p[1])):
+        if d == 0:
+            if r < 0:
+                return False
+            continue
+        t = r / d
+        if d < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 > t1:
+            return False
+    return True
+
+def _box_intersects_polygon(box, rings) -> bool:
+    x0, y0, x1, y1 = box
+    if _point_in_rings((x0 + x1) / 2, (y0 + y1) / 2, rings):
+        return True
+    for ring in rings:
+        n = len(ring)
+        for i in range(n):
+            if _segment_hits_box(ring[i], ring[(i + 1) % n], box):
+                return True
+    return False
+
+class TileGrid():
+    '''
+    Non-overlapping grid of `size` x `size` tiles covering an area at a zoom
+    (see `tile_grid`).
+
+    The grid is anchored at the north-west corner of the area, so tile
+    (row, col) at `zoom` is exactly covered by tiles (2 row + i, 2 col + j),
+    i, j in {0, 1}, of the grid of the same area at `zoom + 1` (`children`).
+    '''
+    def __init__(self, bbox: Tuple[float, float, float, float],
+                       zoom: int,
+                       size: int = 512,
+                       polygons: Optional[list] = None):
+
+        min_lon, min_lat, max_lon, max_lat = bbox
+        self.bbox = bbox
+        self.zoom = zoom
+        self.size = size
+        self.x0, self.y0 = latlon_to_pixel(max_lat, min_lon, zoom)
+        x1, y1 = latlon_to_pixel(min_lat, max_lon, zoom)
+        self.cols = max(1, math.ceil((x1 - self.x0) / size))
+        self.rows = max(1, math.ceil((y1 - self.y0) / size))
+
+        # Polygons in pixel coordinates, computed once.
+        self.polygons = None
+        if polygons is not None:
+            self.polygons = [[[latlon_to_pixel(lat, lon, zoom) for lon, lat in ring]
+                              for ring in polygon] for polygon in polygons]
+        self._polygons = polygons
+
+    def tile(self, row: int, col: int) -> Optional[dict]:
+        ''' Tile (row, col), None if out of the grid or of the polygons.'''
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            return None
+        size = self.size
+        box = (self.x0 + col * size, self.y0 + row * size,
+               self.x0 + (col + 1) * size, self.y0 + (row + 1) * size)
+        if self.polygons is not None and not any(_box_intersects_polygon(box, rings)
+                                                 for rings in self.polygons):
+            return None
+        center = pixel_to_latlon((box[0] + box[2]) / 2, (box[1] + box[3]) / 2, self.zoom)
+        return {'row': row, 'col': col, 'location': center}
+
+    def __iter__(self) -> Iterator[dict]:
+        for row in range(self.rows):
+            for col in range(self.cols):
+                tile = self.tile(row, col)
+                if tile is not None:
+                    yield tile
+
+    def __len__(self) -> int:
+        if self.polygons is None:
+            return self.rows * self.cols
+        return sum(1 for _ in self)
+
+    def finer(self) -> 'TileGrid':
+        ''' Grid of the same area at the next zoom.'''
+        return TileGrid(self.bbox, self.zoom + 1, self.size, self._polygons)
+
+    def children(self, tile: dict, finer: 'TileGrid') -> List[dict]:
+        ''' Tiles of `finer` (see `finer`) covering `tile`.'''
+        row, col = tile['row'], tile['col']
+        children = [finer.tile(2 * row + i, 2 * col + j) for i in (0, 1) for j in (0, 1)]
+        return [child for child in children if child is not None]
+
+def tile_grid(bbox: Tuple[float, float, float, float],
+              zoom: int,
+              size: int = 512,
+              polygons: Optional[list] = None) -> Iterator[dict]:
+    '''
+    Non-overlapping grid of `size` x `size` tiles covering an area.
+
+    Parameters
+    ----------
+    bbox : tuple
+        (min_lon, min_lat, max_lon, max_lat) of the area.
+    zoom : int
+        Zoom level of the tiles.
+    size : int
+        Tile side in pixels (as requested to the Static Maps API).
+    polygons : list, optional
+        Polygons (see `geometry_polygons`); tiles that don't intersect any of
+        them are skipped.
+
+    Yields
+    ------
+    dict with the `row`, `col` and `location` (lat, lon) of each tile centre,
+    row by row from the north-west corner.
+    '''
+    return iter(TileGrid(bbox, zoom, size, polygons))
+
+def grid_shape(bbox: Tuple[float, float, float, float], zoom: int,
+               size: int = 512) -> Tuple[int, int]:
+    ''' (rows, cols) of the `tile_grid` of a bounding box.'''
+    min_lon, min_lat, max_lon, max_lat = bbox
+    x0, y0 = latlon_to_pixel(max_lat, min_lon, zoom)
+    x1, y1 = latlon_to_pixel(min_lat, max_lon, zoom)
+    return max(1, math.ceil((y1 - y0) / size)), max(1, math.ceil((x1 - x0) / size))
@@ -0,0 +1,143 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import collections
+from typing import List, Tuple
+
+import numpy as np
+
+from classification_model.tiling import latlon_to_pixel, pixel_to_latlon
+
+# Unit steps (row, col) of the 4-neighbourhood.
+NEIGHBOURS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+def mask_components(mask: np.ndarray) -> List[List[Tuple[int, int]]]:
+    ''' Cells (row, col) of each 4-connected component of a boolean mask.'''
+    rows, cols = mask.shape
+    seen = np.zeros_like(mask, dtype=bool)
+    components = []
+    for start in map(tuple, np.argwhere(mask).tolist()):
+        if seen[start]:
+            continue
+        seen[start] = True
+        component, stack = [], [start]
+        while stack:
+            r, c = stack.pop()
+            component.append((r, c))
+            for dr, dc in NEIGHBOURS:
+                n = (r + dr, c + dc)
+                if 0 <= n[0] < rows and 0 <= n[1] < cols and mask[n] and not seen[n]:
+                    seen[n] = True
+                    stack.append(n)
+        components.append(component)
+    return components
+
+def component_rings(cells: List[Tuple[int, int]]) -> List[List[Tuple[int, int]]]:
+    '''
+    Boundary rings of a set of cells, as closed lists of cell corners
+    (row, col). With north up, the outer ring is counterclockwise and holes
+    are clockwise (the GeoJSON right-hand rule); collinear corners are
+    dropped.
+    '''
+    cells = set(cells)
+    # Boundary edges oriented with the cells on their left.
+    edges = collections.defaultdict(list)
+    for r, c in cells:
+        if (r + 1, c) not in cells:
+            edges[(r + 1, c)].append((r + 1, c + 1))
+        if (r, c + 1) not in cells:
+            edges[(r + 1, c + 1)].append((r, c + 1))
+        if (r - 1, c) not in cells:
+            edges[(r, c + 1)].append((r, c))
+        if (r, c - 1) not in cells:
+            edges[(r, c)].append((r + 1, c))
+
+    rings = []
+    while edges:
+        start = next(iter(edges))
+        ring = [start]
+        previous, current = start, edges[start].pop()
+        if not edges[start]:
+            del edges[start]
+        while current != start:
+            ring.append(current)
+            ends = edges[current]
+            if len(ends) > 1:
+                # Corner shared by two diagonal cells: turn towards the
+                # other cell, keeping them joined, so the empty cells on
+                # either side get separate rings (a hole touching the outer
+                # ring at a corner is its own interior ring).
+                direction = (current[0] - previous[0], current[1] - previous[1])
+                right = (direction[1], -direction[0])
+                end = next((e for e in ends
+                            if (e[0] - current[0], e[1] - current[1]) == right), ends[0])
+                ends.remove(end)
+            else:
+                end = ends.pop()
+            if not ends:
+                del edges[current]
+            previous, current = current, end
+        rings.append(_drop_collinear(ring))
+    return rings
+
+def _drop_collinear(ring):
+    n = len(ring)
+    corners = []
+    for i in range(n):
+        (r0, c0), (r1, c1), (r2, c2) = ring[i - 1], ring[i], ring[(i + 1) % n]
+        if (r1 - r0) * (c2 - c1) != (c1 - c0) * (r2 - r1):
+            corners.append(ring[i])
+    return corners + corners[:1]
+
+def _signed_area(ring) -> float:
+    # Shoelace in (x=col, y=-row): positive for counterclockwise rings.
+    return sum(c0 * -r1 - c1 * -r0 for (r0, c0), (r1, c1) in zip(ring, ring[1:])) / 2.
+
+def grid_polygons(grid: np.ndarray,
+                  location: Tuple[float, float],
+                  zoom: int,
+                  shape: Tuple[int, int]) -> dict:
+    '''
+    Detection regions of an explainability map as GeoJSON.
+
+    Parameters
+    ----------
+    grid : ndarray
+        (h, w) map covering the tile, e.g. from `ModelQuery.compute_grid`;
+        non-zero cells are detections.
+    location : tuple
+        (lat, lon) of the tile centre.
+    zoom : int
+        Zoom of the tile.
+    shape : tuple
+        (height, width) of the tile in pixels.
+
+    Returns
+    -------
+    A FeatureCollection with a Polygon (lon, lat) per 4-connected region,
+    with the `cells`, `max` and `mean` of its values as properties.
+    '''
+    grid = np.asarray(grid)
+    h, w = grid.shape
+    x, y = latlon_to_pixel(*location, zoom)
+    x0, y0 = x - shape[1] / 2, y - shape[0] / 2
+    cell_h, cell_w = shape[0] / h, shape[1] / w
+
+    def corner(r, c):
+        lat, lon = pixel_to_latlon(x0 + c * cell_w, y0 + r * cell_h, zoom)
+        return [float(lon), float(lat)]
+
+    features = []
+    for cells in mask_components(grid > 0):
+        rings = component_rings(cells)
+        # A component has a single outer ring, the others are holes.
+        outer = max(range(len(rings)), key=lambda i: _signed_area(rings[i]))
+        rings.insert(0, rings.pop(outer))
+        values = grid[tuple(np.array(cells).T)]
+        features.append({'type': 'Feature',
+                         'geometry': {'type': 'Polygon',
+                                      'coordinates': [[corner(r, c) for r, c in ring]
+                                                      for ring in rings]},
+                         'properties': {'cells': len(cells),
+                                        'max': float(values.max()),
+                                        'mean': float(values.mean())}})
+    return {'type': 'FeatureCollection', 'features': features}
@@ -1,21 +1,133 @@
 # Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
 
+# Client of the /predict endpoint.
+#
+# Without arguments it runs a few example requests (positive, negative and
+# invalid inputs) and prints the responses. With a coordinates file it is a
+# load generator: the locations are replayed (cyclically) against the
+# server, either by `--concurrency` clients sending one request after the
+# other (closed loop) or at `--rate` requests per second whatever the
+# response times (open loop), and throughput, errors and latency
+# percentiles are reported:
+#
+#   python client_request.py --locations locations.csv --concurrency 8 --duration 30
+#   python client_request.py --locations locations.csv --rate 20 --duration 30 --format scores
+#
+# The coordinates file is a CSV with `latitude` and `longitude` columns (and
+# optional `zoom` and `quantile` ones), as for classification_model/main.py
+# --input. Against a local server use a stand-in tile provider (see
+# classification_model/tile_server.py) not to load the maps API.
+
+import argparse
+import csv
 import json
 import base64
 from PIL import Image
 import io
+import random
+import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import requests
 
 from read_the_output import image_bytes_to_numpy
 
+# Upper bounds (milliseconds) of the reported latency histogram.
+HISTOGRAM_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+def parse_multipart(response):
+    '''
+    (headers, body) of each part of a multipart/mixed response, header
+    names in lower case. Raises ValueError if the response is malformed.
+    '''
+    match = re.search(r'boundary=([^;\s]+)', response.headers.get('Content-Type', ''))
+    if match is None:
+        raise ValueError('Multipart response without boundary.')
+    chunks = response.content.split(b'--' + match.group(1).encode('utf-8'))
+    if len(chunks) < 3 or chunks[-1].strip() != b'--':
+        raise ValueError('Truncated multipart response.')
+
+    parts = []
+    for chunk in chunks[1:-1]:
+        head, separator, body = chunk[2:].partition(b'\r\n\r\n')
+        if not chunk.startswith(b'\r\n') or not separator or not body.endswith(b'\r\n'):
+            raise ValueError('Malformed multipart part.')
+        headers = {}
+        for line in head.decode('utf-8').split('\r\n'):
+            name, _, value = line.partition(': ')
+            headers[name.lower()] = value
+        parts.append((headers, body[:-2]))
+    return parts
+
+def parse_response(response, decode_images=True):
+    '''
+    Contents of a /predict JSON (or multipart) response: the top-level
+    fields, the data fields and the shape of the decoded images. Raises
+    ValueError if the response is malformed.
+    '''
+    attachments = {}
+    text = response.text
+    if response.headers.get('Content-Type', '').startswith('multipart/mixed'):
+        # A JSON part, then the images as binary parts.
+        parts = parse_multipart(response)
+        if not parts[0][0].get('content-type', '').startswith('application/json'):
+            raise ValueError('Multipart response without a JSON part.')
+        text = parts[0][1].decode('utf-8')
+        for headers, body in parts[1:]:
+            name = re.search(r'name="([^"]+)"', headers.get('content-disposition', ''))
+            if name is None:
+                raise ValueError('Multipart image without name.')
+            attachments[name.group(1)] = body
+
+    try:
+        content = json.loads(text)
+    except ValueError:
+        raise ValueError(f'Invalid JSON response ({response.headers.get("Content-Type")}).')
+    if not isinstance(content, dict) or 'status' not in content:
+        raise ValueError('Response without status.')
+
+    data = content.get('data')
+    images = {}
+    if data is not None:
+        if content['status'] == 'success':
+            if not isinstance(data.get('prediction'), bool):
+                raise ValueError('Response without prediction.')
+            if not isinstance(data.get('score'), float):
+                raise ValueError('Response without score.')
+        for k in ['input_image', 'output_image']:
+            if data.get(k) is not None and decode_images:
+                im = base64.b64decode(data[k])
+                images[k] = image_bytes_to_numpy(im).shape
+    if decode_images:
+        for k, im in attachments.items():
+            images[k] = image_bytes_to_numpy(im).shape
+    return content, images
+
+def check_response(response, decode_images=False):
+    ''' None if the response is a valid success, otherwise the problem.'''
+    if response.status_code != 200:
+        return f'HTTP {response.status_code}'
+    if response.headers.get('Content-Type', '').startswith('image/'):
+        # `image` format: the data is in the headers.
+        if response.headers.get('X-Prediction') not in ('true', 'false'):
+            return 'Image response without X-Prediction.'
+        return None
+    try:
+        content, _ = parse_response(response, decode_images)
+    except ValueError as e:
+        return str(e)
+    if content['status'] != 'success':
+        return f'Status {content["status"]}'
+    return None
+
 def show_response(response):
-    content = response.content
     status_code = response.status_code
 
     print('>>', 'status code: ', status_code)
-    content = json.loads(response.text)
+    content, images = parse_response(response)
 
     for k in content.keys():
         if k not in  ['data', 'errors']:
@@ -32,66 +144,245 @@ def show_response(response):
                 print('>>', k, content['data'][k])
             else:
                 if content['data'][k] is not None:
-                    im = base64.b64decode(content['data']['input_image'])
-                    print('>> data', k.title(), image_bytes_to_numpy(im).shape)
+                    print('>> data', k.title(), images[k])
                 else:
                     print('>> data', k.title(), content['data'][k])
     if 'errors' in content.keys() and content['errors'] is not None:
         print(content['errors'])
 
-# Here are some examples for a quick verification.
-# 1. Success case with a positive detection
-print('** Success Case **')
-url = "http://localhost:5000/predict"
-data = {
-    "latitude": -34.82929722222222,
-    "longitude": -58.40813611111111,
-    "zoom": 18,
-    "quantile": 0.94
-}
-
-response = requests.post(url, json=data)
-show_response(response)
-print('')
-
-#2.  Success case with Negative detection
-print('** Success Case **')
-url = "http://localhost:5000/predict"
-data = {
-    "latitude": 37.653770,
-    "longitude": -7.54779,
-    "zoom": 18,
-    "quantile": 0.94
-}
-
-response = requests.post(url, json=data)
-show_response(response)
-print('')
-
-# 3. Bad latitude case:
-print('** Latitude Error Case **')
-url = "http://localhost:5000/predict"
-data = {
-    "latitude": 48653770,
-    "longitude": -7.54779,
-    "zoom": 18,
-    "quantile": 0.94
-}
-
-response = requests.post(url, json=data)
-show_response(response)
-print('')
-
-# 4. Bad latitude case:
-print('** Latitude Error Case 2**')
-url = "http://localhost:5000/predict"
-data = {
-    "latitude": "lalala",
-    "longitude": -7.54779,
-    "zoom": 18,
-    "quantile": 0.94
-}
-
-response = requests.post(url, json=data)
-show_response(response)
-print('')
+def examples(url):
+    ''' Some examples for a quick verification.'''
+    cases = [
+        # 1. Success case with a positive detection
+        ('** Success Case **', {"latitude": -34.82929722222222,
+                                "longitude": -58.40813611111111}),
+        # 2. Success case with Negative detection
+        ('** Success Case **', {"latitude": 37.653770,
+                                "longitude": -7.54779}),
+        # 3. Bad latitude case
+        ('** Latitude Error Case **', {"latitude": 48653770,
+                                       "longitude": -7.54779}),
+        # 4. Bad latitude case
+        ('** Latitude Error Case 2**', {"latitude": "lalala",
+                                        "longitude": -7.54779}),
+    ]
+    for title, data in cases:
+        print(title)
+        data.update({"zoom": 18, "quantile": 0.94})
+        response = requests.post(url, json=data)
+        show_response(response)
+        print('')
+
+def load_locations(path):
+    '''
+    Request bodies (latitude, longitude and optional zoom, quantile) of a
+    CSV. Values that aren't numbers are sent as they are (invalid requests).
+    '''
+    def value(text, cast):
+        try:
+            return cast(text)
+        except ValueError:
+            return text
+
+    locations = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            data = {'latitude': value(row.get('latitude') or row['lat'], float),
+                    'longitude': value(row.get('longitude') or row['lon'], float)}
+            if row.get('zoom'):
+                data['zoom'] = value(row['zoom'], int)
+            if row.get('quantile'):
+                data['quantile'] = value(row['quantile'], float)
+            locations.append(data)
+    if not locations:
+        raise ValueError(f'No locations in {path}.')
+    return locations
+
+class LoadGenerator():
+    '''
+    Replays request bodies against an endpoint and records, per request,
+    its latency, HTTP status and problem (see `check_response`).
+
+    Each thread keeps its own session, so connections are reused. In the
+    open loop the latency is measured from the time the request was
+    scheduled, so the time waiting for a free client counts (a slow server
+    is not hidden by sending less). Requests without a response after
+    `timeout` seconds are counted as errors.
+    '''
+    def __init__(self, url, locations, options=None, decode_images=False, timeout=60.):
+        self.url = url
+        self.locations = locations
+        self.options = options or {}
+        self.decode_images = decode_images
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next = 0
+        self.results = []
+
+    def _body(self):
+        with self._lock:
+            i = self._next
+            self._next += 1
+        return dict(self.locations[i % len(self.locations)], **self.options)
+
+    def _send(self, scheduled=None):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        body = self._body()
+        start = time.perf_counter()
+        try:
+            response = session.post(self.url, json=body, timeout=self.timeout)
+            status, problem = response.status_code, check_response(response, self.decode_images)
+        except requests.RequestException as e:
+            status, problem = None, type(e).__name__
+        end = time.perf_counter()
+        with self._lock:
+            self.results.append((end - (scheduled or start), status, problem))
+
+    def closed_loop(self, concurrency, duration=None, n_requests=None):
+        ''' `concurrency` clients, each sending its next request on a response.'''
+        deadline = time.perf_counter() + duration if duration else None
+        counter = iter(range(n_requests)) if n_requests else None
+
+        def client():
+            while deadline is None or time.perf_counter() < deadline:
+                if counter is not None and next(counter, None) is None:
+                    return
+                self._send()
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def open_loop(self, rate, duration=None, n_requests=None,
+                  max_in_flight=256, poisson=False):
+        '''
+        Requests sent at `rate` per second (exponential inter-arrival times
+        if `poisson`), by up to `max_in_flight` concurrent clients.
+        '''
+        start = time.perf_counter()
+        scheduled = start
+        sent = 0
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            while (n_requests is None or sent < n_requests) and \
+                  (duration is None or scheduled - start < duration):
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self._send, scheduled)
+                sent += 1
+                scheduled += random.expovariate(rate) if poisson else 1. / rate
+
+    def report(self, elapsed):
+        ''' Throughput, errors and latency percentiles and histogram.'''
+        latencies = np.array([latency for latency, _, _ in self.results]) * 1000
+        statuses, problems = {}, {}
+        for _, status, problem in self.results:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if problem is not None:
+                problems[problem] = problems.get(problem, 0) + 1
+
+        n = len(self.results)
+        errors = sum(problems.values())
+        summary = {'requests': n,
+                   'elapsed_s': elapsed,
+                   'requests_per_s': n / elapsed if elapsed else 0.,
+                   'ok_per_s': (n - errors) / elapsed if elapsed else 0.,
+                   'error_rate': errors / n if n else 0.,
+                   'status_codes': statuses,
+                   'errors': problems}
+        if n:
+            summary.update({'mean_ms': float(latencies.mean()),
+                            'p50_ms': float(np.percentile(latencies, 50)),
+                            'p95_ms': float(np.percentile(latencies, 95)),
+                            'p99_ms': float(np.percentile(latencies, 99)),
+                            'max_ms': float(latencies.max())})
+            counts = np.histogram(latencies, [0] + HISTOGRAM_BUCKETS + [np.inf])[0]
+            summary['histogram'] = {f'<={b}ms' if b != np.inf else f'>{HISTOGRAM_BUCKETS[-1]}ms': int(c)
+                                    for b, c in zip(HISTOGRAM_BUCKETS + [np.inf], counts)}
+        return summary
+
+def print_report(summary):
+    print(f'Requests: {summary["requests"]} in {summary["elapsed_s"]:.1f} s '
+          f'({summary["requests_per_s"]:.1f} req/s, {summary["ok_per_s"]:.1f} ok/s)')
+    print(f'Errors: {summary["error_rate"]:.2%}', summary['errors'] or '')
+    print('Status codes:', summary['status_codes'])
+    if summary['requests']:
+        print('Latency (ms): ' + ', '.join(f'{k[:-3]} {summary[k]:.1f}'
+                                           for k in ['mean_ms', 'p50_ms', 'p95_ms',
+                                                     'p99_ms', 'max_ms']))
+        top = max(summary['histogram'].values())
+        for bucket, count in summary['histogram'].items():
+            bar = '#' * int(round(40 * count / top)) if top else ''
+            print(f'  {bucket:>10} {count:>8} {bar}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://localhost:5000/predict')
+    parser.add_argument('--locations', type=str, default='',
+                        help='CSV of locations to replay (load test). Without it, '
+                             'the example requests are run.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--concurrency', type=int, default=4,
+                      help='Closed loop: number of concurrent clients.')
+    mode.add_argument('--rate', type=float, default=None,
+                      help='Open loop: requests per second.')
+    parser.add_argument('--poisson', action='store_true',
+                        help='Open loop: exponential inter-arrival times.')
+    parser.add_argument('--max-in-flight', type=int, default=256,
+                        help='Open loop: maximum concurrent requests.')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='Seconds of load (default: --requests).')
+    parser.add_argument('--requests', type=int, default=None,
+                        help='Number of requests (default: one per location).')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='Requests sent (and not measured) before the load.')
+    parser.add_argument('--format', type=str, default='json',
+                        help='Response format requested (json, scores, image, multipart).')
+    parser.add_argument('--timeout', type=float, default=60.,
+                        help='Seconds to wait for each response.')
+    parser.add_argument('--no-input-image', action='store_true',
+                        help='Ask for responses without the input image.')
+    parser.add_argument('--decode-images', action='store_true',
+                        help='Also decode the images of every response.')
+    parser.add_argument('--output', type=str, default='',
+                        help='Also write the report as JSON to this file.')
+    args = parser.parse_args()
+
+    if not args.locations:
+        examples(args.url)
+        sys.exit(0)
+
+    locations = load_locations(args.locations)
+    n_requests = args.requests
+    if n_requests is None and args.duration is None:
+        n_requests = len(locations)
+
+    options = {'format': args.format}
+    if args.no_input_image:
+        options['include_input_image'] = False
+
+    if args.warmup:
+        LoadGenerator(args.url, locations, options,
+                      timeout=args.timeout).closed_loop(1, n_requests=args.warmup)
+
+    generator = LoadGenerator(args.url, locations, options, args.decode_images, args.timeout)
+    start = time.perf_counter()
+    if args.rate is not None:
+        generator.open_loop(args.rate, args.duration, n_requests,
+                            args.max_in_flight, args.poisson)
+    else:
+        generator.closed_loop(args.concurrency, args.duration, n_requests)
+    summary = generator.report(time.perf_counter() - start)
+    summary.update({'url': args.url, 'format': args.format,
+                    'mode': 'open' if args.rate is not None else 'closed',
+                    'rate': args.rate, 'concurrency': None if args.rate else args.concurrency})
+
+    print_report(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,73 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+# Production server: gunicorn app:app (this file is read from the working
+# directory). The app, and the model, are loaded once in the master and the
+# workers are forked from it, so the weights are shared copy-on-write. Each
+# worker gets its own slice of the CPU cores for its PyTorch threads, so
+# workers x threads matches the cores instead of oversubscribing them.
+
+import gc
+import os
+
+import torch
+
+from settings import (port_number, serving_workers, serving_torch_threads,
+                      serving_interop_threads, serving_http_threads, serving_pin_cores,
+                      serving_timeout)
+
+bind = f'0.0.0.0:{port_number}'
+workers = serving_workers
+worker_class = 'gthread'
+threads = serving_http_threads
+preload_app = True
+# Workers not heartbeating for this long are restarted. gthread workers
+# heartbeat from their main loop, so long streamed responses (scans) don't
+# count against it.
+timeout = serving_timeout
+
+# The master warms the model up single-threaded: OpenMP thread pools don't
+# survive a fork, the workers start their own (see post_fork). Inter-op
+# threads are left unset here, so each worker can still set them.
+torch.set_num_threads(1)
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def when_ready(server):
+    # Workers are forked with the model already loaded and warmed up.
+    import app
+    app.model_loader.join()
+    # Objects allocated so far are never collected, so collections in the
+    # workers don't write to (and copy) the shared pages.
+    gc.freeze()
+
+def pre_fork(server, worker):
+    # Lowest slot not taken by a live worker (restarted workers reuse it).
+    taken = {getattr(w, 'slot', None) for w in server.WORKERS.values()}
+    worker.slot = min(set(range(server.num_workers + 1)) - taken)
+
+def post_fork(server, worker):
+    import app
+
+    cores = available_cores()
+    n_workers = max(1, server.num_workers)
+    n_threads = serving_torch_threads or max(1, len(cores) // n_workers)
+
+    if serving_pin_cores and hasattr(os, 'sched_setaffinity') and \
+            len(cores) >= n_workers * n_threads:
+        start = (worker.slot % n_workers) * n_threads
+        os.sched_setaffinity(0, cores[start:start + n_threads])
+
+    torch.set_num_threads(n_threads)
+    torch.set_num_interop_threads(serving_interop_threads)
+    # The worker's own thread pool, kernels picked for its thread count.
+    app.registry.warm_up()
+    # Asynchronous jobs (queued ones, or interrupted by a restart) resume.
+    if app.job_runner is not None:
+        app.job_runner.start()
+
+    server.log.info('Worker %s: slot %s, %s torch threads, %s interop threads, cores %s',
+                    worker.pid, worker.slot, n_threads, serving_interop_threads,
+                    sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else '-')
@@ -6,19 +6,183 @@ secret_key = ''
 # Trained model path.
 model_path = './classification_model/models/model_cls.pt'
 
+# Version id of the model served at startup, and the checkpoints that can be
+# hot-swapped with POST /model/<version>.
+model_version = 'v1'
+model_paths = {model_version: model_path}
+
+# Token required by POST /model/<version> (`Authorization: Bearer <token>`
+# header); '' disables the endpoint. A swap only changes the model of the
+# worker process answering it.
+model_swap_token = ''
+
+# Inference backend: 'eager' (torch.save checkpoints), or 'torchscript' /
+# 'onnx' for models exported with classification_model/export.py, or 'int8'
+# for models quantized with classification_model/quantize.py (then
+# model_path points to the exported file).
+inference_backend = 'eager'
+
+# Channels-last (NHWC) memory format for the model input (and the eager
+# model). Usually faster convolutions on x86 CPUs, always with 'int8'.
+channels_last = False
+
 # Default resolution (zoom) for image downaloading.
 # Valid numbers are 17,18,19.
 # It could be extended to a wider range in case of changing the model.
 default_zoom = 18
 
+# Side (pixels) of the downloaded satellite images.
+tile_size = 512
+
 # Default quantile value for pixel-wise explainability.
 # it could be a number in {0.90, 0.92, 0.93, 0.94, 0.96, 0.98}
 default_pixel_quantile = 0.94
 
+# Response formats of /predict: 'json' (images as base64 PNG), 'scores'
+# (no images), 'image' (PNG body, data in X-* headers) and 'multipart'
+# (JSON part and PNG parts).
+response_formats = ['json', 'scores', 'image', 'multipart']
+default_response_format = 'json'
+
+# Compact explainability outputs a request can ask for (`cam_outputs`) on
+# top of the images: 'grid' (the map at the resolution of the model
+# features, e.g. 16x16) and 'polygons' (GeoJSON detection regions). They
+# don't need the full resolution map: with the 'scores' format it is not
+# computed at all.
+cam_output_types = ['grid', 'polygons']
+default_cam_outputs = []
+
+# Default encoding of the response images: 'png', 'jpeg', 'webp' or
+# 'webp_lossless'. `image_quality` (1-100) applies to JPEG and lossy WebP,
+# `png_compress_level` (0: fastest, 9: smallest) to PNG.
+image_format = 'png'
+image_quality = 90
+png_compress_level = 6
+
 # Custom messages returned after classification.
 positive_message = 'Positive detection.'
 negative_message = 'Negative detection.'
 
+# Micro-batching of concurrent queries: a forward pass is run when
+# `batch_max_size` images are waiting or the oldest one waited
+# `batch_max_wait` seconds.
+batch_max_size = 8
+batch_max_wait = 0.010
+
+# Batch prediction: maximum number of locations per request and number of
+# images downloaded concurrently.
+batch_max_locations = 1000
+download_workers = 8
+
+# Satellite tile cache. Downloaded images are kept in `tile_cache_dir`
+# (set it to '' to disable the cache) up to `tile_cache_max_bytes`, evicting
+# the least recently used ones, and are downloaded again after
+# `tile_cache_ttl` seconds. The last `tile_cache_memory_items` decoded images
+# are also kept in memory.
+tile_cache_dir = './tile_cache'
+tile_cache_max_bytes = 1 << 30
+tile_cache_ttl = 7 * 24 * 3600
+tile_cache_memory_items = 128
+
+# Cascade area scans ("cascade": true): the area is screened at
+# `cascade_start_zoom` and only tiles scoring at least `cascade_threshold`
+# (low, to keep the recall) are refined with their tiles at the next zoom,
+# down to the requested zoom.
+cascade_start_zoom = 17
+cascade_threshold = 0.2
+
+# Concurrent requests for the same tile (location rounded to
+# `coalesce_precision` decimals, zoom and model version) and explainability
+# quantile wait for a single download and inference instead of repeating them.
+coalesce_requests = True
+coalesce_precision = 6
+
+# Area scans: maximum number of tiles of a single request.
+scan_max_tiles = 10000
+
+# Model outputs (score and low resolution activation map) kept in memory for
+# the last `result_cache_items` tiles, so a new quantile for a known tile
+# doesn't run the model again (0 disables it).
+result_cache_items = 4096
+
+# Tile provider: 'google' (Static Maps API, uses `secret_key`), 'http' (a
+# server answering the same query parameters at `tile_provider_url`, e.g.
+# classification_model/tile_server.py) or 'file' (images in `tile_provider_dir`).
+tile_provider = 'google'
+tile_provider_url = ''
+tile_provider_dir = ''
+
+# Tile downloads: timeout (seconds) and retries of each request, base and
+# maximum backoff (seconds) between retries (an upstream Retry-After above
+# the maximum fails the download), maximum requests started per second (0: no
+# limit) and maximum simultaneous requests per process.
+download_timeout = 10.
+download_retries = 3
+download_backoff = 0.5
+download_max_backoff = 10.
+download_rate_limit = 0.
+download_max_concurrency = 16
+
+# Admission control (per process): max. requests downloading and running
+# the model at once, and max. requests waiting for each stage. Beyond
+# that a request is rejected at once with `admission_reject_status` (503 or
+# 429) and a Retry-After header, instead of queueing until it times out.
+# Requests are dropped (504) before the model runs once their deadline
+# passed: the X-Request-Timeout header (seconds) or
+# `admission_default_timeout` (0: no deadline). Decoded tiles held by
+# requests are limited to `admission_memory_budget` bytes (0: no limit).
+# Scans and jobs wait for their turn instead of being rejected.
+admission_control = True
+admission_download_max_in_flight = 32
+admission_download_max_queue = 64
+admission_inference_max_in_flight = 16
+admission_inference_max_queue = 64
+admission_reject_status = 503
+admission_default_timeout = 30.
+admission_memory_budget = 512 * 1024 ** 2
+
+# Asynchronous jobs (POST /jobs): SQLite database of the durable job queue
+# ('' disables the jobs API), job worker threads per process, tiles stored
+# per checkpoint, seconds without a heartbeat (renewed every third of it while
+# the job runs) after which a running job is taken over (e.g. its process
+# died), max. tiles per job and per results page.
+jobs_db = './jobs.sqlite3'
+jobs_workers = 2
+jobs_chunk_size = 64
+jobs_lease = 60.
+jobs_max_tiles = 100000
+jobs_page_size = 1000
+
+# Past predictions (GET /detections): SQLite database indexed by tile
+# footprint ('' disables it), written in background. The raw explainability
+# map of positives is stored with them if `detections_store_cam`.
+# /predict with the 'scores' format answers from a stored prediction of the
+# same tile and model younger than `max_age` seconds (request parameter,
+# default `detections_max_age`; 0 always runs the model). Max. results and
+# radius (meters) of a query.
+detections_db = './detections.sqlite3'
+detections_store_cam = True
+detections_max_age = 0
+detections_max_results = 1000
+detections_max_radius = 50000.
+
+# Add a Server-Timing header (duration of each stage of the query) to the
+# responses. Metrics are always exposed at /metrics.
+server_timing_header = False
+
 # Server settings (also in set it in Dockerfile)
 port_number = 5000
 
+# Production server (gunicorn.conf.py). The model is loaded once before
+# forking the workers, which share its memory. PyTorch threads per worker
+# (0: the available cores split among the workers, each worker pinned to
+# its own cores), PyTorch inter-op threads per worker, HTTP threads per
+# worker (requests of a worker share its micro-batches) and seconds after
+# which a hung worker (no heartbeat) is restarted.
+serving_workers = 2
+serving_torch_threads = 0
+serving_interop_threads = 1
+serving_http_threads = 8
+serving_pin_cores = True
+serving_timeout = 120
+
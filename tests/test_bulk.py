@@ -0,0 +1,23 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import os
+
+import pytest
+
+from classification_model.bulk import ParquetWriter
+
+def test_parquet_resume_after_kill(tmp_path):
+    pytest.importorskip('pyarrow')
+    path = str(tmp_path / 'out.parquet')
+    writer = ParquetWriter(path)
+    writer.write([{'index': 0, 'status': 'success', 'prediction': True, 'score': 0.9}])
+    state = writer.commit()
+    writer.write([{'index': 1, 'status': 'success', 'prediction': False, 'score': 0.1}])
+    writer.commit()
+    # Killed while writing the next part: after the checkpoint, half written.
+    with open(os.path.join(path, 'part-000002.parquet.tmp'), 'wb') as f:
+        f.write(b'PAR1')
+
+    writer = ParquetWriter(path, state)
+    assert sorted(os.listdir(path)) == ['part-000000.parquet']
+    assert writer.commit() == {'parts': 1}
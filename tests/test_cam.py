@@ -0,0 +1,65 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import threading
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from classification_model.cam import CAMExtractor
+from classification_model.preprocessing import Preprocessor
+from classification_model.query import ModelQuery
+
+class TinyResNet(nn.Module):
+    ''' Smallest model with the `layer4` and `fc` used by the extractor.'''
+    def __init__(self):
+        super().__init__()
+        self.layer4 = nn.Conv2d(3, 4, 3, stride=2, padding=1)
+        self.fc = nn.Linear(4, 1)
+
+    def forward(self, x):
+        features = self.layer4(x)
+        return self.fc(torch.flatten(features.mean((2, 3)), 1))
+
+def query(model, input_):
+    return CAMExtractor.for_model(model)(input_)
+
+def test_constant_state_per_query():
+    torch.manual_seed(0)
+    model = TinyResNet().eval()
+    image = np.random.default_rng(0).integers(0, 256, (3, 16, 16), dtype=np.uint8)
+
+    # As the service: a ModelQuery per query, on the same model.
+    for _ in range(10000):
+        pred, score, cam = ModelQuery(model=model, threshold=0.,
+                                      preprocessor=Preprocessor()).make_query(image)
+        # A single hook, however many queries ran.
+        assert len(model.layer4._forward_hooks) == 1
+
+    assert cam.shape == (16, 16)
+    extractor = CAMExtractor.for_model(model)
+    assert ModelQuery(model=model).extractor is extractor
+    # No features kept between queries.
+    assert vars(extractor._local) == {'features': None}
+
+def test_thread_local_features():
+    torch.manual_seed(0)
+    model = TinyResNet().eval()
+    inputs = [torch.rand(1, 3, 16, 16) for _ in range(4)]
+    expected = [query(model, x)[1] for x in inputs]
+    errors = []
+
+    def run(i):
+        for _ in range(200):
+            _, cam = query(model, inputs[i])
+            if not torch.equal(cam, expected[i]):
+                errors.append(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(model.layer4._forward_hooks) == 1
@@ -0,0 +1,22 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import time
+
+from classification_model.detections import DetectionStore
+
+def test_writer_survives_an_unwritable_batch(tmp_path):
+    store = DetectionStore(str(tmp_path / 'detections.sqlite3'), flush_interval=0.05)
+    # Not convertible to a float32 map.
+    store.add(-34.6, -58.4, 18, True, 0.9, 'v1', cam=[['not', 'a'], ['number', '!']])
+
+    deadline = time.monotonic() + 5.
+    while store.stats()['dropped'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert store.stats()['dropped'] == 1
+
+    store.add(-34.6, -58.4, 18, True, 0.9, 'v1')
+    while store.stats()['written'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stats = store.stats()
+    assert stats['written'] == 1 and stats['queued'] == 0
+    assert store.latest(-34.6, -58.4, 18, 'v1', max_age=60.)['score'] == 0.9
@@ -0,0 +1,50 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from classification_model.downloader import DownloadError, TileFetcher
+
+@pytest.fixture
+def upstream():
+    ''' Local server answering the queued (status, headers) in order, then 200.'''
+    answers = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, headers = answers.pop(0) if answers else (200, {})
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/tile', answers
+    server.shutdown()
+    server.server_close()
+
+def test_long_retry_after_fails(upstream):
+    url, answers = upstream
+    answers.append((503, {'Retry-After': '3600'}))
+    fetcher = TileFetcher(retries=3, backoff=0.01, max_backoff=1.)
+    start = time.monotonic()
+    with pytest.raises(DownloadError) as error:
+        fetcher.get(url)
+    assert error.value.status_code == 503
+    assert time.monotonic() - start < 1.
+
+def test_short_retry_after_is_retried(upstream):
+    url, answers = upstream
+    answers.append((429, {'Retry-After': '0'}))
+    fetcher = TileFetcher(retries=3, backoff=0.01, max_backoff=1.)
+    assert fetcher.get(url) == b'ok'
@@ -0,0 +1,40 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import pytest
+import torch
+import torchvision
+
+from classification_model.cam import CAMExtractor
+from classification_model.engines import load_engine
+from classification_model.export import check_parity, export_onnx, export_torchscript
+
+SIZE = 64
+
+@pytest.fixture(scope='module')
+def model():
+    # Same architecture as the served classifier, random weights.
+    torch.manual_seed(0)
+    return torchvision.models.resnet18(weights=None, num_classes=1).eval()
+
+@pytest.mark.parametrize('backend, export, suffix',
+                         [('torchscript', export_torchscript, '.ts'),
+                          ('onnx', export_onnx, '.onnx')])
+def test_backend_parity(model, tmp_path, backend, export, suffix):
+    if backend == 'onnx':
+        pytest.importorskip('onnx')
+        pytest.importorskip('onnxruntime')
+    path = str(tmp_path / ('model' + suffix))
+    export(model, path, SIZE)
+    engine = load_engine(backend, path)
+
+    # Raw outputs: logits and layer4 maps.
+    input_ = torch.rand(2, 3, SIZE, SIZE)
+    expected_logits, expected_cam = CAMExtractor.for_model(model)(input_)
+    logits, cam = engine(input_)
+    assert logits.shape == expected_logits.shape and cam.shape == expected_cam.shape
+    assert torch.allclose(logits, expected_logits, atol=1e-4)
+    assert torch.allclose(cam, expected_cam, atol=1e-3)
+
+    # Scores and upsampled explainability maps of the served query.
+    report = check_parity(model, engine, n_images=4, size=SIZE)
+    assert report['ok'], report
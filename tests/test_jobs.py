@@ -0,0 +1,33 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import time
+
+from classification_model.jobs import DONE, RUNNING, JobRunner, JobStore
+
+def test_lease_renewed_during_a_long_chunk(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite3'), lease=0.3)
+    job_id = store.create({}, [{'tile': 0}, {'tile': 1}])
+
+    def process(params, tile):
+        # Much longer than the lease.
+        time.sleep(1.)
+        return {'prediction': False}
+
+    runner = JobRunner(store, process, workers=1, max_workers=1, chunk_size=2,
+                       poll_interval=0.05)
+    runner.start()
+    while store.get(job_id)['status'] != RUNNING:
+        time.sleep(0.01)
+
+    deadline = time.monotonic() + 10.
+    taken_over = None
+    while time.monotonic() < deadline:
+        # Another process looking for expired leases.
+        taken_over = taken_over or store.claim('other')
+        job = store.get(job_id)
+        if job['status'] == DONE:
+            break
+        time.sleep(0.05)
+
+    assert taken_over is None
+    assert job['status'] == DONE and job['done'] == 2
@@ -0,0 +1,26 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import time
+
+import pytest
+
+from classification_model.scheduler import BatchScheduler
+
+def test_deadline_checked_after_an_idle_queue():
+    ran = []
+
+    def run_batch(items):
+        ran.extend(items)
+        return items
+
+    scheduler = BatchScheduler(run_batch, max_batch_size=8, max_wait=0.2)
+    assert scheduler.submit('first').result(timeout=5.) == 'first'
+
+    # Idle for longer than the deadline of the next item.
+    time.sleep(0.3)
+    # Expires while waiting for the batch to fill.
+    future = scheduler.submit('late', deadline=time.monotonic() + 0.05)
+    with pytest.raises(TimeoutError):
+        future.result(timeout=5.)
+    assert ran == ['first']
+    assert scheduler.stats()['expired'] == 1
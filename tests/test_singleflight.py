@@ -0,0 +1,38 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import threading
+import time
+
+import pytest
+
+from classification_model.singleflight import SingleFlight
+
+def test_follower_timeout():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    results = []
+
+    def slow():
+        started.set()
+        release.wait()
+        return 42
+
+    leader = threading.Thread(target=lambda: results.append(flight.do('tile', slow)))
+    leader.start()
+    started.wait()
+
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        flight.do('tile', slow, timeout=0.1)
+    assert time.monotonic() - start < 1.
+
+    # The run goes on for the leader and the other followers.
+    follower = threading.Thread(target=lambda: results.append(flight.do('tile', slow)))
+    follower.start()
+    while flight.stats()['coalesced'] < 2:
+        time.sleep(0.01)
+    release.set()
+    leader.join()
+    follower.join()
+    assert sorted(results, key=lambda r: r[1]) == [(42, False), (42, True)]
+    assert flight.stats() == {'leaders': 1, 'coalesced': 2, 'in_flight': 0}
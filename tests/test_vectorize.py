@@ -0,0 +1,60 @@
+# Matias D. Molina - molinamatiasd@gmail.com - linkedin.com/in/matiasmolina
+
+import numpy as np
+import pytest
+
+from classification_model.vectorize import grid_polygons
+
+shapely = pytest.importorskip('shapely')
+from shapely.geometry import shape
+
+SHAPE = (16, 16)
+
+# Cells touching only at a corner.
+CORNER_MASKS = [
+    # Hole touching the outer boundary at a vertex.
+    [[1, 1, 1, 0],
+     [1, 0, 0, 1],
+     [1, 1, 1, 1]],
+    # Two holes touching each other at a vertex.
+    [[1, 1, 1, 1],
+     [1, 0, 1, 1],
+     [1, 1, 0, 1],
+     [1, 1, 1, 1]],
+    # Diagonal cells closing a pocket.
+    [[0, 1, 0],
+     [1, 0, 1],
+     [0, 1, 1]],
+    [[1, 0, 1],
+     [0, 1, 0],
+     [1, 0, 1]],
+]
+
+def polygons(mask):
+    grid = np.asarray(mask, dtype=np.float32)
+    collection = grid_polygons(grid, (-34.6, -58.4), 18, SHAPE)
+    return [(shape(f['geometry']), f['properties']) for f in collection['features']]
+
+@pytest.mark.parametrize('mask', CORNER_MASKS)
+def test_corner_touching_masks_are_valid(mask):
+    for polygon, _ in polygons(mask):
+        assert shapely.is_valid(polygon), shapely.is_valid_reason(polygon)
+
+def test_hole_touching_outer_ring():
+    [(polygon, properties)] = polygons(CORNER_MASKS[0])
+    assert properties['cells'] == 9
+    assert len(polygon.interiors) == 1
+
+def test_random_masks():
+    rng = np.random.default_rng(0)
+    cell_area = polygons(np.ones((16, 16)))[0][0].area / 256
+    for _ in range(200):
+        mask = rng.random((16, 16)) < rng.uniform(0.3, 0.7)
+        features = polygons(mask)
+        assert sum(p['cells'] for _, p in features) == mask.sum()
+        for polygon, properties in features:
+            assert shapely.is_valid(polygon), shapely.is_valid_reason(polygon)
+            # Right-hand rule: counterclockwise shell, clockwise holes.
+            assert polygon.exterior.is_ccw
+            assert not any(ring.is_ccw for ring in polygon.interiors)
+            assert polygon.area / cell_area == pytest.approx(properties['cells'], rel=1e-5)
@@ -25,3 +25,91 @@ def check_arguments(zoom, quantile, lat, lon):
     if not is_valid_longitude(lon):
         err_msg['longitude'] = f'Invalid longitude value ({lon}).'
     return err_msg
+
+def is_valid_bbox(bbox):
+    # (min_lon, min_lat, max_lon, max_lat)
+    if not isinstance(bbox, (list, tuple)) or len(bbox) != 4:
+        return False
+    if not all(type(v) == float for v in bbox):
+        return False
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return (is_valid_longitude(min_lon) and is_valid_longitude(max_lon) and
+            is_valid_latitude(min_lat) and is_valid_latitude(max_lat) and
+            min_lon < max_lon and min_lat < max_lat)
+
+def check_area_arguments(zoom, quantile, bbox):
+    err_msg = {}
+    if not is_valid_zoom(zoom):
+        err_msg['zoom'] = f'Invalid zoom value ({zoom}).'
+    if not is_valid_quantile(quantile):
+        err_msg['quantile'] = f'Invalid quantile value ({quantile}).'
+    if not is_valid_bbox(bbox):
+        err_msg['bbox'] = f'Invalid bounding box ({bbox}).'
+    return err_msg
+
+def is_valid_threshold(threshold):
+    return isinstance(threshold, (int, float)) and 0. <= threshold <= 1.
+
+def check_cascade_arguments(start_zoom, zoom, threshold):
+    err_msg = {}
+    if not is_valid_zoom(start_zoom) or start_zoom >= zoom:
+        err_msg['cascade_start_zoom'] = (f'Invalid cascade start zoom ({start_zoom}), '
+                                         f'it must be a valid zoom lower than {zoom}.')
+    if not is_valid_threshold(threshold):
+        err_msg['cascade_threshold'] = f'Invalid cascade threshold ({threshold}).'
+    return err_msg
+
+def is_valid_format(fmt, formats):
+    return fmt in formats
+
+def check_output_arguments(fmt, include_input_image, formats):
+    err_msg = {}
+    if not is_valid_format(fmt, formats):
+        err_msg['format'] = f'Invalid format value ({fmt}).'
+    if type(include_input_image) != bool:
+        err_msg['include_input_image'] = f'Invalid include_input_image value ({include_input_image}).'
+    return err_msg
+
+def check_cam_arguments(cam_outputs, fmt, types):
+    err_msg = {}
+    if not isinstance(cam_outputs, list) or any(t not in types for t in cam_outputs):
+        err_msg['cam_outputs'] = f'Invalid cam_outputs value ({cam_outputs}).'
+    elif cam_outputs and fmt == 'image':
+        err_msg['cam_outputs'] = 'cam_outputs are not available with the image format.'
+    return err_msg
+
+def is_valid_image_quality(quality):
+    return type(quality) == int and 1 <= quality <= 100
+
+def is_valid_compress_level(level):
+    return type(level) == int and 0 <= level <= 9
+
+def check_encoding_arguments(image_format, quality, compress_level, formats):
+    err_msg = {}
+    if image_format not in formats:
+        err_msg['image_format'] = f'Invalid image_format value ({image_format}).'
+    if not is_valid_image_quality(quality):
+        err_msg['image_quality'] = f'Invalid image_quality value ({quality}).'
+    if not is_valid_compress_level(compress_level):
+        err_msg['png_compress_level'] = f'Invalid png_compress_level value ({compress_level}).'
+    return err_msg
+
+def check_detections_arguments(bbox, center, radius, limit, max_radius, max_results):
+    err_msg = {}
+    if center is None:
+        if not is_valid_bbox(bbox):
+            err_msg['bbox'] = f'Invalid bounding box ({bbox}).'
+    else:
+        lat, lon = center
+        if not is_valid_latitude(lat):
+            err_msg['latitude'] = f'Invalid latitude value ({lat}).'
+        if not is_valid_longitude(lon):
+            err_msg['longitude'] = f'Invalid longitude value ({lon}).'
+        if type(radius) != float or not 0 < radius <= max_radius:
+            err_msg['radius'] = f'Invalid radius ({radius}), at most {max_radius} meters.'
+    if type(limit) != int or not 0 < limit <= max_results:
+        err_msg['limit'] = f'Invalid limit ({limit}), at most {max_results}.'
+    return err_msg
+
+def is_valid_max_age(max_age):
+    return type(max_age) in (int, float) and max_age >= 0